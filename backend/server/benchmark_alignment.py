@@ -0,0 +1,215 @@
+"""
+Benchmarks for the MIMS-to-EM alignment helpers.
+
+Usage:
+    python benchmark_alignment.py [--sizes 1000 2000 4000] [--repeat 3]
+        [--search-size 1800] [--trials 4] [--levels 4 2 1]
+        [--tps-size 800] [--landmarks 12 40 120] [--tps-step 8]
+        [--tps-tolerance 0.05]
+"""
+
+import argparse
+import os
+import time
+
+import cv2
+import django
+import numpy as np
+import pyvips
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
+django.setup()
+
+from mims.services.fft_alignment import fft_threshold_match  # noqa: E402
+from mims.services.image_utils import correct_inner_zeros  # noqa: E402
+from mims.services.register import evaluate_tps_grid  # noqa: E402
+from skimage.transform import ThinPlateSplineTransform  # noqa: E402
+
+# Reference: the FFT search at full resolution only, with no coarser level
+SINGLE_LEVEL = [1]
+
+
+def correct_inner_zeros_loop(original_array):
+    """Pure-Python reference implementation correct_inner_zeros replaced."""
+    array = original_array.astype(np.uint8)
+    array = np.where(array == 0, 1, array)
+    for y in range(0, array.shape[0] - 1):
+        for x in range(0, array.shape[1] - 1):
+            if array[y][x] not in [1]:
+                break
+            array[y][x] = 0
+        for x in range(array.shape[1] - 1, 0, -1):
+            if array[y][x] not in [1]:
+                break
+            array[y][x] = 0
+    for x in range(0, array.shape[1] - 1):
+        for y in range(0, array.shape[0] - 1):
+            if array[y][x] not in [1]:
+                break
+            array[y][x] = 0
+        for y in range(array.shape[0] - 1, 0, -1):
+            if array[y][x] not in [1]:
+                break
+            array[y][x] = 0
+    return array
+
+
+def synthetic_em(size, seed=0):
+    """Downscaled-EM-like image: a rotated textured section on a zero border."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    c = size / 2
+    theta = np.radians(20)
+    u = (xx - c) * np.cos(theta) + (yy - c) * np.sin(theta)
+    v = -(xx - c) * np.sin(theta) + (yy - c) * np.cos(theta)
+    section = (np.abs(u) < size * 0.35) & (np.abs(v) < size * 0.3)
+    image = rng.integers(0, 256, (size, size), dtype=np.uint8)
+    # Sparse true zeros inside the section are what correct_inner_zeros keeps
+    image[rng.random((size, size)) < 0.01] = 0
+    image[~section] = 0
+    return image
+
+
+def _best_time(fn, image, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(image)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark_correct_inner_zeros(sizes, repeat):
+    print("correct_inner_zeros")
+    print(f"{'size':>8} {'loop (s)':>10} {'numpy (s)':>10} {'speedup':>9} identical")
+    for size in sizes:
+        image = synthetic_em(size)
+        loop_time, expected = _best_time(correct_inner_zeros_loop, image, 1)
+        numpy_time, actual = _best_time(correct_inner_zeros, image, repeat)
+        print(
+            f"{size:>8} {loop_time:>10.3f} {numpy_time:>10.4f} "
+            f"{loop_time / numpy_time:>8.0f}x {np.array_equal(expected, actual)}"
+        )
+
+
+def synthetic_section(size, seed=0):
+    """Smooth textured section on a zero border, like a padded EM canvas."""
+    rng = np.random.default_rng(seed)
+    border = size // 8
+    texture = rng.normal(size=(size - 2 * border, size - 2 * border))
+    texture = cv2.GaussianBlur(texture, (0, 0), 4)
+    texture = np.clip(texture / texture.std() * 40 + 128, 1, 255).astype(np.uint8)
+    image = np.zeros((size, size), dtype=np.uint8)
+    image[border:-border, border:-border] = texture
+    return image
+
+
+def synthetic_tile(section, x, y, angle, flip_hor, tile_size=512):
+    """Crop of the section that the search should find at (x, y, angle, flip)."""
+    tile = pyvips.Image.new_from_array(section[y : y + tile_size, x : x + tile_size])
+    if flip_hor:
+        tile = tile.fliphor()
+    if angle:
+        tile = tile.rotate(-angle, background=0)
+    return tile.numpy()
+
+
+def _same_location(a, b):
+    return (
+        np.hypot(a[0] - b[0], a[1] - b[1]) < 40 and a[3] == b[3] and a[4] == b[4]
+    )
+
+
+def benchmark_alignment_search(size, trials, levels):
+    """
+    Regression check of the pyramid search against the single-level search.
+
+    For random tiles cut from a synthetic section at random orientations,
+    reports both runtimes, whether the best match is the same and how many of
+    the full-resolution top 3 the pyramid also returns.
+    """
+    print(f"alignment search, {size}px canvas, levels {levels}")
+    print(
+        f"{'angle':>6} {'flip':>5} {'single (s)':>12} {'pyramid (s)':>12} "
+        f"{'speedup':>8} {'top-1':>6} {'top-3':>6}"
+    )
+    section = synthetic_section(size)
+    rng = np.random.default_rng(1)
+    for _ in range(trials):
+        angle = int(rng.integers(0, 24)) * 15
+        flip_hor = bool(rng.integers(0, 2))
+        x, y = (int(v) for v in rng.integers(size // 8, size - size // 8 - 512, 2))
+        tile = synthetic_tile(section, x, y, angle, flip_hor)
+
+        start = time.perf_counter()
+        single = fft_threshold_match(section, tile, levels=SINGLE_LEVEL)
+        single_time = time.perf_counter() - start
+        start = time.perf_counter()
+        pyramid = fft_threshold_match(section, tile, levels=levels)
+        pyramid_time = time.perf_counter() - start
+
+        top_1 = bool(single and pyramid and single[0][:2] == pyramid[0][:2])
+        top_3 = sum(any(_same_location(s, p) for p in pyramid) for s in single)
+        print(
+            f"{angle:>6} {str(flip_hor):>5} {single_time:>12.2f} "
+            f"{pyramid_time:>12.2f} {single_time / pyramid_time:>7.1f}x "
+            f"{str(top_1):>6} {top_3:>4}/{len(single)}"
+        )
+
+
+def synthetic_tps(size, landmarks, seed=0):
+    """TPS through random landmarks on a smoothly distorted canvas."""
+    rng = np.random.default_rng(seed)
+    src = rng.uniform(0, size, (landmarks, 2))
+    dst = src + np.column_stack(
+        [6 * np.sin(src[:, 1] / size * 3), 5 * np.cos(src[:, 0] / size * 2)]
+    )
+    dst += rng.normal(0, 0.5, src.shape)
+    tps = ThinPlateSplineTransform()
+    tps.estimate(dst, src)
+    return tps
+
+
+def benchmark_tps_grid(size, landmarks, step, tolerance):
+    """Sparse-grid TPS evaluation against the dense one, on a size x size canvas."""
+    print(f"TPS grid, {size}px canvas, step {step}, tolerance {tolerance}")
+    print(
+        f"{'landmarks':>10} {'dense (s)':>10} {'grid (s)':>9} {'speedup':>8} "
+        f"{'est. error':>11} {'true error':>11} {'dense px':>9}"
+    )
+    xs = np.arange(size)
+    for count in landmarks:
+        tps = synthetic_tps(size, count)
+        start = time.perf_counter()
+        grid = np.stack(np.meshgrid(xs, xs), axis=-1).reshape(-1, 2).astype(float)
+        dense = np.concatenate([tps(c) for c in np.array_split(grid, size)])
+        dense_time = time.perf_counter() - start
+        start = time.perf_counter()
+        coords, report = evaluate_tps_grid(tps, size, size, step, tolerance)
+        grid_time = time.perf_counter() - start
+        true_error = np.linalg.norm(coords.reshape(-1, 2) - dense, axis=-1).max()
+        print(
+            f"{count:>10} {dense_time:>10.2f} {grid_time:>9.3f} "
+            f"{dense_time / grid_time:>7.1f}x {report['max_error']:>11.4f} "
+            f"{true_error:>11.4f} {report['dense_fraction']:>8.1%}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 1000, 2000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--search-size", type=int, default=1800)
+    parser.add_argument("--trials", type=int, default=4)
+    parser.add_argument("--levels", type=int, nargs="+", default=[4, 2, 1])
+    parser.add_argument("--tps-size", type=int, default=800)
+    parser.add_argument("--landmarks", type=int, nargs="+", default=[12, 40, 120])
+    parser.add_argument("--tps-step", type=int, default=8)
+    parser.add_argument("--tps-tolerance", type=float, default=0.05)
+    args = parser.parse_args()
+    benchmark_correct_inner_zeros(args.sizes, args.repeat)
+    benchmark_alignment_search(args.search_size, args.trials, args.levels)
+    benchmark_tps_grid(
+        args.tps_size, args.landmarks, args.tps_step, args.tps_tolerance
+    )
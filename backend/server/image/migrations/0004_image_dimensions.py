@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-17 14:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("image", "0003_image_view_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="width",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="height",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="dtype",
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
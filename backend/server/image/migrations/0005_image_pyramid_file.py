@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-17 15:48
+
+from django.db import migrations, models
+
+import image.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("image", "0004_image_dimensions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="pyramid_file",
+            field=models.FileField(
+                blank=True,
+                null=True,
+                upload_to=image.models.get_em_image_upload_path,
+            ),
+        ),
+    ]
@@ -1,11 +1,26 @@
 from django.db import models
 from core.models import AbstractBaseModel, CanvasObj, Canvas
-from PIL import Image
+from PIL import Image as PILImage
+import numpy as np
 import os
+import pyvips
 import shutil
-from image.tasks import convert_to_dzi_format
+from celery import chain
+from image.tasks import convert_to_dzi_format, create_pyramid_tiff
 
-Image.MAX_IMAGE_PIXELS = None
+PILImage.MAX_IMAGE_PIXELS = None
+
+# libvips band formats as numpy dtype names
+VIPS_FORMAT_TO_DTYPE = {
+    "uchar": "uint8",
+    "char": "int8",
+    "ushort": "uint16",
+    "short": "int16",
+    "uint": "uint32",
+    "int": "int32",
+    "float": "float32",
+    "double": "float64",
+}
 
 
 def get_em_image_upload_path(instance, filename):
@@ -36,6 +51,15 @@ class Image(CanvasObj):
     view_status = models.IntegerField(
         choices=ViewStatus.choices, default=ViewStatus.UNPROCESSED
     )
+    # Read from the file header at upload so nothing has to decode the image
+    # just to know its size
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+    dtype = models.CharField(max_length=16, null=True, blank=True)
+    # Tiled, pyramidal copy of file written at upload, used for all reads
+    pyramid_file = models.FileField(
+        upload_to=get_em_image_upload_path, blank=True, null=True
+    )
 
     def __str__(self):
         return self.file.path
@@ -45,17 +69,104 @@ class Image(CanvasObj):
         return self.file.url
 
     def save(self, *args, **kwargs):
-        is_new = self.pk is None
+        # The UUID primary key is set before the first save, so pk is no sign
+        # of a new row
+        is_new = self._state.adding
         super().save(*args, **kwargs)
         if is_new:
             # Try and get the pixel size from the image metadata
             try:
-                with Image.open(self.file.path) as img:
+                with PILImage.open(self.file.path) as img:
                     self.pixel_size_nm = float(img.tag_v2.get(0x828D, [0])[0])
                     super().save(update_fields=["pixel_size_nm"])
             except Exception:
                 pass
-            convert_to_dzi_format.delay(self.id)
+            try:
+                self.read_dimensions()
+            except Exception as e:
+                print(f"Could not read the dimensions of {self.file.name}: {e}")
+            chain(
+                create_pyramid_tiff.si(self.id), convert_to_dzi_format.si(self.id)
+            ).delay()
+
+    @property
+    def source_path(self):
+        """The pyramidal TIFF once it exists, otherwise the uploaded file."""
+        if self.pyramid_file and os.path.exists(self.pyramid_file.path):
+            return self.pyramid_file.path
+        return self.file.path
+
+    def _open(self, scale=1.0):
+        """
+        Open the image at the pyramid level closest to, and not smaller than,
+        scale. Returns the pyvips image and its size relative to full resolution.
+        """
+        path = self.source_path
+        # TIFFs can be read at any position; other formats are decoded top to
+        # bottom, which keeps a single region read from holding the whole image
+        is_tiff = path.lower().endswith((".tif", ".tiff"))
+        access = "random" if is_tiff else "sequential"
+        img = pyvips.Image.new_from_file(path, access=access)
+        # Pages of an upload are planes or channels, only those of the pyramid
+        # are levels
+        if scale < 1 and path != self.file.path and "n-pages" in img.get_fields():
+            level = min(int(np.log2(1 / scale)), img.get("n-pages") - 1)
+            if level > 0:
+                page = pyvips.Image.new_from_file(path, page=level, access=access)
+                if abs(page.width - img.width / 2**level) <= 1:
+                    img = page
+        return img, img.width / self.get_dimensions()[0]
+
+    def read_dimensions(self):
+        """Store width, height and dtype from the file header."""
+        img = pyvips.Image.new_from_file(self.file.path)
+        self.width = img.width
+        self.height = img.height
+        self.dtype = VIPS_FORMAT_TO_DTYPE.get(img.format, img.format)
+        super().save(update_fields=["width", "height", "dtype"])
+
+    def get_dimensions(self):
+        """
+        Returns (width, height), reading the file header only the first time for
+        images uploaded before they were stored.
+        """
+        if self.width is None or self.height is None or not self.dtype:
+            self.read_dimensions()
+        return self.width, self.height
+
+    @property
+    def shape(self):
+        """(height, width), like the first two axes of the image array."""
+        width, height = self.get_dimensions()
+        return height, width
+
+    def crop(self, x0, y0, x1, y1, scale=1.0):
+        """
+        The [y0:y1, x0:x1] region of the image as a numpy array, read without
+        loading the rest of the image. Bounds are clipped to the image like
+        numpy slicing.
+
+        With scale < 1 the region is read from the nearest pyramid level and
+        resized by the remaining factor, so it costs about the output size.
+        """
+        width, height = self.get_dimensions()
+        x0, x1 = (int(np.clip(v, 0, width)) for v in (x0, x1))
+        y0, y1 = (int(np.clip(v, 0, height)) for v in (y0, y1))
+        if x1 <= x0 or y1 <= y0:
+            return np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=self.dtype)
+        img, level_scale = self._open(scale)
+        left, top = int(x0 * level_scale), int(y0 * level_scale)
+        right = min(img.width, max(left + 1, int(np.ceil(x1 * level_scale))))
+        bottom = min(img.height, max(top + 1, int(np.ceil(y1 * level_scale))))
+        region = img.crop(left, top, right - left, bottom - top)
+        if scale != level_scale:
+            region = region.resize(scale / level_scale)
+        return region.numpy()
+
+    def read(self, scale=1.0):
+        """The whole image, resized by scale from the nearest pyramid level."""
+        width, height = self.get_dimensions()
+        return self.crop(0, 0, width, height, scale)
 
     def delete(self, *args, **kwargs):
         # Delete the media directory with the EM image files
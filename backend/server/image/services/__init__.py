@@ -0,0 +1,19 @@
+"""Image services shared by the EM, MIMS and segmentation apps."""
+
+# libvips threads
+from .concurrency import set_worker_concurrency, vips_profile, worker_concurrency
+
+# Tile pyramids
+from .dzi import get_dzi_source, prepare_dzi_image, save_dzi, update_dzi_region
+
+__all__ = [
+    # libvips threads
+    "set_worker_concurrency",
+    "worker_concurrency",
+    "vips_profile",
+    # Tile pyramids
+    "get_dzi_source",
+    "prepare_dzi_image",
+    "save_dzi",
+    "update_dzi_region",
+]
@@ -0,0 +1,113 @@
+"""libvips thread counts for Celery workers and per task type."""
+
+import os
+import time
+from contextlib import contextmanager
+
+import pyvips
+from django.conf import settings
+
+# libvips threads per task type, 0 meaning every core of the machine
+CONCURRENCY_PROFILES = getattr(
+    settings,
+    "VIPS_CONCURRENCY_PROFILES",
+    {"em": 0, "overlay": 1, "composite": 1, "segmentation": 0},
+)
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _concurrency_functions():
+    """
+    libvips concurrency getter and setter, or (None, None) if unavailable.
+
+    pyvips only wraps them from 3.2 on. With older versions in ABI mode they
+    are declared here; a compiled (API mode) binding without them cannot
+    change the thread count.
+    """
+    if hasattr(pyvips, "concurrency_set"):
+        return pyvips.concurrency_get, pyvips.concurrency_set
+    if not pyvips.API_mode:
+        try:
+            pyvips.ffi.cdef(
+                "int vips_concurrency_get(void);"
+                "void vips_concurrency_set(int concurrency);"
+            )
+        except Exception:
+            # Already declared
+            pass
+    if hasattr(pyvips.vips_lib, "vips_concurrency_set"):
+        return pyvips.vips_lib.vips_concurrency_get, pyvips.vips_lib.vips_concurrency_set
+    print("libvips concurrency cannot be set with this pyvips, keeping its default")
+    return None, None
+
+
+_concurrency_get, _concurrency_set = _concurrency_functions()
+
+
+def get_concurrency():
+    """libvips threads of this process, or None if unknown."""
+    return _concurrency_get() if _concurrency_get else None
+
+
+def set_concurrency(threads):
+    """Set the libvips threads of this process, if the binding allows it."""
+    if _concurrency_set and threads:
+        _concurrency_set(threads)
+
+
+def worker_concurrency(pool_size):
+    """
+    Default libvips threads of one worker process: the cores shared out over
+    the processes of the pool, so that a busy worker does not run
+    pool_size x cores threads.
+    """
+    return max(1, _cpu_count() // max(1, pool_size or _cpu_count()))
+
+
+def set_worker_concurrency(pool_size):
+    """Set the default libvips threads of this process, see worker_concurrency."""
+    threads = worker_concurrency(pool_size)
+    set_concurrency(threads)
+    print(f"libvips concurrency {threads} (pool of {pool_size} processes)")
+    return threads
+
+
+def profile_concurrency(profile):
+    """libvips threads of a task type, or None to keep the worker default."""
+    if profile not in CONCURRENCY_PROFILES:
+        return None
+    return CONCURRENCY_PROFILES[profile] or _cpu_count()
+
+
+@contextmanager
+def vips_profile(profile=None):
+    """
+    Run libvips operations with the thread count of a task type and measure
+    how much of it they used.
+
+    Yields a dict that is filled in on exit with "threads", "seconds",
+    "cpu_seconds" (process CPU time, every thread included) and
+    "cpu_utilization" (cpu_seconds / (seconds * threads)).
+    """
+    previous = get_concurrency()
+    threads = profile_concurrency(profile) or previous or _cpu_count()
+    set_concurrency(threads)
+    stats = {"profile": profile, "threads": threads}
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield stats
+    finally:
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+        set_concurrency(previous)
+        stats["seconds"] = round(seconds, 3)
+        stats["cpu_seconds"] = round(cpu_seconds, 3)
+        stats["cpu_utilization"] = round(
+            cpu_seconds / (seconds * threads) if seconds > 0 else 0, 3
+        )
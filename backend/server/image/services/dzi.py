@@ -0,0 +1,205 @@
+"""IIIF3 tile pyramids (dzsave) for EM images, MIMS composites and segmentations."""
+
+import json
+import os
+
+import pyvips
+from django.conf import settings
+
+from .concurrency import vips_profile
+
+TILE_SIZE = getattr(settings, "DZI_TILE_SIZE", 512)
+OVERLAP = getattr(settings, "DZI_OVERLAP", 0)
+SUFFIX = getattr(settings, "DZI_SUFFIX", ".jpg[Q=75]")
+DEPTH = getattr(settings, "DZI_DEPTH", "onetile")
+SIXTEEN_BIT = getattr(settings, "DZI_16BIT", "shift")
+# Written next to the tiles: size and pixel format of the image the pyramid
+# was made from, which update_dzi_region has to be given again
+SOURCE_FILENAME = "source.json"
+
+
+def _is_png(suffix):
+    return suffix.split("[")[0].lower() == ".png"
+
+
+def prepare_dzi_image(img, suffix=SUFFIX, sixteen_bit=SIXTEEN_BIT):
+    """
+    Convert img to the pixel format its tiles are written in.
+
+    8 bit images are unchanged. 16 bit images keep their high byte ("shift",
+    what dzsave does on its own for JPEG tiles), or all 16 bits ("keep"),
+    which is only possible with PNG tiles.
+    """
+    if img.format != "ushort":
+        return img
+    if sixteen_bit == "keep" and _is_png(suffix):
+        return img.copy(interpretation="grey16" if img.bands == 1 else "rgb16")
+    return (img >> 8).cast("uchar")
+
+
+def _source_info(img):
+    return {
+        "width": img.width,
+        "height": img.height,
+        "bands": img.bands,
+        "format": img.format,
+    }
+
+
+def get_dzi_source(dzi_dir):
+    """Size and pixel format of the image a save_dzi pyramid was made from, or None."""
+    try:
+        with open(os.path.join(dzi_dir, SOURCE_FILENAME)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _directory_size(path):
+    total = count = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(root, filename))
+            count += 1
+    return total, count
+
+
+def save_dzi(img, path, id_url, profile=None, **options):
+    """
+    Write img as an IIIF3 tile pyramid to the directory path.
+
+    Tile size, overlap, tile format (suffix with its save options, e.g.
+    ".webp[Q=80]"), depth and 16 bit handling come from the DZI_* settings and
+    can be overridden per call with the keyword arguments tile_size, overlap,
+    suffix, depth and sixteen_bit. Images that fit in one tile are written as
+    a single level.
+
+    profile is the task type ("em", "overlay", ...) whose libvips thread count
+    from VIPS_CONCURRENCY_PROFILES dzsave runs with.
+
+    Returns:
+        dict: {"path", "width", "height", "seconds", "tiles", "bytes",
+        "threads", "cpu_seconds", "cpu_utilization"}
+    """
+    tile_size = options.get("tile_size", TILE_SIZE)
+    suffix = options.get("suffix", SUFFIX)
+    depth = options.get("depth", DEPTH)
+    if img.width <= tile_size and img.height <= tile_size:
+        depth = "one"
+
+    sixteen_bit = options.get("sixteen_bit", SIXTEEN_BIT)
+    with vips_profile(profile) as stats:
+        prepare_dzi_image(img, suffix, sixteen_bit).dzsave(
+            path,
+            id=id_url,
+            layout=pyvips.enums.ForeignDzLayout.IIIF3,
+            tile_size=tile_size,
+            overlap=options.get("overlap", OVERLAP),
+            suffix=suffix,
+            depth=depth,
+        )
+    with open(os.path.join(path, SOURCE_FILENAME), "w") as fh:
+        json.dump(_source_info(img), fh)
+
+    total_bytes, tiles = _directory_size(path)
+    report = {
+        "path": path,
+        "width": img.width,
+        "height": img.height,
+        "seconds": stats["seconds"],
+        "tiles": tiles,
+        "bytes": total_bytes,
+        "threads": stats["threads"],
+        "cpu_seconds": stats["cpu_seconds"],
+        "cpu_utilization": stats["cpu_utilization"],
+    }
+    print(
+        f"DZI {path}: {img.width}x{img.height}, {tiles} files, "
+        f"{total_bytes / 1e6:.1f} MB in {stats['seconds']:.2f}s, "
+        f"{stats['threads']} threads at {stats['cpu_utilization']:.0%} CPU"
+    )
+    return report
+
+
+def _dzi_tiles(dzi_dir):
+    """
+    Every tile of an IIIF3 dzsave pyramid.
+
+    dzsave writes each tile to <region>/<size>/0/default.<suffix>, where the
+    region is "x,y,w,h" in full resolution pixels (or "full") and the size is
+    the "w,h" of the tile at its pyramid level.
+
+    Yields:
+        tuple: (path, (x, y, w, h), (tile_w, tile_h))
+    """
+    for region_entry in os.scandir(dzi_dir):
+        if not region_entry.is_dir():
+            continue
+        region = None
+        if region_entry.name != "full":
+            region = tuple(int(v) for v in region_entry.name.split(","))
+        for size_entry in os.scandir(region_entry.path):
+            size = tuple(int(v) for v in size_entry.name.split(","))
+            tile_dir = os.path.join(size_entry.path, "0")
+            for filename in os.listdir(tile_dir):
+                if filename.startswith("default."):
+                    yield os.path.join(tile_dir, filename), region, size
+
+
+def update_dzi_region(img, dzi_dir, region):
+    """
+    Re-render the tiles of an existing save_dzi pyramid of img inside a region.
+
+    Only tiles whose extent overlaps region are touched, at every pyramid
+    level, and within them only the part covered by region is rendered from
+    img (shrunk to the level) and pasted over the saved tile.
+
+    img has to have the size and pixel format of the image the pyramid was
+    made from: a 16 bit image is written with a different brightness than an
+    8 bit one (see prepare_dzi_image), so updated tiles would no longer match
+    the rest. Otherwise, or for pyramids without a recorded source, nothing is
+    written and the pyramid has to be rebuilt.
+
+    Args:
+        img (pyvips.Image): The full resolution image the pyramid was made from
+        dzi_dir (str): Directory dzsave wrote the IIIF3 pyramid to
+        region (tuple): (x0, y0, x1, y1) in full resolution pixels
+
+    Returns:
+        int: number of tiles written, or None if the pyramid has to be rebuilt
+    """
+    if get_dzi_source(dzi_dir) != _source_info(img):
+        return None
+    rx0, ry0, rx1, ry1 = region
+    updated = 0
+    for path, tile_region, (tile_w, tile_h) in _dzi_tiles(dzi_dir):
+        x, y, w, h = tile_region or (0, 0, img.width, img.height)
+        # Overlap of the region with the tile, aligned to the level's pixels
+        factor = max(1, round(w / tile_w))
+        x0 = max(x, rx0 - (rx0 - x) % factor)
+        y0 = max(y, ry0 - (ry0 - y) % factor)
+        x1 = min(x + w, rx1 + (x - rx1) % factor)
+        y1 = min(y + h, ry1 + (y - ry1) % factor)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        px, py = (x0 - x) // factor, (y0 - y) // factor
+        part_w = min(tile_w - px, -(-(x1 - x0) // factor))
+        part_h = min(tile_h - py, -(-(y1 - y0) // factor))
+        part = img.crop(x0, y0, x1 - x0, y1 - y0)
+        if factor > 1:
+            part = part.shrink(factor, factor)
+        # Partial blocks at the image edge can round the shrunk size down
+        part = part.embed(0, 0, part_w, part_h, extend="copy")
+
+        extension = os.path.splitext(path)[1]
+        # Same save options as the rest of the pyramid when the format matches
+        suffix = SUFFIX if SUFFIX.split("[")[0] == extension else extension
+        with open(path, "rb") as fh:
+            tile = pyvips.Image.new_from_buffer(fh.read(), "")
+        part = prepare_dzi_image(part, suffix)
+        tile = tile.insert(part.cast(tile.format), px, py)
+        data = tile.write_to_buffer(suffix)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        updated += 1
+    return updated
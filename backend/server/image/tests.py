@@ -1,3 +1,160 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pyvips
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from core.models import Canvas
+from image.models import Image
+from image.services.dzi import (
+    SOURCE_FILENAME,
+    _dzi_tiles,
+    save_dzi,
+    update_dzi_region,
+)
+from image.tasks import convert_to_dzi_format, create_pyramid_tiff
+
+
+def _tiff_upload(width=300, height=200, name="em.tif"):
+    array = (np.arange(width * height) % 65536).astype(np.uint16)
+    img = pyvips.Image.new_from_array(array.reshape(height, width))
+    return SimpleUploadedFile(name, img.tiffsave_buffer())
+
+
+def _stack_upload(values, width=300, height=200, name="stack.tif"):
+    """Multi-page TIFF with one constant page per value, like a z-stack."""
+    pages = [
+        pyvips.Image.new_from_array(np.full((height, width), v, dtype=np.uint8))
+        for v in values
+    ]
+    stack = pyvips.Image.arrayjoin(pages, across=1).copy()
+    stack.set_type(pyvips.GValue.gint_type, "page-height", height)
+    return SimpleUploadedFile(name, stack.tiffsave_buffer())
+
+
+class ImageUploadTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.canvas = Canvas.objects.create(name="canvas")
+        chain_patch = mock.patch("image.models.chain")
+        self.chain = chain_patch.start()
+        self.addCleanup(chain_patch.stop)
+
+    def test_dimensions_stored_at_upload(self):
+        image = Image.objects.create(canvas=self.canvas, file=_tiff_upload())
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height, image.dtype), (300, 200, "uint16"))
+
+    def test_pyramid_scheduled_at_upload(self):
+        image = Image.objects.create(canvas=self.canvas, file=_tiff_upload())
+        self.chain.assert_called_once_with(
+            create_pyramid_tiff.si(image.id), convert_to_dzi_format.si(image.id)
+        )
+        self.chain.return_value.delay.assert_called_once_with()
+
+    def test_pyramid_not_rescheduled_on_update(self):
+        image = Image.objects.create(canvas=self.canvas, file=_tiff_upload())
+        image.friendly_name = "renamed"
+        image.save()
+        self.chain.assert_called_once()
+
+    def test_read_uses_pyramid_levels(self):
+        image = Image.objects.create(canvas=self.canvas, file=_tiff_upload(512, 256))
+        pyramid_path = os.path.join(self.media_root, "pyramid.tif")
+        pyvips.Image.new_from_file(image.file.path).tiffsave(
+            pyramid_path, tile=True, pyramid=True
+        )
+        image.pyramid_file.name = "pyramid.tif"
+        _, level_scale = image._open(0.25)
+        self.assertEqual(level_scale, 0.25)
+        self.assertEqual(image.read(0.25).shape, (64, 128))
+
+    def test_pages_of_an_upload_are_not_levels(self):
+        image = Image.objects.create(canvas=self.canvas, file=_stack_upload([10, 200]))
+        _, level_scale = image._open(0.5)
+        self.assertEqual(level_scale, 1.0)
+        region = image.read(0.5)
+        self.assertEqual(region.shape, (100, 150))
+        self.assertTrue((region == 10).all())
+
+
+class UpdateDziRegionTests(SimpleTestCase):
+    region = (301, 203, 733, 517)
+
+    def setUp(self):
+        self.dzi_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dzi_root)
+        rng = np.random.default_rng(0)
+        before = rng.integers(0, 256, (700, 1100)).astype(np.uint8)
+        after = before.copy()
+        x0, y0, x1, y1 = self.region
+        after[y0:y1, x0:x1] = rng.integers(0, 256, (y1 - y0, x1 - x0))
+        self.before = pyvips.Image.new_from_array(before)
+        self.after = pyvips.Image.new_from_array(after)
+
+    def save(self, img, name):
+        path = os.path.join(self.dzi_root, name)
+        # Lossless tiles, so updated and rebuilt tiles can be compared
+        save_dzi(img, path, "http://testserver", tile_size=256, suffix=".png")
+        return path
+
+    def tiles(self, path):
+        return {
+            os.path.relpath(tile_path, path): (
+                tile_region,
+                pyvips.Image.new_from_file(tile_path).numpy().astype(int),
+            )
+            for tile_path, tile_region, _ in _dzi_tiles(path)
+        }
+
+    def test_matches_a_full_rebuild(self):
+        updated = self.save(self.before, "updated")
+        self.assertIsNotNone(update_dzi_region(self.after, updated, self.region))
+        rebuilt = self.tiles(self.save(self.after, "rebuilt"))
+        tiles = self.tiles(updated)
+        self.assertEqual(tiles.keys(), rebuilt.keys())
+        for name, (tile_region, tile) in tiles.items():
+            with self.subTest(tile=name):
+                expected = rebuilt[name][1]
+                self.assertEqual(tile.shape, expected.shape)
+                if tile_region is not None and tile_region[2] == tile.shape[1]:
+                    # Full resolution tiles are cropped from the same pixels
+                    np.testing.assert_array_equal(tile, expected)
+                else:
+                    # dzsave halves level by level, the update shrinks at once
+                    self.assertLessEqual(np.abs(tile - expected).max(), 1)
+
+    def test_only_tiles_in_the_region_are_written(self):
+        updated = self.save(self.before, "updated")
+        untouched = self.tiles(updated)
+        written = update_dzi_region(self.after, updated, self.region)
+        changed = [
+            name
+            for name, (_, tile) in self.tiles(updated).items()
+            if not np.array_equal(tile, untouched[name][1])
+        ]
+        self.assertEqual(written, len(changed))
+        x0, y0, x1, y1 = self.region
+        for name in changed:
+            tile_region = untouched[name][0]
+            if tile_region is not None:
+                x, y, w, h = tile_region
+                self.assertTrue(x < x1 and x + w > x0 and y < y1 and y + h > y0)
+
+    def test_other_source_needs_a_rebuild(self):
+        updated = self.save(self.before, "updated")
+        wider = self.after.embed(0, 0, 1200, 700)
+        sixteen_bit = self.after.cast("ushort")
+        for img in [wider, sixteen_bit]:
+            with self.subTest(size=(img.width, img.height), format=img.format):
+                self.assertIsNone(update_dzi_region(img, updated, self.region))
+        os.remove(os.path.join(updated, SOURCE_FILENAME))
+        self.assertIsNone(update_dzi_region(self.after, updated, self.region))
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mims", "0018_remove_mimsimageset_mask"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mimsimage",
+            name="stack_transforms",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
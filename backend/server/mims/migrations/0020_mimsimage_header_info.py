@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-17 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mims", "0019_mimsimage_stack_transforms"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mimsimage",
+            name="header_info",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -1,6 +1,5 @@
 import numpy as np
 import os
-import sims
 from PIL import Image
 import pprint
 from pathlib import Path
@@ -42,12 +41,11 @@ def load_images_and_bboxes(
     mims_pixel_size = None
 
     for mims in mims_images:
-        im = sims.SIMS(mims.file.path)
+        header_info = mims.get_header_info()
         if not mims_pixel_size:
-            mims_meta = im.header["Image"]
-            mims_pixel_size = mims_meta["raster"] / mims_meta["width"]
+            mims_pixel_size = mims.pixel_size_nm
 
-        x, y = im.header["sample x"], im.header["sample y"]
+        x, y = header_info["sample_x"], header_info["sample_y"]
         x, y = y, x
         # Initial tl_corners are in sample coordinates (microns)
         tl_corners.append((x, y))
@@ -102,8 +100,7 @@ def load_images_and_bboxes(
 def get_concatenated_image(mims_image_set, species, flip=False):
     images, bboxes = load_images_and_bboxes(mims_image_set, species, flip)
     positions = [bbox[0] for bbox in bboxes]
-    mims_meta = sims.SIMS(mims_image_set.mims_images.first().file.path).header["Image"]
-    mims_pixel_size = mims_meta["raster"] / mims_meta["width"]
+    mims_pixel_size = mims_image_set.mims_images.first().pixel_size_nm
 
     if not images:
         print("No images found for the given species.")
@@ -103,6 +103,12 @@ class MIMSImage(CanvasObj):
     isotopes = models.ManyToManyField(Isotope)
 
     registration_info = models.JSONField(null=True, blank=True)
+    # Plane drift estimated once on a reference species and reused for all
+    # species: {"reference": "SE", "mode": 6, "tmats": [[[...]]]}
+    stack_transforms = models.JSONField(null=True, blank=True)
+    # Header fields read once at upload:
+    # raster, width, height, planes, sample_x, sample_y, date
+    header_info = models.JSONField(null=True, blank=True)
 
     def __str__(self):
         filename = self.name if self.name else self.file.name.split("/")[-1]
@@ -115,9 +121,34 @@ class MIMSImage(CanvasObj):
     def delete(self, *args, **kwargs):
         # Delete the media directory with the image files
         if self.file:
+            from mims.services.species_cache import clear_species_cache
+
+            clear_species_cache(self.file.path)
             os.remove(self.file.path)
         super().delete(*args, **kwargs)
 
+    def get_stack_tmats(self, mode=None):
+        """
+        The stored shared drift matrices as an array, or None if none were
+        estimated (or they were estimated with another StackReg mode).
+        """
+        transforms = self.stack_transforms
+        if not transforms or (mode is not None and transforms["mode"] != mode):
+            return None
+        return np.asarray(transforms["tmats"])
+
+    def get_header_info(self):
+        """
+        Returns the cached .im header fields, parsing the file header only the
+        first time for images uploaded before they were stored.
+        """
+        if not self.header_info:
+            from mims.services.im_reader import extract_header_info, read_im_header
+
+            self.header_info = extract_header_info(read_im_header(self.file.path))
+            self.save(update_fields=["header_info"])
+        return self.header_info
+
     def get_affine_matrix(self):
         """
         Returns the cached 3 × 3 affine as a NumPy array, or None
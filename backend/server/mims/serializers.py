@@ -2,6 +2,7 @@
 
 from rest_framework import serializers
 from django.conf import settings
+from django.urls import reverse
 import os
 from image.models import Image
 from mims.models import (
@@ -46,10 +47,11 @@ class IsotopeImageSerializer(serializers.ModelSerializer):
 class MIMSOverlaySerializer(serializers.ModelSerializer):
     isotope = serializers.SerializerMethodField()
     dzi_url = serializers.SerializerMethodField()
+    png_url = serializers.SerializerMethodField()
 
     class Meta:
         model = MIMSOverlay
-        fields = ["id", "isotope", "dzi_url"]
+        fields = ["id", "isotope", "dzi_url", "png_url"]
 
     def get_isotope(self, obj):
         return obj.isotope.name
@@ -59,6 +61,14 @@ class MIMSOverlaySerializer(serializers.ModelSerializer):
             return os.path.join(settings.MEDIA_URL, obj.mosaic)
         return None
 
+    def get_png_url(self, obj):
+        if getattr(settings, "MIMS_OVERLAY_STORAGE", "dzi+png") == "dzi":
+            return None
+        return reverse(
+            "mims:mimsimageset-overlay-png",
+            kwargs={"pk": obj.image_set_id, "isotope": obj.isotope.name},
+        )
+
 
 class MIMSImageSetSerializer(serializers.ModelSerializer):
     mims_overlays = serializers.SerializerMethodField()
@@ -1,7 +1,10 @@
+from .im_reader import *
 from .image_utils import *
+from .fft_alignment import *
 from .interface import *
 from .orient_images import *
 from .registration_utils import *
+from .species_cache import *
 from .unwarp import *
 from .register import *
 from .prepare_registration_images import *
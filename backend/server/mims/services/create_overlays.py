@@ -1,15 +1,201 @@
 import os
 import numpy as np
 import pyvips
+from celery import chord
 from django.conf import settings
-from mims.models import MIMSImage, MIMSImageSet, Isotope, MIMSOverlay
+from image.services import get_dzi_source, save_dzi, update_dzi_region
+from mims.models import MIMSImage, MIMSImageSet, Isotope, MIMSOverlay, MimsTiffImage
 from mims.model_utils import get_concatenated_image
+from mims.services.unwarp import RATIO_IMAGES
 
+# What is stored besides each overlay's DZI pyramid: "dzi" (nothing), "dzi+png"
+# (a full-resolution PNG written on its first request) or "dzi+tiff" (a tiled,
+# compressed TIFF master written with the pyramid)
+OVERLAY_STORAGE = getattr(settings, "MIMS_OVERLAY_STORAGE", "dzi+png")
 
-def create_registered_overlays(image_set):
+
+def get_overlay_isotopes(registered_images):
+    """Names of every overlay of the registered images, ratio overlays included."""
+    isotopes_set = set()
+    for img in registered_images:
+        for tiff_image in img.mims_tiff_images.all():
+            isotopes_set.add(tiff_image.name)
+
+    isotopes = list(isotopes_set)
+
+    # Add ratio isotopes if base isotopes exist
+    for ratio_name, (numerator_names, denominator_names) in RATIO_IMAGES.items():
+        has_denominator = any(name in isotopes for name in denominator_names)
+        has_numerator = any(name in isotopes for name in numerator_names)
+        if has_denominator and has_numerator and ratio_name not in isotopes:
+            isotopes.append(ratio_name)
+    return isotopes
+
+
+def get_overlay_dir(image_set):
+    """Overlay directory of an image set, relative to MEDIA_ROOT."""
+    canvas_id = str(image_set.canvas.id)
+    return os.path.join("tmp_images", canvas_id, str(image_set.id), "overlays")
+
+
+def get_overlay_master_path(image_set, isotope, extension):
+    """Absolute path of the full-resolution .png or .tif of an overlay."""
+    return os.path.join(
+        settings.MEDIA_ROOT, get_overlay_dir(image_set), isotope + extension
+    )
+
+
+def remove_overlay_masters(image_set, isotope):
+    """
+    Remove the full-resolution copies of an overlay that no longer match it.
+
+    A PNG is written again on its next request, a TIFF master on the next full
+    render of the overlay (until then the PNG is made from the registered
+    images).
+    """
+    for extension in (".png", ".tif"):
+        path = get_overlay_master_path(image_set, isotope, extension)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def save_overlay_master(img, image_set, isotope):
+    """
+    Store what MIMS_OVERLAY_STORAGE keeps of an overlay besides its pyramid.
+
+    A previously written PNG no longer matches img, so it is removed and, with
+    "dzi+png", written again on its next request.
+    """
+    remove_overlay_masters(image_set, isotope)
+    if OVERLAY_STORAGE == "dzi+tiff":
+        img.tiffsave(
+            get_overlay_master_path(image_set, isotope, ".tif"),
+            tile=True,
+            compression="deflate",
+            predictor="horizontal",
+            bigtiff=True,
+        )
+
+
+def get_overlay_png(image_set, isotope):
+    """
+    Full-resolution PNG of an overlay, written on its first request.
+
+    The PNG is made from the TIFF master if there is one, otherwise from the
+    registered images.
+
+    Returns:
+        str: absolute path of the PNG, or None if the storage policy keeps no
+        full-resolution overlay or the isotope has no data
+    """
+    if OVERLAY_STORAGE == "dzi":
+        return None
+    png_path = get_overlay_master_path(image_set, isotope, ".png")
+    if os.path.exists(png_path):
+        return png_path
+
+    tiff_path = get_overlay_master_path(image_set, isotope, ".tif")
+    if os.path.exists(tiff_path):
+        img = pyvips.Image.new_from_file(tiff_path, access="sequential")
+    else:
+        registered_images = image_set.mims_images.filter(
+            status=MIMSImage.Status.REGISTERED
+        )
+        em_image = image_set.canvas.images.first()
+        if not em_image or not registered_images.exists():
+            return None
+        canvas_width, canvas_height = em_image.get_dimensions()
+        img = create_isotope_composite(
+            registered_images, isotope, canvas_width, canvas_height
+        )
+        if img is None:
+            return None
+
+    # Write next to the final path so a concurrent request never reads half a PNG
+    tmp_path = png_path + f".{os.getpid()}.png"
+    img.pngsave(tmp_path, compression=6)
+    os.replace(tmp_path, png_path)
+    return png_path
+
+
+def create_isotope_overlay(image_set, isotope):
+    """
+    Render the DZI of one isotope of a registered image set, and the master
+    copy MIMS_OVERLAY_STORAGE asks for.
+
+    Isotopes are independent of each other, so this is safe to run for several
+    isotopes of the same set at once.
+
+    Returns:
+        str: DZI path relative to MEDIA_ROOT, or None if nothing was rendered
+    """
+    print(f"Processing isotope: {isotope}")
+    registered_images = image_set.mims_images.filter(status=MIMSImage.Status.REGISTERED)
+    em_image = image_set.canvas.images.first()
+    if not em_image or not registered_images.exists():
+        return None
+    canvas_width, canvas_height = em_image.get_dimensions()
+
+    relative_dir = get_overlay_dir(image_set)
+    output_dir = os.path.join(settings.MEDIA_ROOT, relative_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    try:
+        # Lazy canvas-sized composite, streamed into the master and DZI
+        img = create_isotope_composite(
+            registered_images, isotope, canvas_width, canvas_height
+        )
+
+        if img is None:
+            print(f"No data found for isotope {isotope}")
+            return None
+
+        save_overlay_master(img, image_set, isotope)
+
+        # Create DZI file
+        id_url = os.path.join("http://localhost:8000/media", relative_dir)
+
+        save_dzi(
+            img,
+            os.path.join(output_dir, isotope + ".dzi"),
+            id_url,
+            profile="overlay",
+        )
+    except Exception as e:
+        print(f"Error processing isotope {isotope}: {e}")
+        return None
+
+    return os.path.join(relative_dir, isotope + ".dzi")
+
+
+def save_overlays(image_set, mosaics):
+    """
+    Create or update the MIMSOverlay records of an image set.
+
+    Args:
+        mosaics (dict): isotope name -> DZI path relative to MEDIA_ROOT
+    """
+    for isotope, dzi_relative_path in mosaics.items():
+        isotope_obj, _ = Isotope.objects.get_or_create(name=isotope)
+        MIMSOverlay.objects.update_or_create(
+            image_set=image_set,
+            isotope=isotope_obj,
+            defaults={"mosaic": dzi_relative_path},
+        )
+        print(f"Created overlay for {isotope}: {dzi_relative_path}")
+
+    print(f"Completed creating overlays for image set {image_set.id}")
+
+
+def create_registered_overlays(image_set, fan_out=True):
     """
     Create composite overlay images when an image set transitions to REGISTERED status.
     This stitches together MimsTiffImages from all registered images into canvas-sized composites.
+
+    With fan_out every isotope is rendered by its own Celery subtask, so the
+    overlays of a set are built in parallel across workers, and a chord
+    callback saves the MIMSOverlay records once all of them are done. Without
+    it the isotopes are rendered one after the other in the calling process.
     """
     print(f"Creating registered overlays for image set {image_set.id}")
 
@@ -19,106 +205,111 @@ def create_registered_overlays(image_set):
         print("No registered images found")
         return
 
-    # Get canvas dimensions from the EM image
-    canvas = image_set.canvas
-    em_image = canvas.images.first()
-    if not em_image:
+    if not image_set.canvas.images.exists():
         print("No EM image found for canvas")
         return
 
-    from PIL import Image
+    isotopes = get_overlay_isotopes(registered_images)
 
-    em_img = Image.open(em_image.file.path)
-    canvas_width, canvas_height = em_img.size
+    if not fan_out:
+        mosaics = {
+            isotope: create_isotope_overlay(image_set, isotope) for isotope in isotopes
+        }
+        save_overlays(
+            image_set, {isotope: path for isotope, path in mosaics.items() if path}
+        )
+        return
 
-    # Get all isotopes from registered images
-    isotopes_set = set()
-    for img in registered_images:
-        for tiff_image in img.mims_tiff_images.all():
-            isotopes_set.add(tiff_image.name)
+    # Local import, mims.tasks imports this module
+    from mims.tasks import create_mims_overlay, save_mims_overlays
 
-    isotopes = list(isotopes_set)
+    image_set_id = str(image_set.id)
+    chord(create_mims_overlay.s(image_set_id, isotope) for isotope in isotopes)(
+        save_mims_overlays.s(image_set_id)
+    )
 
-    # Add ratio isotopes if base isotopes exist
-    possible_12c_names = ["12C", "12C2"]
-    possible_13c_names = ["13C", "12C 13C"]
-    possible_15n_names = ["15N 12C", "12C 15N"]
-    possible_14n_names = ["14N 12C", "12C 14N"]
-
-    species_12c = next((name for name in possible_12c_names if name in isotopes), None)
-    species_13c = next((name for name in possible_13c_names if name in isotopes), None)
-    if species_12c and species_13c:
-        isotopes.append("13C12C_ratio")
-
-    species_15n = next((name for name in possible_15n_names if name in isotopes), None)
-    species_14n = next((name for name in possible_14n_names if name in isotopes), None)
-    if species_15n and species_14n:
-        isotopes.append("15N14N_ratio")
-
-    # Create composite overlays for each isotope
-    canvas_id = str(image_set.canvas.id)
-    relative_dir = os.path.join("tmp_images", canvas_id, str(image_set.id), "overlays")
-    output_dir = os.path.join(settings.MEDIA_ROOT, relative_dir)
-    os.makedirs(output_dir, exist_ok=True)
 
-    for isotope in isotopes:
-        print(f"Processing isotope: {isotope}")
+def update_isotope_overlay(image_set, isotope, region):
+    """
+    Update the existing overlay pyramid of one isotope inside a canvas region.
 
-        try:
-            # Create canvas-sized composite image for this isotope
-            composite_img = create_isotope_composite(
-                registered_images, isotope, canvas_width, canvas_height
-            )
+    The full-resolution copies are only removed, since rewriting them would
+    take a pass over the whole canvas (see remove_overlay_masters).
 
-            if composite_img is None:
-                print(f"No data found for isotope {isotope}")
-                continue
+    Returns:
+        str: DZI path relative to MEDIA_ROOT, or None if the isotope has no
+        overlay pyramid to update, or one made from a composite of another
+        pixel format (e.g. the only 16 bit tile was re-registered away)
+    """
+    overlay = MIMSOverlay.objects.filter(
+        image_set=image_set, isotope__name=isotope
+    ).first()
+    if overlay is None:
+        return None
+    dzi_dir = os.path.join(settings.MEDIA_ROOT, overlay.mosaic)
+    source = get_dzi_source(dzi_dir)
+    if source is None:
+        return None
 
-            # Save as compressed PNG
-            comp_path = os.path.join(output_dir, isotope + ".png")
-            Image.fromarray(composite_img).save(comp_path, format='PNG', optimize=True, compress_level=6)
-
-            # Convert to pyvips image
-            img = pyvips.Image.new_from_array(composite_img)
-
-            # Create DZI file
-            id_url = os.path.join("http://localhost:8000/media", relative_dir)
-
-            if img.width <= 512 and img.height <= 512:
-                img.dzsave(
-                    os.path.join(output_dir, isotope + ".dzi"),
-                    id=id_url,
-                    tile_size=512,
-                    depth="one",
-                    layout=pyvips.enums.ForeignDzLayout.IIIF3,
-                )
-            else:
-                img.dzsave(
-                    os.path.join(output_dir, isotope + ".dzi"),
-                    id=id_url,
-                    layout=pyvips.enums.ForeignDzLayout.IIIF3,
-                )
-
-            # Create or update MIMSOverlay record
-            isotope_obj, _ = Isotope.objects.get_or_create(name=isotope)
-            dzi_relative_path = os.path.join(relative_dir, isotope + ".dzi")
-
-            overlay, created = MIMSOverlay.objects.get_or_create(
-                image_set=image_set,
-                isotope=isotope_obj,
-                defaults={"mosaic": dzi_relative_path},
-            )
-            if not created:
-                overlay.mosaic = dzi_relative_path
-                overlay.save()
+    registered_images = image_set.mims_images.filter(status=MIMSImage.Status.REGISTERED)
+    canvas_width, canvas_height = image_set.canvas.images.first().get_dimensions()
+    img = create_isotope_composite(
+        registered_images, isotope, canvas_width, canvas_height
+    )
+    if img is None:
+        img = pyvips.Image.black(canvas_width, canvas_height).cast(source["format"])
+
+    updated = update_dzi_region(img, dzi_dir, region)
+    if updated is None:
+        print(f"The {isotope} overlay changed pixel format, rendering it in full")
+        return None
+    print(f"Updated {updated} tiles of the {isotope} overlay in {region}")
 
-            print(f"Created overlay for {isotope}: {dzi_relative_path}")
+    remove_overlay_masters(image_set, isotope)
+    return overlay.mosaic
 
-        except Exception as e:
-            print(f"Error processing isotope {isotope}: {e}")
-            continue
 
-    print(f"Completed creating overlays for image set {image_set.id}")
+def update_registered_overlays(image_set, updated_bboxes):
+    """
+    Update the overlays of a registered set after one image was re-registered.
+
+    Only the part of the canvas covered by updated_bboxes (the image's previous
+    and new registration bboxes) is re-rendered, so the rest of every overlay
+    pyramid is kept. Isotopes that have no overlay yet are rendered in full.
+    """
+    points = np.concatenate(
+        [np.asarray(bbox, dtype=float).reshape(-1, 2) for bbox in updated_bboxes]
+    )
+    x0, y0 = np.floor(points.min(axis=0)).astype(int)
+    x1, y1 = np.ceil(points.max(axis=0)).astype(int)
+    region = (int(x0), int(y0), int(x1), int(y1))
+    print(f"Updating overlays of image set {image_set.id} in {region}")
+
+    registered_images = image_set.mims_images.filter(status=MIMSImage.Status.REGISTERED)
+    mosaics = {}
+    for isotope in get_overlay_isotopes(registered_images):
+        dzi_relative_path = update_isotope_overlay(image_set, isotope, region)
+        if dzi_relative_path is None:
+            dzi_relative_path = create_isotope_overlay(image_set, isotope)
+        if dzi_relative_path:
+            mosaics[isotope] = dzi_relative_path
+    save_overlays(image_set, mosaics)
+
+
+def _bbox_corners(bbox):
+    """(x0, y0, x1, y1) of a registration bbox, not clamped to the canvas."""
+    # bbox assumed as [ [x0,y0], [x1,y1], [x2,y2], [x3,y3] ]
+    # where [0] is top-left and [2] is bottom-right
+    try:
+        return int(bbox[0][0]), int(bbox[0][1]), int(bbox[2][0]), int(bbox[2][1])
+    except Exception:
+        # Fallback: if bbox is dict or other format, try keys
+        return (
+            int(bbox.get("x0", 0)),
+            int(bbox.get("y0", 0)),
+            int(bbox.get("x1", 0)),
+            int(bbox.get("y1", 0)),
+        )
 
 
 def create_isotope_composite(registered_images, isotope, canvas_width, canvas_height):
@@ -126,135 +317,69 @@ def create_isotope_composite(registered_images, isotope, canvas_width, canvas_he
     Create a canvas-sized composite image for a specific isotope by stitching together
     MimsTiffImages from all registered images using their registration bboxes.
 
+    The composite is a lazy pyvips graph of `insert`s onto a black canvas, so
+    nothing canvas-sized is held in memory; pixels are only computed, a region
+    at a time, when the result is saved (e.g. streamed into dzsave).
+
     Rules:
       - No resizing. Paste-with-crop only.
       - No blending. New pixels overwrite existing ones ("last tile wins").
-      - Cropping respects canvas bbox:
-          * If x0 or y0 is negative, crop that many pixels from LEFT/TOP first.
-          * Then clip any overflow on RIGHT/BOTTOM to the canvas.
-      - Output is single-channel (grayscale), dtype taken from first pasted tile.
+      - Tiles are cropped to their bbox size, and whatever falls outside the
+        canvas on any side is clipped.
+      - Output is single-channel, 16 bit if any tile is, 8 bit otherwise.
+
+    Returns:
+        pyvips.Image or None if no tile of the isotope is on the canvas
     """
-    import numpy as np
-    from PIL import Image
-
-    # ----- Handle ratio composites by delegating -----
-    if isotope == "13C12C_ratio":
-        return create_ratio_composite(
-            registered_images,
-            ["12C", "12C2"],  # denominator candidates
-            ["13C", "12C 13C"],  # numerator candidates
-            canvas_width,
-            canvas_height,
-        )
-    elif isotope == "15N14N_ratio":
-        return create_ratio_composite(
-            registered_images,
-            ["14N 12C", "12C 14N"],  # denominator candidates
-            ["15N 12C", "12C 15N"],  # numerator candidates
-            canvas_width,
-            canvas_height,
+    # ----- Images registered before ratio tiles were stored -----
+    if isotope in RATIO_IMAGES:
+        tiled_images = (
+            MimsTiffImage.objects.filter(mims_image__in=registered_images, name=isotope)
+            .values("mims_image")
+            .distinct()
+            .count()
         )
+        if tiled_images < registered_images.count():
+            numerator_names, denominator_names = RATIO_IMAGES[isotope]
+            return create_ratio_composite(
+                registered_images,
+                denominator_names,
+                numerator_names,
+                canvas_width,
+                canvas_height,
+            )
 
-    # Collect tiles for this isotope
-    tiff_images = []
-    for mims_image in registered_images:
+    tiles = []
+    for mims_image in registered_images.order_by("image_set_priority"):
         for tiff_image in mims_image.mims_tiff_images.filter(name=isotope):
-            tiff_images.append((mims_image.id, tiff_image.id, tiff_image))
+            if not tiff_image.registration_bbox:
+                continue
+            x0, y0, x1, y1 = _bbox_corners(tiff_image.registration_bbox)
+            if x1 <= max(0, x0) or y1 <= max(0, y0):
+                continue
+            if x0 >= canvas_width or y0 >= canvas_height:
+                # Entire bbox is outside canvas
+                continue
+            try:
+                tile = pyvips.Image.new_from_file(tiff_image.image.path)
+            except Exception as e:
+                print(f"Error loading tiff image {tiff_image.id}: {e}")
+                continue
+            if tile.bands > 1:
+                tile = tile.extract_band(0)
+            tile = tile.crop(0, 0, min(tile.width, x1 - x0), min(tile.height, y1 - y0))
+            tiles.append((tile, x0, y0))
 
-    if not mims_image.mims_tiff_images.filter(name=isotope):
+    if not tiles:
         return None
 
-    composite = None  # will be allocated on first successful paste
-
-    pasted_any = False
-    out_dtype = None
-
-    for tiff_image in mims_image.mims_tiff_images.filter(name=isotope).order_by("name"):
-        bbox = tiff_image.registration_bbox
-        if not bbox:
-            continue
-
-        try:
-            img = Image.open(tiff_image.image.path)
-            src = np.array(img)
-        except Exception as e:
-            print(f"Error loading tiff image {tiff_image.id}: {e}")
-            continue
-
-        # Convert to grayscale plane (float32 if luma computed; otherwise original dtype)
-        gray = src
-        # Establish output buffer/dtype on first tile
-        if composite is None:
-            if np.issubdtype(gray.dtype, np.floating) or np.max(gray) > 255:
-                out_dtype = np.uint16 if src.dtype == np.uint16 else np.uint8
-            else:
-                out_dtype = gray.dtype
-            composite = np.zeros((canvas_height, canvas_width), dtype=out_dtype)
-
-        # If gray is float (from luma), rescale to out_dtype range before paste
-        if np.issubdtype(gray.dtype, np.floating):
-            # Map 0..255 or 0..65535 depending on src depth heuristics
-            # If original src was uint16, assume 0..65535 target, else 0..255
-            if out_dtype == np.uint16:
-                gray = np.clip(gray, 0, 65535).astype(np.uint16)
-            else:
-                gray = np.clip(gray, 0, 255).astype(np.uint8)
-
-        Hs, Ws = gray.shape[:2]
-
-        # ----- Raw bbox from registration (do NOT clamp yet) -----
-        # bbox assumed as [ [x0,y0], [x1,y1], [x2,y2], [x3,y3] ]
-        # where [0] is top-left and [2] is bottom-right
-        try:
-            x0_raw, y0_raw = int(bbox[0][0]), int(bbox[0][1])
-            x1_raw, y1_raw = int(bbox[2][0]), int(bbox[2][1])
-        except Exception:
-            # Fallback: if bbox is dict or other format, try keys
-            x0_raw = int(bbox.get("x0", 0))
-            y0_raw = int(bbox.get("y0", 0))
-            x1_raw = int(bbox.get("x1", 0))
-            y1_raw = int(bbox.get("y1", 0))
-
-        # Destination rect on canvas (clamped to canvas)
-        dest_x0 = max(0, x0_raw)
-        dest_y0 = max(0, y0_raw)
-        dest_x1 = min(canvas_width, x1_raw)
-        dest_y1 = min(canvas_height, y1_raw)
-
-        if dest_x1 <= dest_x0 or dest_y1 <= dest_y0:
-            # Entire bbox is outside canvas
-            continue
-
-        # Width/height of clamped destination rect
-        dst_w = dest_x1 - dest_x0
-        dst_h = dest_y1 - dest_y0
-
-        # ----- Source crop offsets (crop LEFT/TOP first for negative corners) -----
-        # If x0_raw < 0, we need to skip -x0_raw columns from source's LEFT edge.
-        src_x0 = max(0, -x0_raw)
-        src_y0 = max(0, -y0_raw)
-
-        # Start with intended copy size equal to dest rect
-        copy_w = dst_w
-        copy_h = dst_h
-
-        # But ensure we don't read past the source
-        if src_x0 + copy_w > Ws:
-            copy_w = Ws - src_x0
-        if src_y0 + copy_h > Hs:
-            copy_h = Hs - src_y0
-
-        if copy_w <= 0 or copy_h <= 0:
-            continue
-
-        # Final paste (overwrite — no blending)
-        composite[dest_y0 : dest_y0 + copy_h, dest_x0 : dest_x0 + copy_w] = gray[
-            src_y0 : src_y0 + copy_h, src_x0 : src_x0 + copy_w
-        ]
-
-        pasted_any = True
-
-    return composite if pasted_any else None
+    is_16bit = any(tile.format in ("ushort", "float", "double") for tile, _, _ in tiles)
+    out_format = "ushort" if is_16bit else "uchar"
+    composite = pyvips.Image.black(canvas_width, canvas_height).cast(out_format)
+    for tile, x0, y0 in tiles:
+        # insert clips the parts of the tile that fall outside the canvas
+        composite = composite.insert(tile.cast(out_format), x0, y0)
+    return composite
 
 
 def create_ratio_composite(
@@ -262,15 +387,19 @@ def create_ratio_composite(
 ):
     """
     Create a ratio composite (e.g., 13C/12C) by dividing two isotope composites.
+
+    Only used for images registered before register_images stored per-tile
+    ratio images.
+
+    Both composites and the division stay lazy pyvips operations.
     """
     # Get the denominator composite
-    denom_isotope = None
+    denom_composite = None
     for name in denominator_names:
         denom_composite = create_isotope_composite(
             registered_images, name, canvas_width, canvas_height
         )
         if denom_composite is not None:
-            denom_isotope = name
             break
 
     if denom_composite is None:
@@ -288,20 +417,15 @@ def create_ratio_composite(
     if numer_composite is None:
         return None
 
-    # Calculate ratio, avoiding division by zero
-    denom_composite = denom_composite.astype(np.float32)
-    numer_composite = numer_composite.astype(np.float32)
-
     # Set zeros to 1 to avoid division by zero
-    denom_composite[denom_composite == 0] = 1
+    denom_composite = (denom_composite == 0).ifthenelse(1, denom_composite)
 
     # Calculate ratio and scale by 10000 (same as preprocessing)
-    ratio = (numer_composite / denom_composite * 10000).astype(np.uint16)
-
-    return ratio
+    ratio = numer_composite.cast("float") / denom_composite * 10000
+    return ratio.cast("ushort")
 
 
-def update_mims_image_set_status(image_set_id):
+def update_mims_image_set_status(image_set_id, updated_bboxes=None):
     """
     Update MIMSImageSet status based on the completion status of all MIMSImage objects in the set.
 
@@ -310,6 +434,8 @@ def update_mims_image_set_status(image_set_id):
     - REGISTERED: If all images are REGISTERED, INVALID_FILE, or OUTSIDE_CANVAS
 
     When transitioning to REGISTERED, creates composite overlays in tmp_images location.
+    When the set already was REGISTERED (an image was re-registered), only the
+    overlay tiles inside updated_bboxes are re-rendered.
     """
     image_set = MIMSImageSet.objects.get(id=image_set_id)
     mims_images = image_set.mims_images.all()
@@ -352,5 +478,7 @@ def update_mims_image_set_status(image_set_id):
             and new_status == MIMSImageSet.Status.REGISTERED
         ):
             create_registered_overlays(image_set)
+    elif new_status == MIMSImageSet.Status.REGISTERED and updated_bboxes:
+        update_registered_overlays(image_set, updated_bboxes)
 
     return new_status
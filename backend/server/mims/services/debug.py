@@ -1,5 +1,4 @@
 import matplotlib.pyplot as plt
-from PIL import Image
 import numpy as np
 import os
 from pathlib import Path
@@ -14,11 +13,9 @@ def _save_debug_overlay(mims_img, geom, patch, iso_name):
     The overlay is magenta with 40% opacity. This provides a clear visual
     check of the alignment for each patch before it's placed in the mosaic.
     """
-    # --- 1. Load and crop the full-resolution EM image ---
-    em_path = mims_img.image_set.canvas.images.first().file.path
-    em_full = np.array(Image.open(em_path))
+    # --- 1. Read the full-resolution EM crop ---
     x0, y0, x1, y1 = geom["bbox"]
-    em_crop = em_full[y0:y1, x0:x1]
+    em_crop = mims_img.image_set.canvas.images.first().crop(x0, y0, x1, y1)
 
     # --- 2. Prepare the magenta overlay from the patch ---
     # Resize patch to match the EM crop dimensions for overlay
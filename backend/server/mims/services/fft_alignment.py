@@ -0,0 +1,251 @@
+from datetime import datetime
+
+import cv2
+import numpy as np
+import pyvips
+from django.conf import settings
+
+from .image_utils import manipulate_image, update_top_locations
+
+# Same acceptance rules as do_sliding_search, in full-resolution pixels
+MIN_VALID_PIXELS = 100000
+MIN_UNION_PIXELS = 2000
+MAX_VALID_INTERSECTION = 0.8
+# Candidates closer than this (in full-resolution pixels) are the same location
+PEAK_RADIUS = 40
+# Shrink factors of the coarse-to-fine search, coarsest first
+PYRAMID_LEVELS = getattr(settings, "MIMS_ALIGNMENT_PYRAMID_LEVELS", [4, 2, 1])
+
+
+def _correlate(image, template):
+    """Sum of image * template for every placement of template inside image."""
+    return np.rint(cv2.matchTemplate(image, template, cv2.TM_CCORR))
+
+
+def score_translations(
+    im1,
+    im2,
+    valid_im1,
+    valid_im2,
+    min_valid=MIN_VALID_PIXELS,
+    min_union=MIN_UNION_PIXELS,
+):
+    """
+    IoU of im2 placed at every (x, y) inside im1, computed with cross-correlation.
+
+    Scores match do_sliding_search: the intersection counts every overlapping
+    foreground pixel, the union only counts pixels valid in both images, and
+    placements with too few valid pixels, too small a union or an implausibly
+    high overlap are rejected with a score of -1.
+
+    Returns:
+        numpy.ndarray: (H1 - H2 + 1, W1 - W2 + 1) float32 map indexed [y, x]
+    """
+    s = (im1 > 0).astype(np.float32)
+    t = (im2 > 0).astype(np.float32)
+    v1 = valid_im1.astype(np.float32)
+    v2 = valid_im2.astype(np.float32)
+
+    intersection = _correlate(s, t)
+    valid = _correlate(v1, v2)
+    # |V1 & V2 & (S | T)| = |V1 S V2| + |V1 V2 T| - |V1 S V2 T|
+    union = (
+        _correlate(v1 * s, v2) + _correlate(v1, v2 * t) - _correlate(v1 * s, v2 * t)
+    )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = np.where(union > 0, intersection / union, 0)
+    rejected = (
+        (valid < min_valid)
+        | (union < min_union)
+        | (intersection > MAX_VALID_INTERSECTION * valid)
+    )
+    iou[rejected] = -1
+    return iou.astype(np.float32)
+
+
+def _top_peaks(scores, count, radius):
+    """Best `count` positions of a score map, at least `radius` apart."""
+    scores = scores.copy()
+    peaks = []
+    for _ in range(count):
+        y, x = np.unravel_index(np.argmax(scores), scores.shape)
+        if scores[y, x] <= 0:
+            break
+        peaks.append((int(x), int(y), float(scores[y, x])))
+        scores[
+            max(0, y - radius) : y + radius + 1, max(0, x - radius) : x + radius + 1
+        ] = -1
+    return peaks
+
+
+def _shrink(mask, factor):
+    """Block-average a boolean mask with pyvips and re-binarize it."""
+    if factor == 1:
+        return mask
+    image = pyvips.Image.new_from_array(np.where(mask, 255, 0).astype(np.uint8))
+    return image.shrink(factor, factor).numpy() > 127
+
+
+def _orientations(angle, flip_hor):
+    if angle is not None and flip_hor is not None:
+        return [(angle, flip_hor)]
+    return [
+        (test_angle, test_flip_hor)
+        for test_angle in range(0, 360, 15)
+        for test_flip_hor in [True, False]
+    ]
+
+
+def _refine(im1, valid_im1, im2, valid_im2, x, y, margin, min_valid, min_union):
+    """Best placement of im2 within +/- margin pixels of (x, y)."""
+    h, w = im2.shape
+    y0, x0 = max(0, y - margin), max(0, x - margin)
+    y1 = min(im1.shape[0] - h, y + margin)
+    x1 = min(im1.shape[1] - w, x + margin)
+    if y1 < y0 or x1 < x0:
+        return None
+    scores = score_translations(
+        im1[y0 : y1 + h, x0 : x1 + w],
+        im2,
+        valid_im1[y0 : y1 + h, x0 : x1 + w],
+        valid_im2,
+        min_valid=min_valid,
+        min_union=min_union,
+    )
+    dy, dx = np.unravel_index(np.argmax(scores), scores.shape)
+    if scores[dy, dx] <= 0:
+        return None
+    return x0 + int(dx), y0 + int(dy), float(scores[dy, dx])
+
+
+def fft_threshold_match(
+    im1_full,
+    im2_full,
+    THRESHOLD_8BIT_BUFFER=10,
+    angle=None,
+    flip_hor=None,
+    levels=None,
+    peaks_per_orientation=3,
+    window=None,
+):
+    """
+    Drop-in replacement for threshold_match using a coarse-to-fine pyramid.
+
+    The binarized masks are shrunk with pyvips to every pyramid level. At the
+    coarsest level each (angle, flip) is rotated there (not at full resolution)
+    and all translations are scored at once with FFT-based correlation. The best
+    peaks of every orientation are pooled and the overall top candidates are
+    re-scored at each finer level, only in a window of a few pixels around
+    their position from the level above.
+
+    Args:
+        levels (list): Shrink factors, coarsest first. Defaults to
+            MIMS_ALIGNMENT_PYRAMID_LEVELS; full resolution (1) is always last.
+        peaks_per_orientation (int): Coarse candidates kept per orientation
+        window (tuple): (x0, y0, x1, y1) region of im1 to search in. The
+            thresholds are still taken from the whole of im1.
+
+    Returns:
+        list: up to 3 (x, y, iou, angle, flip_hor) tuples, best first
+    """
+    levels = sorted(set(levels or PYRAMID_LEVELS) | {1}, reverse=True)
+    valid_im1 = im1_full > 0
+    im1_threshold = np.percentile(im1_full, 90) - THRESHOLD_8BIT_BUFFER
+    im1 = im1_full > im1_threshold
+    im2_threshold = np.percentile(im2_full, 90) - THRESHOLD_8BIT_BUFFER
+    im2 = im2_full > im2_threshold
+    # The valid area of im2 is its whole frame, rotated along with it
+    frame_im2 = im2_full > 0
+    x_origin = y_origin = 0
+    if window is not None:
+        x_origin, y_origin, x_end, y_end = window
+        im1 = im1[y_origin:y_end, x_origin:x_end]
+        valid_im1 = valid_im1[y_origin:y_end, x_origin:x_end]
+
+    im1_levels = {f: (_shrink(im1, f), _shrink(valid_im1, f)) for f in levels}
+    im2_levels = {f: (_shrink(im2, f), _shrink(frame_im2, f)) for f in levels}
+    manipulated = {}
+
+    def get_manipulated(factor, test_angle, test_flip_hor):
+        key = (factor, test_angle, test_flip_hor)
+        if key not in manipulated:
+            manipulated[key] = tuple(
+                manipulate_image(
+                    np.where(mask, 255, 0).astype(np.uint8), test_angle, test_flip_hor
+                )
+                > 0
+                for mask in im2_levels[factor]
+            )
+        return manipulated[key]
+
+    factor = levels[0]
+    area = factor**2
+    im1_coarse, valid_im1_coarse = im1_levels[factor]
+    candidates = []
+    for test_angle, test_flip_hor in _orientations(angle, flip_hor):
+        if test_flip_hor and test_angle in [0, 90, 180, 270]:
+            print(datetime.now(), "starting angle", test_angle, candidates[:3])
+        im2_coarse, valid_im2_coarse = get_manipulated(
+            factor, test_angle, test_flip_hor
+        )
+        if (
+            im2_coarse.shape[0] > im1_coarse.shape[0]
+            or im2_coarse.shape[1] > im1_coarse.shape[1]
+        ):
+            continue
+        scores = score_translations(
+            im1_coarse,
+            im2_coarse,
+            valid_im1_coarse,
+            valid_im2_coarse,
+            min_valid=MIN_VALID_PIXELS / area,
+            min_union=MIN_UNION_PIXELS / area,
+        )
+        for x, y, iou in _top_peaks(
+            scores, peaks_per_orientation, max(1, PEAK_RADIUS // factor)
+        ):
+            candidates.append((x * factor, y * factor, iou, test_angle, test_flip_hor))
+
+    keep = 3 * peaks_per_orientation
+    for previous_factor, factor in zip(levels, levels[1:]):
+        candidates = sorted(candidates, key=lambda c: c[2], reverse=True)[:keep]
+        area = factor**2
+        im1_level, valid_im1_level = im1_levels[factor]
+        # A position found at the previous level is only known to about one
+        # of its pixels, so search two of them around it at this level
+        margin = 2 * previous_factor // factor
+        refined = []
+        for x, y, _, test_angle, test_flip_hor in candidates:
+            im2_level, valid_im2_level = get_manipulated(
+                factor, test_angle, test_flip_hor
+            )
+            best = _refine(
+                im1_level,
+                valid_im1_level,
+                im2_level,
+                valid_im2_level,
+                x // factor,
+                y // factor,
+                margin,
+                MIN_VALID_PIXELS / area,
+                MIN_UNION_PIXELS / area,
+            )
+            if best is not None:
+                x, y, iou = best
+                refined.append((x * factor, y * factor, iou, test_angle, test_flip_hor))
+        candidates = refined
+
+    best_overall_locations = []
+    for x, y, iou, test_angle, test_flip_hor in sorted(
+        candidates, key=lambda c: c[2], reverse=True
+    ):
+        best_overall_locations = update_top_locations(
+            best_overall_locations,
+            x + x_origin,
+            y + y_origin,
+            iou,
+            test_angle,
+            test_flip_hor,
+        )
+    return best_overall_locations
@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import sims
+
+
+class _HeaderOnlySIMS(sims.SIMS):
+    """sims.SIMS that stops after the header instead of decoding the image cube."""
+
+    def read_data(self, *args, **kwargs):
+        self.data = None
+
+
+def read_im_header(im_file):
+    """
+    Parse only the header of an .im file.
+
+    Header queries (raster, width, sample x/y, date, ...) then cost a few KB of
+    I/O instead of materializing every plane of every species.
+    """
+    try:
+        return _HeaderOnlySIMS(str(im_file)).header
+    except Exception:
+        # Some versions of sims finish parsing the header while reading the data
+        return sims.SIMS(str(im_file)).header
+
+
+def extract_header_info(header):
+    """The header fields the pipeline needs, in a JSON-serializable dict."""
+    image = header["Image"]
+    # sims leaves the date as None when the file has none (or "N/A")
+    date = header.get("date")
+    return {
+        "raster": image["raster"],
+        "width": image["width"],
+        "height": image["height"],
+        "planes": image["planes"],
+        "sample_x": header["sample x"],
+        "sample_y": header["sample y"],
+        "date": date.isoformat() if date else None,
+    }
+
+
+class ImFile:
+    """
+    Header plus memory-mapped species planes of a Cameca .im image file.
+
+    Image data follows the header as a (planes, masses, height, width) cube, so
+    the planes of one species are a strided numpy.memmap view over the file and
+    only the pages that are actually read get loaded. Files whose layout does
+    not match the header fall back to the full sims.SIMS reader.
+    """
+
+    def __init__(self, im_file):
+        self.path = str(im_file)
+        self.header = read_im_header(self.path)
+        self.species = [str(s) for s in self.header.get("label list", ())]
+        self._planes = None
+        self._sims = None
+
+        image = self.header.get("Image", {})
+        try:
+            dtype = np.dtype(f"{self.header['byte order']}u{image['bytes per pixel']}")
+            shape = (image["planes"], image["masses"], image["height"], image["width"])
+            offset = self.header["header size"]
+        except (KeyError, TypeError):
+            dtype = None
+        if (
+            dtype is not None
+            and len(self.species) == shape[1]
+            and os.path.getsize(self.path)
+            >= offset + int(np.prod(shape)) * dtype.itemsize
+        ):
+            self._planes = np.memmap(
+                self.path, dtype=dtype, mode="r", offset=offset, shape=shape
+            )
+        else:
+            self._sims = sims.SIMS(self.path)
+            if self._sims.data is None or self._sims.data.species is None:
+                raise ValueError("Invalid .im file")
+            self.header = self._sims.header
+            self.species = [str(s) for s in self._sims.data.species.values]
+
+        if not self.species:
+            raise ValueError("Invalid .im file")
+
+    @property
+    def pixel_size_nm(self):
+        image = self.header["Image"]
+        return image["raster"] / image["width"]
+
+    def species_stack(self, species):
+        """Planes of one species, shape (planes, height, width)."""
+        if species not in self.species:
+            raise KeyError(f"Species {species} not in {self.path}")
+        if self._planes is not None:
+            return self._planes[:, self.species.index(species)]
+        return self._sims.data.loc[species].to_numpy()
@@ -7,6 +7,7 @@ from pystackreg.util import to_uint16
 import sims
 from scipy import ndimage
 from PIL import Image
+from mims.services.species_cache import get_species_names, load_species_summed
 
 possible_12c_names = ["12C", "12C2"]
 possible_13c_names = ["13C", "12C 13C"]
@@ -112,40 +113,35 @@ def non_zero_percentile(arr, percentile):
     return percentile_value
 
 
+def _edge_runs(mask, axis):
+    """
+    Cells reached by walking in from both edges of `mask` along `axis` while the
+    mask stays True. Like the original scan, the walk from the leading edge never
+    visits the last cell and the walk from the trailing edge never visits the
+    first one.
+    """
+    mask = np.moveaxis(mask, axis, 0)
+    runs = np.zeros_like(mask)
+    runs[:-1] = np.logical_and.accumulate(mask[:-1], axis=0)
+    runs[1:] |= np.logical_and.accumulate(mask[:0:-1], axis=0)[::-1]
+    return np.moveaxis(runs, 0, axis)
+
+
 def correct_inner_zeros(original_array):
     array = original_array.astype(np.uint8)
     # Correct the inner zeros to 1s
     # First set all 0s to 1s, then outer 1s to 0s
     # 1. Set all 0s to 1s
     array = np.where(array == 0, 1, array)
-    # 2. Set outer 1s to 0s
-    for y in range(0, array.shape[0] - 1):
-        # left side
-        for x in range(0, array.shape[1] - 1):
-            value = array[y][x]
-            if value not in [1]:
-                break
-            array[y][x] = 0
-        # right side
-        for x in range(array.shape[1] - 1, 0, -1):
-            value = array[y][x]
-            if value not in [1]:
-                break
-            array[y][x] = 0
-
-    for x in range(0, array.shape[1] - 1):
-        # top side
-        for y in range(0, array.shape[0] - 1):
-            value = array[y][x]
-            if value not in [1]:
-                break
-            array[y][x] = 0
-        # bottom side
-        for y in range(array.shape[0] - 1, 0, -1):
-            value = array[y][x]
-            if value not in [1]:
-                break
-            array[y][x] = 0
+    background = array == 1
+    # 2. Set outer 1s to 0s, scanning rows from the left and right (every row
+    #    but the last), then columns from the top and bottom (every column but
+    #    the last). Column scans stop at pixels already cleared by the row scans.
+    outer = np.zeros_like(background)
+    outer[:-1] = _edge_runs(background[:-1], axis=1)
+    remaining = background & ~outer
+    outer[:, :-1] |= _edge_runs(remaining[:, :-1], axis=0)
+    array[outer] = 0
     return array
 
 
@@ -215,63 +211,57 @@ def find_transformation(image1_path, image2_path, points1, points2):
     return translation, rotation, flip
 
 
-def image_from_im_file(im_file, species, autocontrast=False, binarize=False):
+def image_from_im_file(
+    im_file, species, autocontrast=False, binarize=False, tmats=None
+):
     """
-    Extract image data for a specific species from an .im file
+    Extract image data for a specific species from an .im file.
+    Registered species planes are served from the species cache.
 
     Args:
         im_file (str): Path to the .im file
         species (str): Name of the species/isotope to extract
         autocontrast (bool): Whether to apply autocontrast scaling
+        tmats (array-like): Shared drift matrices of the file, e.g.
+            MIMSImage.get_stack_tmats(), so a cache miss does not estimate
+            them again
 
     Returns:
         numpy.ndarray: Image data as a numpy array
     """
-    mims = sims.SIMS(im_file)
-    if not mims or mims.data is None or mims.data.species is None:
-        raise ValueError("Invalid .im file")
-
-    def get_species_summed(mims, species):
-        # Extract and register the isotope image
-        sr = StackReg(StackReg.AFFINE)
-        sr.register_stack(mims.data.loc[species].to_numpy(), reference="previous")
-        stacked = sr.transform_stack(mims.data.loc[species].to_numpy())
-        stacked = to_uint16(stacked)
-        species_summed = stacked.sum(axis=0)
-        species_summed = ndimage.median_filter(species_summed, size=1).astype(np.uint16)
-        return species_summed
+    all_species = get_species_names(im_file)
 
     species_summed = None
-    if species in mims.data.species.values:
-        species_summed = get_species_summed(mims, species)
+    if species in all_species:
+        species_summed = load_species_summed(im_file, species, tmats=tmats)
     elif species == "15N14N_ratio":
         n15 = next(
-            (name for name in possible_15n_names if name in mims.data.species.values),
+            (name for name in possible_15n_names if name in all_species),
             None,
         )
         n14 = next(
-            (name for name in possible_14n_names if name in mims.data.species.values),
+            (name for name in possible_14n_names if name in all_species),
             None,
         )
         if n15 and n14:
-            n15 = get_species_summed(mims, n15)
-            n14 = get_species_summed(mims, n14)
+            n15 = load_species_summed(im_file, n15, tmats=tmats)
+            n14 = load_species_summed(im_file, n14, tmats=tmats)
             n14[n14 == 0] = 1
             species_summed = np.divide(n15, n14) * 10000
         else:
             None
     elif species == "13C12C_ratio":
         c13 = next(
-            (name for name in possible_13c_names if name in mims.data.species.values),
+            (name for name in possible_13c_names if name in all_species),
             None,
         )
         c12 = next(
-            (name for name in possible_12c_names if name in mims.data.species.values),
+            (name for name in possible_12c_names if name in all_species),
             None,
         )
         if c13 and c12:
-            c13 = get_species_summed(mims, c13)
-            c12 = get_species_summed(mims, c12)
+            c13 = load_species_summed(im_file, c13, tmats=tmats)
+            c12 = load_species_summed(im_file, c12, tmats=tmats)
             c12[c12 == 0] = 1
             species_summed = np.divide(c13, c12) * 10000
         else:
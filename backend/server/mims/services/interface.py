@@ -2,9 +2,11 @@ import os
 from datetime import datetime
 import numpy as np
 import pyvips
-import sims
 from django.conf import settings
 
+from mims.model_utils import get_autocontrast_image_path
+from mims.models import MIMSAlignment, MIMSImage
+from .fft_alignment import fft_threshold_match
 from .image_utils import (
     manipulate_image,
     update_top_locations,
@@ -12,6 +14,9 @@ from .image_utils import (
     correct_inner_zeros,
 )
 
+ALIGNMENT_ENGINE = getattr(settings, "MIMS_ALIGNMENT_ENGINE", "fft")
+FROM_SET_SEARCH_RADIUS = getattr(settings, "MIMS_FROM_SET_SEARCH_RADIUS", 0.15)
+
 
 def threshold_match(
     im1_full, im2_full, THRESHOLD_8BIT_BUFFER=10, angle=None, flip_hor=None
@@ -66,80 +71,204 @@ def threshold_match(
     return best_overall_locations
 
 
-def create_alignment_estimates(mims_image, confirmed_alignment=None):
-    print(
-        f"{datetime.now()} starting alignment. Confirmed alignment is {confirmed_alignment}"
-    )
-    if confirmed_alignment:
-        # Get the em coordinates of the mims_image given the confirmed one.
-        print(
-            f"Found confirmed alignment in project: angle of {confirmed_alignment.rotation_degrees}, flip_hor of {confirmed_alignment.flip_hor}"
-        )
-        confirmed_im_obj = sims.SIMS(confirmed_alignment.mims_image.file)
-        current_im_obj = sims.SIMS(mims_image.mims_image.file)
-        current_im_x = current_im_obj.header["sample x"]
-        current_im_y = current_im_obj.header["sample y"]
-        confirmed_im_obj_x = confirmed_im_obj.header["sample x"]
-        confirmed_im_obj_y = confirmed_im_obj.header["sample y"]
-        confirmed_alignment_em_x = confirmed_alignment.x_offset
-        confirmed_alignment_em_y = confirmed_alignment.y_offset
-        scale = confirmed_alignment.scale
-        mims_pixel_size = mims_image.pixel_size_nm
-        em_pixel_size = mims_image.image_set.em_image.pixel_size_nm
-        angle = confirmed_alignment.rotation_degrees
-        flip_hor = confirmed_alignment.flip_hor
-        # Calculate the difference in microns between the current and confirmed nanoSIMS images
-        delta_x_microns = current_im_x - confirmed_im_obj_x
-        delta_y_microns = current_im_y - confirmed_im_obj_y
-
-        # Convert the difference to EM pixels
-        delta_x_em_pixels = delta_x_microns * 1000 / em_pixel_size
-        delta_y_em_pixels = delta_y_microns * 1000 / em_pixel_size
-
-        # Create rotation matrix
-        theta = np.radians(angle)
-        rotation_matrix = np.array(
-            [[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]]
-        )
-        # Apply rotation to the delta coordinates
-        rotated_delta = np.dot(
-            rotation_matrix, np.array([delta_x_em_pixels, delta_y_em_pixels])
+def _load_sulfur_image(mims_image):
+    """Inverted 32S autocontrast image, with 0 reserved for rotation padding."""
+    sulfur_image = pyvips.Image.new_from_file(
+        get_autocontrast_image_path(mims_image, "32S")
+    ).numpy()
+    # Invert the 8-bit image
+    sulfur_image = np.invert(sulfur_image)
+    # Change 0 to 1 so we can ignore extra pixels from rotation
+    return np.where(sulfur_image == 0, 1, sulfur_image)
+
+
+def _load_scaled_em(em_image, scale, padding):
+    """EM image resized to MIMS pixel size and padded with zeros."""
+    # Read from the nearest level of the EM pyramid
+    em = em_image.read(scale)
+    # Set inner 0s to 1s so we can expand with more 0s
+    em = correct_inner_zeros(em).astype(np.uint8)
+    return (
+        pyvips.Image.new_from_array(em)
+        .embed(
+            padding,
+            padding,
+            em.shape[1] + 2 * padding,
+            em.shape[0] + 2 * padding,
+            background=0,
         )
+        .numpy()
+    )
 
-        # Apply flip_hor if necessary
-        if flip_hor:
-            rotated_delta[0] = -rotated_delta[0]
-        # Calculate the new EM coordinates
-        new_em_x = confirmed_alignment_em_x + rotated_delta[0]
-        new_em_y = confirmed_alignment_em_y + rotated_delta[1]
 
-        # Apply scale factor
-        new_em_x *= scale
-        new_em_y *= scale
+def get_em_pixel_size(mims_image):
+    em_image = mims_image.image_set.canvas.images.first()
+    return em_image.pixel_size_nm or mims_image.image_set.canvas.pixel_size_nm
 
-        # Round to nearest integer (assuming EM coordinates are in pixels)
-        new_em_x = round(new_em_x)
-        new_em_y = round(new_em_y)
 
-        print(mims_image.file.filename)
-        print(
-            confirmed_im_obj_x,
-            confirmed_im_obj_y,
-            confirmed_alignment_em_x,
-            confirmed_alignment_em_y,
-        )
-        print(new_em_x, new_em_y)
-        mims_image.alignments.filter(status="FROM_SET").delete()
-        """new_from_set_alignment = MIMSAlignment(
-            mims_image=mims_image,
-            status="FROM_SET",
-            x_offset=new_em_x,
-            y_offset=new_em_y,
-            rotation_degrees=confirmed_alignment.rotation_degrees,
-            flip_hor=confirmed_alignment.flip_hor,
-            scale=confirmed_alignment.scale,
+def predict_from_set_offsets(confirmed_alignment, mims_images, em_pixel_size):
+    """
+    EM offsets of every image in mims_images from one confirmed alignment.
+
+    The stage position difference to the confirmed image is converted to EM
+    pixels and rotated/flipped like the confirmed image, for all images at once.
+
+    Returns:
+        numpy.ndarray: (N, 2) integer x, y offsets in EM pixels
+    """
+    confirmed_header = confirmed_alignment.mims_image.get_header_info()
+    stage = np.array(
+        [
+            [header["sample_x"], header["sample_y"]]
+            for header in (m.get_header_info() for m in mims_images)
+        ],
+        dtype=float,
+    ).reshape(-1, 2)
+    # Difference in microns to the confirmed image, converted to EM pixels
+    delta = (
+        (stage - [confirmed_header["sample_x"], confirmed_header["sample_y"]])
+        * 1000
+        / em_pixel_size
+    )
+    theta = np.radians(confirmed_alignment.rotation_degrees)
+    rotation_matrix = np.array(
+        [[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]]
+    )
+    delta = delta @ rotation_matrix.T
+    if confirmed_alignment.flip_hor:
+        delta[:, 0] = -delta[:, 0]
+    offsets = delta + [confirmed_alignment.x_offset, confirmed_alignment.y_offset]
+    return np.rint(offsets).astype(int)
+
+
+def _refine_offset(em_scaled, sulfur_image, x, y, angle, flip_hor, radius):
+    """
+    Best placement of the 32S image within radius pixels of (x, y) on the
+    scaled and padded EM image, with the orientation fixed.
+
+    Returns:
+        tuple: (x, y, iou) or None if no placement was accepted
+    """
+    h, w = manipulate_image(sulfur_image, angle, flip_hor).shape
+    x0, y0 = max(0, x - radius), max(0, y - radius)
+    x1 = min(em_scaled.shape[1], x + radius + w)
+    y1 = min(em_scaled.shape[0], y + radius + h)
+    if x1 - x0 < w or y1 - y0 < h:
+        return None
+    matches = fft_threshold_match(
+        em_scaled,
+        sulfur_image,
+        10,
+        angle,
+        flip_hor,
+        levels=[1],
+        window=(x0, y0, x1, y1),
+    )
+    if not matches:
+        return None
+    return matches[0][:3]
+
+
+def propagate_confirmed_alignment(confirmed_alignment, mims_images=None, refine=True):
+    """
+    Create FROM_SET alignments for the other images of a set from one confirmed
+    alignment.
+
+    Offsets are predicted from the cached stage coordinates in one pass. If
+    refine is set, each prediction is then corrected by searching the 32S image
+    against the EM image, at the confirmed orientation, in a window of
+    MIMS_FROM_SET_SEARCH_RADIUS (fraction of the MIMS image size) around it.
+    The EM image is only loaded and scaled once for the whole set.
+
+    Args:
+        confirmed_alignment (MIMSAlignment): User confirmed alignment
+        mims_images (list): Images to align. Defaults to every image of the
+            set that is not registering or registered.
+        refine (bool): Run the local search around each prediction
+
+    Returns:
+        list: the saved MIMSAlignment objects
+    """
+    confirmed_image = confirmed_alignment.mims_image
+    if mims_images is None:
+        mims_images = confirmed_image.image_set.mims_images.exclude(
+            status__in=[
+                MIMSImage.Status.REGISTERING,
+                MIMSImage.Status.REGISTERED,
+                MIMSImage.Status.INVALID_FILE,
+            ]
+        ).exclude(id=confirmed_image.id)
+    mims_images = list(mims_images)
+    if not mims_images:
+        return []
+    print(
+        f"{datetime.now()} propagating alignment of {confirmed_image} "
+        f"(angle {confirmed_alignment.rotation_degrees}, "
+        f"flip_hor {confirmed_alignment.flip_hor}) to {len(mims_images)} images"
+    )
+
+    em_image = confirmed_image.image_set.canvas.images.first()
+    em_pixel_size = get_em_pixel_size(confirmed_image)
+    offsets = predict_from_set_offsets(confirmed_alignment, mims_images, em_pixel_size)
+    angle = confirmed_alignment.rotation_degrees
+    flip_hor = confirmed_alignment.flip_hor
+
+    em_scaled = em_scaled_key = None
+    alignments = []
+    for mims_image, (x, y) in zip(mims_images, offsets):
+        x, y = int(x), int(y)
+        info = {
+            "predicted": [x, y],
+            "confirmed_alignment": str(confirmed_alignment.id),
+        }
+        if refine:
+            sulfur_image = _load_sulfur_image(mims_image)
+            scale = em_pixel_size / mims_image.pixel_size_nm
+            padding = int(max(sulfur_image.shape) * 0.6)
+            # Images of a set normally share one raster, so this loads once
+            if em_scaled_key != (scale, padding):
+                em_scaled_key = (scale, padding)
+                em_scaled = _load_scaled_em(em_image, scale, padding)
+            radius = int(max(sulfur_image.shape) * FROM_SET_SEARCH_RADIUS)
+            refined = _refine_offset(
+                em_scaled,
+                sulfur_image,
+                round(x * scale) + padding,
+                round(y * scale) + padding,
+                angle,
+                flip_hor,
+                radius,
+            )
+            if refined is not None:
+                x = round((refined[0] - padding) / scale)
+                y = round((refined[1] - padding) / scale)
+                info["iou"] = refined[2]
+        alignments.append(
+            MIMSAlignment(
+                mims_image=mims_image,
+                status="FROM_SET",
+                x_offset=x,
+                y_offset=y,
+                rotation_degrees=angle,
+                flip_hor=flip_hor,
+                scale=confirmed_alignment.scale,
+                info=info,
+            )
         )
-        new_from_set_alignment.save()"""
+
+    MIMSAlignment.objects.filter(mims_image__in=mims_images, status="FROM_SET").delete()
+    MIMSAlignment.objects.bulk_create(alignments)
+    print(f"{datetime.now()} created {len(alignments)} FROM_SET alignments")
+    return alignments
+
+
+def create_alignment_estimates(mims_image, confirmed_alignment=None):
+    print(
+        f"{datetime.now()} starting alignment. Confirmed alignment is {confirmed_alignment}"
+    )
+    if confirmed_alignment:
+        # Get the em coordinates of the mims_image given the confirmed one.
+        propagate_confirmed_alignment(confirmed_alignment, [mims_image])
         return
 
     # Clear old alignments
@@ -148,47 +277,19 @@ def create_alignment_estimates(mims_image, confirmed_alignment=None):
 
     # Get scale
     mims_pixel_size = mims_image.pixel_size_nm
-    em_pixel_size = mims_image.image_set.em_image.pixel_size_nm
+    em_pixel_size = get_em_pixel_size(mims_image)
     scale = em_pixel_size / mims_pixel_size
 
-    # Load the 32S image
-    sulfur_image_path = os.path.join(
-        settings.MEDIA_ROOT,
-        "mims_images",
-        str(mims_image.image_set.id),
-        str(mims_image.id),
-        "isotopes",
-        "32S_autocontrast.png",
-    )
-    sulfur_image = pyvips.Image.new_from_file(sulfur_image_path).numpy()
-
-    # Prep the 32S image:
-    # Invert the 8-bit image
-    sulfur_image = np.invert(sulfur_image)
-    # Change 0 to 1 so we can ignore extra pixels from rotation
-    sulfur_image = np.where(sulfur_image == 0, 1, sulfur_image)
-
-    # Load and scale the em image
-    em_image_path = mims_image.image_set.em_image.file.path
-    em_image = pyvips.Image.new_from_file(em_image_path).resize(scale).numpy()
-
-    # Set inner 0s to 1s so we can expand with more 0s
-    em_image = correct_inner_zeros(em_image).astype(np.uint8)
+    sulfur_image = _load_sulfur_image(mims_image)
     # Expand the image to include padding for the sliding check
     EM_PADDING = int(sulfur_image.shape[0] * 0.6)
-    em_image = (
-        pyvips.Image.new_from_array(em_image)
-        .embed(
-            EM_PADDING,
-            EM_PADDING,
-            em_image.shape[1] + 2 * EM_PADDING,
-            em_image.shape[0] + 2 * EM_PADDING,
-            background=0,
-        )
-        .numpy()
+    em_image = _load_scaled_em(
+        mims_image.image_set.canvas.images.first(), scale, EM_PADDING
     )
-    print(datetime.now(), "starting threshold match")
-    best_matches = threshold_match(em_image, sulfur_image, 10, angle, flip_hor)
+    angle = flip_hor = None
+    print(datetime.now(), f"starting {ALIGNMENT_ENGINE} threshold match")
+    match_fn = fft_threshold_match if ALIGNMENT_ENGINE == "fft" else threshold_match
+    best_matches = match_fn(em_image, sulfur_image, 10, angle, flip_hor)
     print(datetime.now(), best_matches)
     alignment_status = (
         "ESTIMATE_INITIAL"
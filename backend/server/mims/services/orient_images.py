@@ -1,6 +1,5 @@
 import numpy as np
 from skimage.transform import estimate_transform
-from PIL import Image
 import math
 from mims.services.image_utils import image_from_im_file
 from mims.model_utils import (
@@ -98,8 +97,10 @@ def get_points_transform(mims_imageviewset, mims_points, em_points):
     )
 
     # Use the associated MIMSImage within the viewset to get file path
-    mims_img_path = mims_imageviewset.mims_images.first().file.path
-    raw_mims_shape = image_from_im_file(mims_img_path, "SE", autocontrast=False).shape
+    mims_img = mims_imageviewset.mims_images.first()
+    raw_mims_shape = image_from_im_file(
+        mims_img.file.path, "SE", autocontrast=False, tmats=mims_img.get_stack_tmats()
+    ).shape
 
     max_x = raw_mims_shape[1] - 1  # Use width
 
@@ -215,8 +216,8 @@ def calculate_individual_mims_translations(
 
     # Load the aggregate positions and dimensions of the ROI
     ims, bboxes = load_images_and_bboxes(mims_imageviewset, isotope, flip)
-    em_img = np.array(Image.open(mims_imageviewset.canvas.images.first().file.path))
-    em_shape = em_img.shape
+    em_image = mims_imageviewset.canvas.images.first()
+    em_shape = em_image.shape
 
     for mims_image in mims_images:
         mims_image.flip = flip
@@ -246,7 +247,7 @@ def calculate_individual_mims_translations(
             continue
 
         # Crop the em_img to the bounding box
-        cropped_em_img = em_img[max(0, min_y) : max_y, max(0, min_x) : max_x]
+        cropped_em_img = em_image.crop(min_x, min_y, max_x, max_y)
         print(f"Roi {roi}: {cropped_em_img.shape}, {min_x}, {min_y}, {max_x}, {max_y}")
 
         # Adjust the transformed corners to the cropped image coordinates
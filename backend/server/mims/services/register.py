@@ -12,10 +12,9 @@ from django.core.files import File
 from pathlib import Path
 import numpy as np
 from scipy.interpolate import griddata
-from skimage.transform import ThinPlateSplineTransform, warp
+from skimage.transform import ThinPlateSplineTransform
 import numpy as np
 import math
-from PIL import Image
 import cv2
 import os
 from pathlib import Path
@@ -28,6 +27,12 @@ from mims.models import MIMSImage
 import time
 from skimage.transform import SimilarityTransform
 from mims.services.create_overlays import update_mims_image_set_status
+from django.conf import settings
+from mims.services.unwarp import RATIO_IMAGES
+
+# TPS lattice spacing and max interpolation error, in warped canvas pixels
+TPS_GRID_STEP = getattr(settings, "MIMS_TPS_GRID_STEP", 8)
+TPS_TOLERANCE = getattr(settings, "MIMS_TPS_TOLERANCE", 0.05)
 
 
 def _as_int(v):
@@ -93,7 +98,10 @@ def validate_mims_image(mims_image_id):
 def get_mims_dims(mims_image):
     isotope = mims_image.isotopes.first()
     img_mims = image_from_im_file(
-        mims_image.file.path, isotope.name, autocontrast=False
+        mims_image.file.path,
+        isotope.name,
+        autocontrast=False,
+        tmats=mims_image.get_stack_tmats(),
     )
     return img_mims.shape
 
@@ -108,14 +116,172 @@ def _flip_x(arr, max_x):
     return arr
 
 
+def _lattice(size, step):
+    """Every step-th pixel index of an axis, always including the last one."""
+    return np.unique(np.append(np.arange(0, size, step), size - 1))
+
+
+def _interp_weights(points, lattice):
+    idx = np.searchsorted(lattice, points, side="right") - 1
+    idx = np.clip(idx, 0, len(lattice) - 2)
+    weights = (points - lattice[idx]) / (lattice[idx + 1] - lattice[idx])
+    return idx, weights
+
+
+def _bilinear(values, lattice_y, lattice_x, ys, xs):
+    """Bilinear interpolation of (ny, nx, 2) lattice values at every (ys, xs)."""
+    iy, wy = _interp_weights(ys, lattice_y)
+    ix, wx = _interp_weights(xs, lattice_x)
+    wx = wx[None, :, None]
+    wy = wy[:, None, None]
+    top = values[iy][:, ix] * (1 - wx) + values[iy][:, ix + 1] * wx
+    bottom = values[iy + 1][:, ix] * (1 - wx) + values[iy + 1][:, ix + 1] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def _tps_points(tps, points, chunk_size=65536):
+    """tps(points) in chunks, bounding the points x control points temporaries."""
+    if len(points) <= chunk_size:
+        return tps(points)
+    return np.concatenate(
+        [tps(points[i : i + chunk_size]) for i in range(0, len(points), chunk_size)]
+    )
+
+
+def _tps_displacement(tps, xs, ys):
+    """TPS displacement (dx, dy) on the grid of xs by ys, shape (ny, nx, 2)."""
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    points = np.column_stack([grid_x.ravel(), grid_y.ravel()]).astype(float)
+    return (_tps_points(tps, points) - points).reshape(len(ys), len(xs), 2)
+
+
+def _dilate_cells(mask):
+    """3 x 3 dilation of a boolean cell mask."""
+    out = mask.copy()
+    out[1:] |= mask[:-1]
+    out[:-1] |= mask[1:]
+    rows = out.copy()
+    out[:, 1:] |= rows[:, :-1]
+    out[:, :-1] |= rows[:, 1:]
+    return out
+
+
+def evaluate_tps_grid(tps, rows, cols, step=TPS_GRID_STEP, tolerance=TPS_TOLERANCE):
+    """
+    TPS coordinates of every pixel of a (rows, cols) canvas, from a sparse grid.
+
+    The displacement is evaluated exactly every `step` pixels and bilinearly
+    interpolated in between, which costs (rows * cols / step²) TPS evaluations
+    instead of rows * cols. The interpolation error is estimated against the
+    exact TPS at every cell centre, where it is usually largest. Cells (and
+    their neighbours) above `tolerance` pixels, typically the ones around
+    landmarks, are evaluated densely.
+
+    Args:
+        tps (ThinPlateSplineTransform): transform to evaluate
+        rows (int): canvas height
+        cols (int): canvas width
+        step (int): lattice spacing in pixels, MIMS_TPS_GRID_STEP by default
+        tolerance (float): max error in pixels, MIMS_TPS_TOLERANCE by default,
+            or None to keep the interpolation everywhere
+
+    Returns:
+        tuple: ((rows, cols, 2) x, y coordinates, dict with the estimated max
+        error in pixels, the step and the fraction of densely evaluated pixels)
+    """
+    xs, ys = np.arange(cols), np.arange(rows)
+    grid = np.stack(np.meshgrid(xs, ys), axis=-1).astype(float)
+    if step <= 1 or min(rows, cols) <= step:
+        coords = grid + _tps_displacement(tps, xs, ys)
+        return coords, {"max_error": 0.0, "step": 1, "dense_fraction": 1.0}
+
+    lattice_x, lattice_y = _lattice(cols, step), _lattice(rows, step)
+    displacement = _tps_displacement(tps, lattice_x, lattice_y)
+    coords = grid + _bilinear(displacement, lattice_y, lattice_x, ys, xs)
+
+    mid_x = (lattice_x[:-1] + lattice_x[1:]) / 2
+    mid_y = (lattice_y[:-1] + lattice_y[1:]) / 2
+    error = np.linalg.norm(
+        _tps_displacement(tps, mid_x, mid_y)
+        - _bilinear(displacement, lattice_y, lattice_x, mid_y, mid_x),
+        axis=-1,
+    )
+    dense = np.zeros((rows, cols), dtype=bool)
+    if tolerance is not None and (error > tolerance).any():
+        dense_cells = _dilate_cells(error > tolerance)
+        cell_y = _interp_weights(ys, lattice_y)[0]
+        cell_x = _interp_weights(xs, lattice_x)[0]
+        dense = dense_cells[cell_y][:, cell_x]
+        coords[dense] = _tps_points(tps, grid[dense])
+        error = error[~dense_cells]
+    report = {
+        "max_error": float(error.max()) if error.size else 0.0,
+        "step": int(step),
+        "dense_fraction": float(dense.mean()),
+    }
+    return coords, report
+
+
+def build_unwarp_maps(
+    mims_tf, tps, output_shape, dsize, step=TPS_GRID_STEP, tolerance=TPS_TOLERANCE
+):
+    """
+    Composed inverse coordinate map of the whole unwarp, for cv2.remap.
+
+    Equivalent to warping by mims_tf.inverse, then by tps, then resizing the
+    output_shape result to dsize. The TPS is evaluated on a sparse grid of the
+    output_shape canvas (see evaluate_tps_grid) and the coordinate map (not
+    the image) is resized, so every isotope is then interpolated a single time
+    from the source.
+
+    Args:
+        mims_tf (SimilarityTransform): MIMS -> canvas similarity
+        tps (ThinPlateSplineTransform): inverse thin-plate spline on the canvas
+        output_shape (tuple): (rows, cols) of the warped canvas
+        dsize (tuple): (width, height) the canvas is resized to
+        step (int): TPS grid spacing, see evaluate_tps_grid
+        tolerance (float): TPS grid error tolerance, see evaluate_tps_grid
+
+    Returns:
+        tuple: float32 (map_x, map_y) arrays of shape (height, width) and the
+        evaluate_tps_grid report
+    """
+    rows, cols = output_shape
+    coords, report = evaluate_tps_grid(tps, rows, cols, step, tolerance)
+    coords = mims_tf.inverse(coords.reshape(-1, 2))
+    map_x = coords[:, 0].reshape(rows, cols).astype(np.float32)
+    map_y = coords[:, 1].reshape(rows, cols).astype(np.float32)
+    map_x = cv2.resize(map_x, dsize, interpolation=cv2.INTER_LINEAR)
+    map_y = cv2.resize(map_y, dsize, interpolation=cv2.INTER_LINEAR)
+    return map_x, map_y, report
+
+
+def save_unwarped_image(mims_img, name, img):
+    """Write an unwarped image as a compressed PNG and store it as a MimsTiffImage."""
+    reg_loc = Path(mims_img.file.path).with_suffix("") / "registration"
+    out_path = reg_loc / f"{name}_unwarped_{mims_img.name}.png"
+    cv2.imwrite(str(out_path), img, [cv2.IMWRITE_PNG_COMPRESSION, 6])
+
+    # store in DB, then delete temp
+    with open(out_path, "rb") as fh:
+        tiff = MimsTiffImage.objects.create(
+            mims_image=mims_img,
+            image=File(fh, name=out_path.name),
+            name=name,
+            registration_bbox=mims_img.canvas_bbox,
+        )
+    out_path.unlink()
+    return tiff
+
+
 def register_images(mims_image_obj_id):
     """
     1) Optional X-mirror of MIMS landmarks (same axis get_points_transform used)
     2) Similarity affine             →  EM_pred
     3) Median-offset tweak on translation
     4) Thin-plate spline on residuals (EM_pred → EM_true)
-    5) Build inverse warp maps + canvas_bbox
-    6) Display diagnostic plots (TPS panel now uses skimage.transform.warp)
+    5) Build canvas_bbox
+    6) Compose similarity, TPS and resize into one cv2.remap map per image
     """
     start_time = time.time()
 
@@ -200,7 +366,7 @@ def register_images(mims_image_obj_id):
     # ---------- 4. thin-plate spline fit ---------------------------
     tps = ThinPlateSplineTransform()
     # NOTE: we pass (dst, src) so that `tps` is the **inverse** map,
-    #       exactly what `skimage.transform.warp` expects
+    #       i.e. output pixel -> input pixel, as build_unwarp_maps expects
     tps.estimate(em_pred, mims_pred)
     tps_inv = ThinPlateSplineTransform()
     tps_inv.estimate(mims_pred, em_pred)
@@ -212,12 +378,13 @@ def register_images(mims_image_obj_id):
     x1, y1 = np.ceil(em_corners.max(axis=0)).astype(int)
 
     # clamp to the EM image limits (in case any indices went slightly <0 or >size-1)
-    em_img = np.array(Image.open(mims_img.canvas.images.first().file.path))
-    H, W = em_img.shape[:2]
+    H, W = mims_img.canvas.images.first().shape
     # x0, x1 = np.clip([x0, x1], 0, W)
     # y0, y1 = np.clip([y0, y1], 0, H)
 
     # ---------- 6. save bbox & regenerate TIFFs --------------------
+    # The overlays need updating where the tile was and where it is now
+    previous_bbox = mims_img.canvas_bbox
     mims_img.canvas_bbox = [
         [int(x0), int(y0)],
         [int(x1), int(y0)],
@@ -233,59 +400,70 @@ def register_images(mims_image_obj_id):
         tiff.delete()
     mims_img.mims_tiff_images.all().delete()
     t0 = time.time()
+    # ---------- 7. one coordinate map for every isotope -----------
+    # (resize to the bbox) ∘ TPS ∘ similarity, evaluated once
+    map_x, map_y, tps_report = build_unwarp_maps(
+        mims_tf, tps, output_shape, (int(y1 - y0), int(x1 - x0))
+    )
+    print("unwarp map time:", round(time.time() - t0, 1), "s", tps_report)
+    ratio_species = {
+        name
+        for numerators, denominators in RATIO_IMAGES.values()
+        for name in numerators + denominators
+    }
+    unwarped = {}
+    tmats = mims_img.get_stack_tmats()
     for iso in mims_img.isotopes.all():
         # ------------ 1. read + optional flip -------------------------
-        src = image_from_im_file(mims_img.file.path, iso.name, autocontrast=False)
+        src = image_from_im_file(
+            mims_img.file.path, iso.name, autocontrast=False, tmats=tmats
+        )
         if needs_flip:
             src = src[:, ::-1]
 
         # ------------ 2. warp intensity image -------------------------
-        img = warp(src, mims_tf.inverse, output_shape=output_shape, preserve_range=True)
-        img = warp(img, tps, output_shape=output_shape, preserve_range=True)
-
-        # ------------ 3. build alpha mask (warp of ones) --------------
-        ones = np.ones_like(src, dtype=np.uint8)
-        mask = warp(
-            ones,
-            mims_tf.inverse,
-            output_shape=output_shape,
-            order=0,
-            cval=0,
-            preserve_range=True,
+        img = cv2.remap(
+            np.ascontiguousarray(src, dtype=np.float32),
+            map_x,
+            map_y,
+            interpolation=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
         )
-        mask = warp(
-            mask, tps, output_shape=output_shape, order=0, cval=0, preserve_range=True
-        )
-
-        # ------------ 4. crop / resize both the same ------------------
-        img = cv2.resize(img, (y1 - y0, x1 - x0), interpolation=cv2.INTER_LINEAR)
-        mask = cv2.resize(mask, (y1 - y0, x1 - x0), interpolation=cv2.INTER_NEAREST)
+        if iso.name in ratio_species:
+            unwarped[iso.name] = img
 
-        # ------------ 5. build 4-channel BGRA array -------------------
+        # ------------ 3. 8 or 16 bit output ---------------------------
         is_16bit = np.max(img) > 255
         if is_16bit:
             img = img.astype(np.uint16)
         else:
             img = img.astype(np.uint8)
 
-        # ------------ 6. write compressed PNG ---------------------------
-        reg_loc = Path(mims_img.file.path).with_suffix("") / "registration"
-        out_path = reg_loc / f"{iso.name}_unwarped_{mims_img.name}.png"
-        cv2.imwrite(str(out_path), img, [cv2.IMWRITE_PNG_COMPRESSION, 6])
-
-        # ------------ 7. store in DB, then delete temp ---------------
-        with open(out_path, "rb") as fh:
-            tiff = MimsTiffImage.objects.create(
-                mims_image=mims_img,
-                image=File(fh, name=out_path.name),
-                name=f"{iso.name}",
-                registration_bbox=mims_img.canvas_bbox,
-            )
-        out_path.unlink()
+        # ------------ 4. write + store in DB --------------------------
+        save_unwarped_image(mims_img, iso.name, img)
+
+    # ---------- 8. per-tile ratio images ---------------------------
+    for ratio_name, (numerators, denominators) in RATIO_IMAGES.items():
+        numerator = next((n for n in numerators if n in unwarped), None)
+        denominator = next((n for n in denominators if n in unwarped), None)
+        if not numerator or not denominator:
+            continue
+        # Same as the preprocessing ratio images: zeros -> 1, scaled by 10000
+        denominator_img = np.where(
+            unwarped[denominator] == 0, 1, unwarped[denominator]
+        )
+        ratio = unwarped[numerator] / denominator_img * 10000
+        save_unwarped_image(
+            mims_img, ratio_name, np.clip(ratio, 0, 65535).astype(np.uint16)
+        )
     print("unwarp time:", round(time.time() - t0, 1), "s")
 
     mims_img.status = MIMSImage.Status.REGISTERED
     mims_img.save(update_fields=["status"])
 
-    update_mims_image_set_status(mims_img.image_set.id)
+    update_mims_image_set_status(
+        mims_img.image_set.id,
+        updated_bboxes=[bbox for bbox in [previous_bbox, mims_img.canvas_bbox] if bbox],
+    )
     return True
@@ -72,10 +72,29 @@ def create_mask_from_shapes(image_shape, shapes):
     return mask
 
 
-def get_species_summed(mims, species):
-    sr = StackReg(StackReg.AFFINE)
-    sr.register_stack(mims.data.loc[species].to_numpy(), reference="previous")
-    stacked = sr.transform_stack(mims.data.loc[species].to_numpy())
+def get_reference_species(mims):
+    """SE if it was acquired, otherwise the species with the highest total counts."""
+    if "SE" in mims.species:
+        return "SE"
+    totals = [mims.species_stack(species).sum() for species in mims.species]
+    return mims.species[int(np.argmax(totals))]
+
+
+def estimate_stack_transforms(mims, species, mode=StackReg.AFFINE):
+    """Plane-to-plane drift matrices of one species, shape (planes, 3, 3)."""
+    sr = StackReg(mode)
+    return sr.register_stack(mims.species_stack(species), reference="previous")
+
+
+def get_species_summed(mims, species, mode=StackReg.AFFINE, tmats=None):
+    sr = StackReg(mode)
+    stack = mims.species_stack(species)
+    if tmats is None:
+        sr.register_stack(stack, reference="previous")
+        stacked = sr.transform_stack(stack)
+    else:
+        # All species of an acquisition share the same drift between planes
+        stacked = sr.transform_stack(stack, tmats=np.asarray(tmats))
     stacked = to_uint16(stacked)
     species_summed = stacked.sum(axis=0)
     species_summed = ndimage.median_filter(species_summed, size=1).astype(np.uint16)
@@ -85,7 +104,8 @@ def get_species_summed(mims, species):
 def create_registration_images(mims_image, masks=None):
     stime = time.time()
     print("creating registration images", time.time() - stime)
-    em_image_obj = Image.open(mims_image.image_set.canvas.images.first().file.path)
+    em_image = mims_image.image_set.canvas.images.first()
+    em_width, em_height = em_image.get_dimensions()
     mims_path = Path(mims_image.file.path)
     save_reg_loc = os.path.join(mims_path.parent, mims_path.stem, "registration")
     if not os.path.exists(save_reg_loc):
@@ -103,22 +123,13 @@ def create_registration_images(mims_image, masks=None):
     mims_image_obj = mims_image_obj.rotate(-alignment.rotation_degrees, expand=True)
     extra = int(100 * scale)
     em_y_start = max(alignment.y_offset - extra, 0)
-    em_y_end = int(
-        min(em_y_start + mims_image_obj.height * scale + extra, em_image_obj.height)
-    )
+    em_y_end = int(min(em_y_start + mims_image_obj.height * scale + extra, em_height))
     em_x_start = max(alignment.x_offset - extra, 0)
-    em_x_end = int(
-        min(em_x_start + mims_image_obj.width * scale + extra, em_image_obj.width)
-    )
-    em_image_obj = Image.fromarray(
-        np.array(em_image_obj)[em_y_start:em_y_end, em_x_start:em_x_end]
-    )
-    # Scale down the EM image (inverse of scaling up MIMS)
-    em_image_transformed = em_image_obj.resize(
-        (
-            int(em_image_obj.width / scale),
-            int(em_image_obj.height / scale),
-        ),
+    em_x_end = int(min(em_x_start + mims_image_obj.width * scale + extra, em_width))
+    # Scale down the EM image (inverse of scaling up MIMS), reading the region
+    # from the nearest level of the EM pyramid
+    em_image_transformed = Image.fromarray(
+        em_image.crop(em_x_start, em_y_start, em_x_end, em_y_end, scale=1 / scale)
     )
 
     # Transform the EM image instead of the MIMS images
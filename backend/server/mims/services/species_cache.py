@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+from django.conf import settings
+from pystackreg import StackReg
+
+from mims.services.im_reader import ImFile
+from mims.services.registration_utils import (
+    estimate_stack_transforms,
+    get_reference_species,
+    get_species_summed,
+)
+
+SPECIES_CACHE_SIZE = getattr(settings, "MIMS_SPECIES_CACHE_SIZE", 32)
+SHARED_STACK_TRANSFORMS = getattr(settings, "MIMS_SHARED_STACK_TRANSFORMS", True)
+
+_hash_memo = {}
+_species_lru = OrderedDict()
+_lock = Lock()
+
+
+def get_species_cache_dir(im_file):
+    """Cache directory for an .im file, next to its registration folder."""
+    im_path = Path(im_file)
+    return im_path.parent / im_path.stem / "cache"
+
+
+def clear_species_cache(im_file):
+    """Remove the on-disk and in-process cache entries for an .im file."""
+    cache_dir = get_species_cache_dir(im_file)
+    if cache_dir.exists():
+        shutil.rmtree(cache_dir)
+    with _lock:
+        digest = _hash_memo.pop(str(im_file), (None, None))[1]
+        for key in [k for k in _species_lru if k[0] == digest]:
+            del _species_lru[key]
+
+
+def file_digest(im_file):
+    """
+    Content hash of an .im file. Memoized on (size, mtime) so the file is only
+    read once per process while it stays unchanged.
+    """
+    stat = os.stat(im_file)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    memo = _hash_memo.get(str(im_file))
+    if memo and memo[0] == stamp:
+        return memo[1]
+    sha = hashlib.sha256()
+    with open(im_file, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()[:32]
+    _hash_memo[str(im_file)] = (stamp, digest)
+    return digest
+
+
+def _safe_name(species):
+    return re.sub(r"[^\w.-]", "_", species)
+
+
+def get_species_names(im_file, mims=None):
+    """List of species in an .im file, cached next to the summed planes."""
+    cache_dir = get_species_cache_dir(im_file)
+    species_path = cache_dir / f"{file_digest(im_file)}_species.json"
+    if species_path.exists():
+        with open(species_path, "r") as fh:
+            return json.load(fh)
+    if mims is None:
+        mims = ImFile(im_file)
+    species = list(mims.species)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(species_path, "w") as fh:
+        json.dump(species, fh)
+    return species
+
+
+def load_stack_transforms(im_file, mode=StackReg.AFFINE, mims=None):
+    """
+    Drift matrices estimated once on the reference channel of an .im file.
+
+    Returns:
+        tuple: (reference species, numpy.ndarray of shape (planes, 3, 3))
+    """
+    cache_dir = get_species_cache_dir(im_file)
+    tmats_path = cache_dir / f"{file_digest(im_file)}_tmats_{mode}.npz"
+    if tmats_path.exists():
+        with np.load(tmats_path) as cached:
+            return str(cached["reference"]), cached["tmats"]
+    if mims is None:
+        mims = ImFile(im_file)
+    reference = get_reference_species(mims)
+    tmats = estimate_stack_transforms(mims, reference, mode)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_dir / f"{tmats_path.stem}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, reference=np.array(reference), tmats=tmats)
+    os.replace(tmp_path, tmats_path)
+    return reference, tmats
+
+
+def load_species_summed(
+    im_file, species, mode=StackReg.AFFINE, mims=None, shared=None, tmats=None
+):
+    """
+    Registered, summed uint16 image for one species of an .im file.
+
+    Results are content addressed by (file hash, species, StackReg mode and
+    whether the drift is shared) and kept both as .npy files on disk and in an
+    in-process LRU, so each species is only decoded and registered once per
+    file. A copy is returned so callers may modify it freely.
+
+    Args:
+        im_file (str): Path to the .im file
+        species (str): Name of the species/isotope to extract
+        mode (int): StackReg transformation mode used for plane registration
+        mims (ImFile): Already opened file, used on a cache miss
+        shared (bool): Apply the reference channel's drift matrices instead of
+            registering this species on its own. Defaults to
+            MIMS_SHARED_STACK_TRANSFORMS.
+        tmats (array-like): Precomputed shared drift matrices, e.g. from
+            MIMSImage.stack_transforms
+    """
+    if shared is None:
+        shared = SHARED_STACK_TRANSFORMS or tmats is not None
+    registration = f"{mode}s" if shared else f"{mode}"
+
+    digest = file_digest(im_file)
+    key = (digest, species, registration)
+    with _lock:
+        if key in _species_lru:
+            _species_lru.move_to_end(key)
+            return _species_lru[key].copy()
+
+    cache_dir = get_species_cache_dir(im_file)
+    npy_path = cache_dir / f"{digest}_{_safe_name(species)}_{registration}.npy"
+    if npy_path.exists():
+        species_summed = np.load(npy_path)
+    else:
+        if mims is None:
+            mims = ImFile(im_file)
+        if shared and tmats is None:
+            tmats = load_stack_transforms(im_file, mode, mims)[1]
+        species_summed = get_species_summed(mims, species, mode, tmats)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write then rename so a concurrent reader never sees a partial file
+        tmp_path = npy_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as fh:
+            np.save(fh, species_summed)
+        os.replace(tmp_path, npy_path)
+
+    with _lock:
+        _species_lru[key] = species_summed
+        _species_lru.move_to_end(key)
+        while len(_species_lru) > SPECIES_CACHE_SIZE:
+            _species_lru.popitem(last=False)
+    return species_summed.copy()
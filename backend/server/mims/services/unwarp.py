@@ -6,3 +6,9 @@ possible_12c_names = ["12C", "12C2"]
 possible_13c_names = ["13C", "12C 13C"]
 possible_15n_names = ["15N 12C", "12C 15N"]
 possible_14n_names = ["14N 12C", "12C 14N"]
+
+# Ratio images of the isotopes: name -> (numerator names, denominator names)
+RATIO_IMAGES = {
+    "13C12C_ratio": (possible_13c_names, possible_12c_names),
+    "15N14N_ratio": (possible_15n_names, possible_14n_names),
+}
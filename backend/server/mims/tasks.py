@@ -1,4 +1,4 @@
-from celery import shared_task
+from celery import chord, shared_task
 import json
 from django.apps import apps
 from django.conf import settings
@@ -6,13 +6,19 @@ import SimpleITK as sitk
 from django.shortcuts import get_object_or_404
 from mims.services.register import register_images
 from mims.services.orient_images import largest_inner_square, orient_viewset
-from mims.services.registration_utils import (
-    create_registration_images,
-    get_species_summed,
+from mims.services.im_reader import ImFile, extract_header_info
+from mims.services.registration_utils import create_registration_images
+from mims.services.create_overlays import create_isotope_overlay, save_overlays
+from mims.services.species_cache import (
+    SHARED_STACK_TRANSFORMS,
+    get_species_names,
+    load_species_summed,
+    load_stack_transforms,
 )
 from mims.model_utils import (
     get_concatenated_image,
 )
+from image.services import save_dzi
 from mims.models import Isotope, MIMSAlignment, MIMSImage, MIMSImageSet, MIMSOverlay
 from skimage import exposure
 import sims
@@ -26,125 +32,188 @@ import numpy as np
 from pystackreg import StackReg
 from pystackreg.util import to_uint16
 import pyvips
-from mims.services import create_alignment_estimates
+from mims.services import create_alignment_estimates, propagate_confirmed_alignment
+
+# Alignments the user has confirmed, from the rough placement to the final one
+CONFIRMED_ALIGNMENT_STATUSES = [
+    "USER_ROUGH_ALIGNMENT",
+    "FINAL_TWEAKED_ONE",
+    "ROUGH",
+    "COMPLETE",
+]
 
 
 @shared_task
-def preprocess_mims_image_set(mims_image_set_id):
+def preprocess_mims_image_set(mims_image_set_id, fan_out=True):
+    """
+    Preprocess every MIMS image of a set, then build the set composites.
+
+    With fan_out the images are processed as a Celery chord, one subtask per
+    image spread across workers, and finalize_mims_image_set runs as the chord
+    callback. Without it everything runs inline in the calling process.
+    """
     MIMSImageSet = apps.get_model("mims", "MIMSImageSet")
     mims_image_set = MIMSImageSet.objects.get(id=mims_image_set_id)
+    mims_image_ids = [
+        str(mims_image_id)
+        for mims_image_id in mims_image_set.mims_images.values_list("id", flat=True)
+    ]
+
+    if not fan_out:
+        results = [
+            preprocess_mims_image(mims_image_id) for mims_image_id in mims_image_ids
+        ]
+        return finalize_mims_image_set(results, str(mims_image_set_id))
 
-    media_root = settings.MEDIA_ROOT
+    chord(preprocess_mims_image.s(mims_image_id) for mims_image_id in mims_image_ids)(
+        finalize_mims_image_set.s(str(mims_image_set_id))
+    )
 
-    image_dts = {}
 
+@shared_task
+def preprocess_mims_image(mims_image_id):
+    """
+    Parse one .im file, register and save every species and the ratio images.
+
+    Returns:
+        dict: {"id", "date"} for a preprocessed image, or None if the image was
+        invalid or deleted
+    """
     possible_12c_names = ["12C", "12C2"]
     possible_13c_names = ["13C", "12C 13C"]
     possible_15n_names = ["15N 12C", "12C 15N"]
     possible_14n_names = ["14N 12C", "12C 14N"]
 
-    for mims_image in mims_image_set.mims_images.all():
-        short_name = mims_image.file.name.split("/")[-1]
-        print(f"Processing image {short_name}")
-        try:
-            mims = sims.SIMS(mims_image.file.path)
-        except:
-            print(f"Error processing image {short_name}")
-            mims_image.delete()
-            continue
-        is_valid_file = (
-            mims and (mims.data is not None) and (mims.data.species is not None)
-        )
-        if not is_valid_file:
-            mims_image.status = MIMSImage.Status.INVALID_FILE
-            mims_image.save()
-            continue
-        mims_meta = mims.header["Image"]
-        mims_pixel_size = mims_meta["raster"] / mims_meta["width"]
-        mims_image.pixel_size_nm = mims_pixel_size
+    mims_image = MIMSImage.objects.get(id=mims_image_id)
+    mims_image_set = mims_image.image_set
+    short_name = mims_image.file.name.split("/")[-1]
+    print(f"Processing image {short_name}")
+    try:
+        mims = ImFile(mims_image.file.path)
+    except ValueError:
+        mims_image.status = MIMSImage.Status.INVALID_FILE
         mims_image.save()
-        all_species = mims.data.species.values
+        return None
+    except:
+        print(f"Error processing image {short_name}")
+        mims_image.delete()
+        return None
+    if not mims_image.header_info:
+        mims_image.header_info = extract_header_info(mims.header)
+    mims_image.pixel_size_nm = mims.pixel_size_nm
+    mims_image.save()
+    all_species = get_species_names(mims_image.file.path, mims=mims)
 
-        image_dts[mims_image.id] = mims.header["date"]
+    # Estimate the plane drift once and reuse it for every species
+    tmats = mims_image.get_stack_tmats(StackReg.AFFINE)
+    if SHARED_STACK_TRANSFORMS and tmats is None:
+        reference, tmats = load_stack_transforms(
+            mims_image.file.path, StackReg.AFFINE, mims=mims
+        )
+        mims_image.stack_transforms = {
+            "reference": reference,
+            "mode": StackReg.AFFINE,
+            "tmats": tmats.tolist(),
+        }
+        mims_image.save(update_fields=["stack_transforms"])
 
-        # Define the path for saving in tmp_images
-        canvas_id = str(mims_image.image_set.canvas.id)
-        isotope_image_dir = os.path.join(
-            settings.MEDIA_ROOT,
-            "tmp_images",
-            canvas_id,
-            str(mims_image_set.id),
-            "mims_images",
-            mims_image.file.name.split(".")[0].split("/")[-1],
-            "isotopes",
+    # Define the path for saving in tmp_images
+    canvas_id = str(mims_image.image_set.canvas.id)
+    isotope_image_dir = os.path.join(
+        settings.MEDIA_ROOT,
+        "tmp_images",
+        canvas_id,
+        str(mims_image_set.id),
+        "mims_images",
+        mims_image.file.name.split(".")[0].split("/")[-1],
+        "isotopes",
+    )
+    if not os.path.exists(isotope_image_dir):
+        os.makedirs(isotope_image_dir)
+    for species in all_species:
+        iso = Isotope.objects.get_or_create(name=species)
+        mims_image.isotopes.add(iso[0])
+        # Extract and save the isotope image as a png
+        species_summed = load_species_summed(
+            mims_image.file.path, species, mims=mims, tmats=tmats
         )
-        if not os.path.exists(isotope_image_dir):
-            os.makedirs(isotope_image_dir)
-        for species in all_species:
-            iso = Isotope.objects.get_or_create(name=species)
-            mims_image.isotopes.add(iso[0])
-            # Extract and save the isotope image as a png
-            species_summed = get_species_summed(mims, species)
-            image_path = os.path.join(isotope_image_dir, f"{species}.png")
-            img = Image.fromarray(species_summed)
-            img.save(image_path)
-            vmin, vmax = np.percentile(species_summed, (1, 99))
-            autocontrast = exposure.rescale_intensity(
-                species_summed, in_range=(vmin, vmax), out_range=(0, 255)
-            ).astype(np.uint8)
-            autocontrast_path = os.path.join(
-                isotope_image_dir, f"{species}_autocontrast.png"
+        image_path = os.path.join(isotope_image_dir, f"{species}.png")
+        img = Image.fromarray(species_summed)
+        img.save(image_path)
+        vmin, vmax = np.percentile(species_summed, (1, 99))
+        autocontrast = exposure.rescale_intensity(
+            species_summed, in_range=(vmin, vmax), out_range=(0, 255)
+        ).astype(np.uint8)
+        autocontrast_path = os.path.join(
+            isotope_image_dir, f"{species}_autocontrast.png"
+        )
+        img = Image.fromarray(autocontrast)
+        img.save(autocontrast_path)
+    species_12c = next(
+        (name for name in possible_12c_names if name in all_species), None
+    )
+    species_13c = next(
+        (name for name in possible_13c_names if name in all_species), None
+    )
+    if species_12c and species_13c:
+        c12_im = np.copy(
+            np.asarray(
+                Image.open(os.path.join(isotope_image_dir, f"{species_12c}.png"))
             )
-            img = Image.fromarray(autocontrast)
-            img.save(autocontrast_path)
-        species_12c = next(
-            (name for name in possible_12c_names if name in all_species), None
         )
-        species_13c = next(
-            (name for name in possible_13c_names if name in all_species), None
+        c13_im = np.asarray(
+            Image.open(os.path.join(isotope_image_dir, f"{species_13c}.png"))
         )
-        if species_12c and species_13c:
-            c12_im = np.copy(
-                np.asarray(
-                    Image.open(os.path.join(isotope_image_dir, f"{species_12c}.png"))
-                )
-            )
-            c13_im = np.asarray(
-                Image.open(os.path.join(isotope_image_dir, f"{species_13c}.png"))
+        c12_im[c12_im == 0] = 1
+        ratio = Image.fromarray(
+            (np.divide(c13_im, c12_im) * 10000).astype(np.uint16)
+        )
+        ratio.save(os.path.join(isotope_image_dir, "13C12C_ratio.png"))
+
+    species_15n = next(
+        (name for name in possible_15n_names if name in all_species), None
+    )
+    species_14n = next(
+        (name for name in possible_14n_names if name in all_species), None
+    )
+    if species_15n and species_14n:
+        n15_im = np.copy(
+            np.asarray(
+                Image.open(os.path.join(isotope_image_dir, f"{species_15n}.png"))
             )
-            c12_im[c12_im == 0] = 1
-            ratio = Image.fromarray(
-                (np.divide(c13_im, c12_im) * 10000).astype(np.uint16)
+        )
+        n14_im = np.copy(
+            np.asarray(
+                Image.open(os.path.join(isotope_image_dir, f"{species_14n}.png"))
             )
-            ratio.save(os.path.join(isotope_image_dir, "13C12C_ratio.png"))
-
-        species_15n = next(
-            (name for name in possible_15n_names if name in all_species), None
         )
-        species_14n = next(
-            (name for name in possible_14n_names if name in all_species), None
+        n14_im[n14_im == 0] = 1
+        ratio = Image.fromarray(
+            (np.divide(n15_im, n14_im) * 10000).astype(np.uint16)
         )
-        if species_15n and species_14n:
-            n15_im = np.copy(
-                np.asarray(
-                    Image.open(os.path.join(isotope_image_dir, f"{species_15n}.png"))
-                )
-            )
-            n14_im = np.copy(
-                np.asarray(
-                    Image.open(os.path.join(isotope_image_dir, f"{species_14n}.png"))
-                )
-            )
-            n14_im[n14_im == 0] = 1
-            ratio = Image.fromarray(
-                (np.divide(n15_im, n14_im) * 10000).astype(np.uint16)
-            )
-            ratio.save(os.path.join(isotope_image_dir, "15N14N_ratio.png"))
-        mims_image.status = MIMSImage.Status.PREPROCESSED
-        mims_image.save()
+        ratio.save(os.path.join(isotope_image_dir, "15N14N_ratio.png"))
+    mims_image.status = MIMSImage.Status.PREPROCESSED
+    mims_image.save()
+
+    return {"id": str(mims_image.id), "date": mims_image.header_info["date"]}
+
+
+@shared_task
+def finalize_mims_image_set(results, mims_image_set_id):
+    """Chord callback: order the set by acquisition date and build composites."""
+    MIMSImageSet = apps.get_model("mims", "MIMSImageSet")
+    mims_image_set = MIMSImageSet.objects.get(id=mims_image_set_id)
+
+    possible_12c_names = ["12C", "12C2"]
+    possible_13c_names = ["13C", "12C 13C"]
+    possible_15n_names = ["15N 12C", "12C 15N"]
+    possible_14n_names = ["14N 12C", "12C 14N"]
+
+    image_dts = {result["id"]: result["date"] for result in results if result}
 
     # Use the image dts to determine priority number, earlier being better and save as image_set_priority on the mims_image
-    ordered_dts = sorted(image_dts.items(), key=lambda x: x[1])
+    # Images without an acquisition date go last
+    ordered_dts = sorted(image_dts.items(), key=lambda x: (x[1] is None, x[1] or ""))
     for i, (mims_image_id, _) in enumerate(ordered_dts):
         mims_image = MIMSImage.objects.get(id=mims_image_id)
         mims_image.image_set_priority = i
@@ -178,20 +247,9 @@ def preprocess_mims_image_set(mims_image_set_id):
         id_url = os.path.join("http://localhost:8000/media", relative_dir)
 
         # Save the DZI file directly to the target directory
-        if img.width <= 512 and img.height <= 512:
-            img.dzsave(
-                os.path.join(output_dir, isotope + ".dzi"),
-                id=id_url,
-                tile_size=512,
-                depth="one",
-                layout=pyvips.enums.ForeignDzLayout.IIIF3,
-            )
-        else:
-            img.dzsave(
-                os.path.join(output_dir, isotope + ".dzi"),
-                id=id_url,
-                layout=pyvips.enums.ForeignDzLayout.IIIF3,
-            )
+        save_dzi(
+            img, os.path.join(output_dir, isotope + ".dzi"), id_url, profile="composite"
+        )
 
         # Create or update MIMSOverlay record for this isotope
         isotope_obj = Isotope.objects.get(name=isotope)
@@ -231,7 +289,7 @@ def estimate_mims_alignment(mims_image_id):
     if confirmed_aligned_images.exists():
         confirmed_alignment = (
             confirmed_aligned_images.first()
-            .alignments.filter(status__in=["ROUGH", "COMPLETE"])
+            .alignments.filter(status__in=CONFIRMED_ALIGNMENT_STATUSES)
             .first()
         )
         mims_image.status = MIMSImage.Status.REGISTERING
@@ -250,6 +308,21 @@ def estimate_mims_alignment(mims_image_id):
         mims_image.save()
 
 
+@shared_task
+def propagate_mims_alignment(mims_image_id):
+    """
+    Estimate FROM_SET alignments for every unconfirmed image in the set of
+    mims_image from its confirmed alignment.
+    """
+    mims_image = MIMSImage.objects.get(id=mims_image_id)
+    confirmed_alignment = mims_image.alignments.filter(
+        status__in=CONFIRMED_ALIGNMENT_STATUSES
+    ).first()
+    if not confirmed_alignment:
+        return
+    propagate_confirmed_alignment(confirmed_alignment)
+
+
 @shared_task
 def orient_viewset_task(mims_image_set_obj_id, viewset_points, isotope):
     mims_image_set = get_object_or_404(MIMSImageSet, pk=mims_image_set_obj_id)
@@ -267,3 +340,25 @@ def create_registration_images_task(mims_image_obj_id):
 @shared_task
 def register_images_task(mims_image_obj_id):
     register_images(mims_image_obj_id)
+
+
+@shared_task
+def create_mims_overlay(mims_image_set_id, isotope):
+    """
+    Render the overlay of one isotope of a registered image set.
+
+    Returns:
+        list: [isotope, DZI path] or None if nothing was rendered
+    """
+    mims_image_set = MIMSImageSet.objects.get(id=mims_image_set_id)
+    dzi_relative_path = create_isotope_overlay(mims_image_set, isotope)
+    if dzi_relative_path is None:
+        return None
+    return [isotope, dzi_relative_path]
+
+
+@shared_task
+def save_mims_overlays(results, mims_image_set_id):
+    """Chord callback of create_registered_overlays, saves the MIMSOverlay rows."""
+    mims_image_set = MIMSImageSet.objects.get(id=mims_image_set_id)
+    save_overlays(mims_image_set, dict(result for result in results if result))
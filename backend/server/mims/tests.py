@@ -1,3 +1,205 @@
-from django.test import TestCase
+import numpy as np
+from django.test import SimpleTestCase
+from skimage.transform import ThinPlateSplineTransform
 
-# Create your tests here.
+from mims.services.fft_alignment import score_translations
+from mims.services.image_utils import correct_inner_zeros
+from mims.services.register import evaluate_tps_grid
+
+
+def _correct_inner_zeros_loop(original_array):
+    """The pixel loop correct_inner_zeros replaced, kept as the reference."""
+    array = original_array.astype(np.uint8)
+    array = np.where(array == 0, 1, array)
+    for y in range(0, array.shape[0] - 1):
+        for x in range(0, array.shape[1] - 1):
+            if array[y][x] not in [1]:
+                break
+            array[y][x] = 0
+        for x in range(array.shape[1] - 1, 0, -1):
+            if array[y][x] not in [1]:
+                break
+            array[y][x] = 0
+    for x in range(0, array.shape[1] - 1):
+        for y in range(0, array.shape[0] - 1):
+            if array[y][x] not in [1]:
+                break
+            array[y][x] = 0
+        for y in range(array.shape[0] - 1, 0, -1):
+            if array[y][x] not in [1]:
+                break
+            array[y][x] = 0
+    return array
+
+
+def _section(shape, seed):
+    """Random section on a zero border, with sparse zeros and ones inside."""
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 4, shape, dtype=np.uint8)
+    yy, xx = np.mgrid[0 : shape[0], 0 : shape[1]]
+    image[np.hypot(yy - shape[0] / 2, xx - shape[1] / 2) > min(shape) / 3] = 0
+    return image
+
+
+class CorrectInnerZerosTests(SimpleTestCase):
+    def assert_matches_loop(self, image):
+        np.testing.assert_array_equal(
+            correct_inner_zeros(image), _correct_inner_zeros_loop(image)
+        )
+
+    def test_matches_loop_on_sections(self):
+        for seed, shape in enumerate([(40, 40), (33, 57), (64, 21)]):
+            with self.subTest(shape=shape):
+                self.assert_matches_loop(_section(shape, seed))
+
+    def test_matches_loop_on_noise(self):
+        # Zeros and ones reaching every edge, including the last row and column
+        # that the scans leave out
+        rng = np.random.default_rng(7)
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                self.assert_matches_loop(rng.integers(0, 3, (25, 30)))
+
+    def test_matches_loop_on_edge_cases(self):
+        for image in [
+            np.zeros((5, 6)),
+            np.full((5, 6), 9),
+            np.zeros((1, 8)),
+            np.zeros((8, 1)),
+            np.arange(30).reshape(5, 6) % 2,
+        ]:
+            with self.subTest(image=image.tolist()):
+                self.assert_matches_loop(image.astype(np.uint8))
+
+    def test_inner_zeros_become_ones(self):
+        image = np.zeros((7, 7), dtype=np.uint8)
+        image[1:6, 1:6] = 200
+        image[3, 3] = 0
+        corrected = correct_inner_zeros(image)
+        self.assertEqual(corrected[3, 3], 1)
+        self.assertEqual(corrected[0, 0], 0)
+        self.assertEqual(corrected[2, 2], 200)
+
+
+def _sliding_iou(im1, im2, valid_im1, valid_im2, x, y):
+    """IoU of one placement, counted the way do_sliding_search does."""
+    im1_slice = im1[y : y + im2.shape[0], x : x + im2.shape[1]] > 0
+    valid_mask = valid_im1[y : y + im2.shape[0], x : x + im2.shape[1]] & valid_im2
+    intersection = np.logical_and(im1_slice, im2 > 0).sum()
+    union = np.logical_and(valid_mask, np.logical_or(im1_slice, im2 > 0)).sum()
+    return intersection, union, valid_mask.sum()
+
+
+class ScoreTranslationsTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.im1 = np.where(rng.random((60, 80)) > 0.5, 255, 0).astype(np.uint8)
+        self.im1[:, :6] = 0
+        self.valid_im1 = np.ones(self.im1.shape, dtype=bool)
+        self.valid_im1[:, :6] = False
+        self.x, self.y = 31, 17
+        self.im2 = self.im1[self.y : self.y + 20, self.x : self.x + 25].copy()
+        self.valid_im2 = np.ones(self.im2.shape, dtype=bool)
+
+    def scores(self, **kwargs):
+        kwargs = {"min_valid": 100, "min_union": 20, **kwargs}
+        return score_translations(
+            self.im1, self.im2, self.valid_im1, self.valid_im2, **kwargs
+        )
+
+    def test_peak_at_the_crop_location(self):
+        scores = self.scores()
+        self.assertEqual(scores.shape, (41, 56))
+        y, x = np.unravel_index(np.argmax(scores), scores.shape)
+        self.assertEqual((x, y), (self.x, self.y))
+        self.assertAlmostEqual(float(scores[y, x]), 1.0, places=5)
+        # Random foreground has no second placement anywhere near as good
+        scores[y, x] = -1
+        self.assertLess(scores.max(), 0.6)
+
+    def test_scores_match_the_sliding_search(self):
+        scores = self.scores()
+        for x, y in [(0, 0), (3, 40), (12, 5), (self.x, self.y), (55, 40)]:
+            with self.subTest(x=x, y=y):
+                intersection, union, valid = _sliding_iou(
+                    self.im1, self.im2, self.valid_im1, self.valid_im2, x, y
+                )
+                if valid < 100 or union < 20 or intersection / valid > 0.8:
+                    self.assertEqual(scores[y, x], -1)
+                else:
+                    self.assertAlmostEqual(
+                        float(scores[y, x]), intersection / union, places=5
+                    )
+
+    def test_rejects_too_few_valid_pixels(self):
+        # Placements over the invalid left margin have fewer valid pixels
+        scores = self.scores(min_valid=self.im2.size)
+        self.assertTrue((scores[:, :6] == -1).all())
+        self.assertGreater(scores[self.y, self.x], 0)
+
+    def test_rejects_implausibly_high_overlap(self):
+        self.im2[:] = 255
+        self.im1[self.y : self.y + 20, self.x : self.x + 25] = 255
+        scores = self.scores()
+        self.assertEqual(scores[self.y, self.x], -1)
+
+
+def _tps(size, landmarks, seed=0):
+    """TPS through random landmarks on a smoothly distorted canvas."""
+    rng = np.random.default_rng(seed)
+    src = rng.uniform(0, size, (landmarks, 2))
+    dst = src + np.column_stack(
+        [6 * np.sin(src[:, 1] / size * 3), 5 * np.cos(src[:, 0] / size * 2)]
+    )
+    dst += rng.normal(0, 0.5, src.shape)
+    tps = ThinPlateSplineTransform()
+    tps.estimate(dst, src)
+    return tps
+
+
+class EvaluateTpsGridTests(SimpleTestCase):
+    rows, cols = 90, 120
+
+    def dense(self, tps):
+        grid = np.stack(np.meshgrid(np.arange(self.cols), np.arange(self.rows)), -1)
+        return tps(grid.reshape(-1, 2).astype(float)).reshape(self.rows, self.cols, 2)
+
+    def test_error_within_tolerance(self):
+        for landmarks in [6, 20]:
+            tps = _tps(self.cols, landmarks)
+            dense = self.dense(tps)
+            for tolerance in [0.5, 0.05]:
+                with self.subTest(landmarks=landmarks, tolerance=tolerance):
+                    coords, report = evaluate_tps_grid(
+                        tps, self.rows, self.cols, 8, tolerance
+                    )
+                    self.assertEqual(coords.shape, (self.rows, self.cols, 2))
+                    error = np.linalg.norm(coords - dense, axis=-1).max()
+                    self.assertLessEqual(error, tolerance)
+                    self.assertLessEqual(report["max_error"], tolerance)
+
+    def test_tighter_tolerance_evaluates_more_pixels_densely(self):
+        tps = _tps(self.cols, 20)
+        fractions = [
+            evaluate_tps_grid(tps, self.rows, self.cols, 8, tolerance)[1][
+                "dense_fraction"
+            ]
+            for tolerance in [None, 0.5, 0.05]
+        ]
+        self.assertEqual(fractions[0], 0.0)
+        self.assertLess(fractions[0], fractions[1])
+        self.assertLess(fractions[1], fractions[2])
+        self.assertLess(fractions[2], 1.0)
+
+    def test_interpolation_only_without_tolerance(self):
+        tps = _tps(self.cols, 20)
+        coords, report = evaluate_tps_grid(tps, self.rows, self.cols, 8, None)
+        error = np.linalg.norm(coords - self.dense(tps), axis=-1).max()
+        self.assertGreater(report["max_error"], 0.5)
+        self.assertAlmostEqual(error, report["max_error"], delta=0.1)
+
+    def test_small_step_is_exact(self):
+        tps = _tps(self.cols, 6)
+        coords, report = evaluate_tps_grid(tps, self.rows, self.cols, 1, 0.05)
+        np.testing.assert_allclose(coords, self.dense(tps), atol=1e-9)
+        self.assertEqual(report, {"max_error": 0.0, "step": 1, "dense_fraction": 1.0})
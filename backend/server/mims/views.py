@@ -1,5 +1,5 @@
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 import json
@@ -15,10 +15,12 @@ from .serializers import MIMSImageSetSerializer, MIMSImageSerializer
 from .tasks import (
     create_registration_images_task,
     preprocess_mims_image_set,
+    propagate_mims_alignment,
     register_images_task,
     orient_viewset_task,
 )
 from mims.services.register import register_images
+from mims.services.create_overlays import get_overlay_png
 from mims.services.orient_images import orient_viewset
 import os
 from PIL import Image
@@ -55,11 +57,16 @@ class MIMSImageSetViewSet(viewsets.ModelViewSet):
         for file_key in data.keys():
             if file_key.startswith("file_"):
                 file = data[file_key]
-                MIMSImage.objects.create(
+                mims_image = MIMSImage.objects.create(
                     canvas=canvas,
                     image_set=image_set,
                     file=file,
                 )
+                # Store the header fields now so later steps never re-parse the file
+                try:
+                    mims_image.get_header_info()
+                except Exception as e:
+                    print(f"Could not read header of {mims_image.file.name}: {e}")
         preprocess_mims_image_set.delay(image_set.id)
 
         serializer = MIMSImageSetSerializer(image_set)
@@ -74,6 +81,22 @@ class MIMSImageSetViewSet(viewsets.ModelViewSet):
         orient_viewset_task.delay(mims_image_set.id, viewset_points, isotope)
         return Response(status=status.HTTP_200_OK)
 
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path=r"overlays/(?P<isotope>[^/]+)/image.png",
+    )
+    def overlay_png(self, request, pk=None, isotope=None):
+        """Full-resolution PNG of an overlay, written on its first request"""
+        mims_image_set = self.get_object()
+        png_path = get_overlay_png(mims_image_set, isotope)
+        if png_path is None:
+            return Response(
+                {"error": f"No full-resolution {isotope} overlay"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        return FileResponse(open(png_path, "rb"), content_type="image/png")
+
 
 class MIMSImageViewSet(viewsets.ModelViewSet):
     queryset = MIMSImage.objects.all()
@@ -105,17 +128,21 @@ class MIMSImageViewSet(viewsets.ModelViewSet):
 
         # Prepare predictors for each possible image_key and 'em'
         image_keys = isotopes + ["em"]
-        em = np.array(Image.open(mims_image.canvas.images.first().file.path))
+        em_image = mims_image.canvas.images.first()
         predictor = SAM2ImagePredictor(sam2_model)
 
         for image_key in image_keys:
             predictor_key = f"{pk}_{image_key}"
             if predictor_key not in predictors:
                 if image_key != "em":
-                    image = image_from_im_file(mims_image.file.path, image_key, True)
+                    image = image_from_im_file(
+                        mims_image.file.path,
+                        image_key,
+                        True,
+                        tmats=mims_image.get_stack_tmats(),
+                    )
                 else:
-                    em_cropped = em[em_bbox[1] : em_bbox[3], em_bbox[0] : em_bbox[2]]
-                    image = em_cropped
+                    image = em_image.crop(*em_bbox)
                 # Convert image to 3 channels if it's single-channel
                 if image.ndim == 2:  # If the image is grayscale
                     image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
@@ -123,9 +150,6 @@ class MIMSImageViewSet(viewsets.ModelViewSet):
                 print(f"Setting image for {predictor_key}")
                 predictor.set_image(image)
                 predictors[predictor_key] = predictor
-        full_em_predictor = SAM2ImagePredictor(sam2_model)
-        full_em_predictor.set_image(em)
-        predictors[f"{pk}_em"] = full_em_predictor
 
         return Response(status=status.HTTP_200_OK)
 
@@ -163,6 +187,8 @@ class MIMSImageViewSet(viewsets.ModelViewSet):
         )
 
         create_registration_images_task.delay(mims_image.id)
+        # Place the rest of the set from this alignment
+        propagate_mims_alignment.delay(mims_image.id)
         mims_image.status = MIMSImage.Status.REGISTERING
         mims_image.save()
 
@@ -186,11 +212,14 @@ class MIMSImageViewSet(viewsets.ModelViewSet):
 
         if predictor_key not in predictors:
             if image_key != "em":
-                image = image_from_im_file(mims_image.file.path, image_key, True)
+                image = image_from_im_file(
+                    mims_image.file.path,
+                    image_key,
+                    True,
+                    tmats=mims_image.get_stack_tmats(),
+                )
             else:
-                em = np.array(Image.open(mims_image.canvas.images.first().file.path))
-                em_cropped = em[em_bbox[1] : em_bbox[3], em_bbox[0] : em_bbox[2]]
-                image = em_cropped
+                image = mims_image.canvas.images.first().crop(*em_bbox)
             # Convert image to 3 channels if it's single-channel
             if image.ndim == 2:  # If the image is grayscale
                 image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
@@ -319,7 +348,11 @@ class MIMSImageViewSet(viewsets.ModelViewSet):
 
         try:
             image_data = image_from_im_file(
-                mims_image.file.path, species, autocontrast, binarize
+                mims_image.file.path,
+                species,
+                autocontrast,
+                binarize,
+                tmats=mims_image.get_stack_tmats(),
             )
             response = HttpResponse(content_type="image/png")
             Image.fromarray(image_data).save(response, format="PNG")
@@ -8,7 +8,7 @@ from core.models import Canvas
 from mims.models import MIMSImage, MIMSImageSet
 from image.models import Image
 from mims.tasks import preprocess_mims_image_set, register_images_task
-from image.tasks import convert_to_dzi_format
+from image.tasks import convert_to_dzi_format, create_pyramid_tiff
 import time
 
 
@@ -57,6 +57,13 @@ def process_canvas_registration(canvas_id, force_reprocess=False):
         print("\n🖼️  Step 2: Processing EM image...")
         start_time = time.time()
 
+        if not em_image.pyramid_file or force_reprocess:
+            print("   → Creating EM pyramid TIFF...")
+            create_pyramid_tiff(em_image.id)
+            em_image.refresh_from_db()
+            print("   ✓ EM pyramid TIFF created")
+            status["files_created"].append(f"EM pyramid: {em_image.pyramid_file.name}")
+
         if (
             not em_image.dzi_file
             or not os.path.exists(em_image.dzi_file.path)
@@ -123,7 +130,7 @@ def process_canvas_registration(canvas_id, force_reprocess=False):
             )
 
             if needs_preprocessing:
-                preprocess_mims_image_set(mims_set.id)
+                preprocess_mims_image_set(mims_set.id, fan_out=False)
                 print("   ✓ Isotopes extracted and composite DZI files created")
 
                 # List created files
@@ -218,7 +225,7 @@ def process_canvas_registration(canvas_id, force_reprocess=False):
                     time.time() - start_time
                 )
                 # create registered overlay
-                create_registered_overlays(mims_set)
+                create_registered_overlays(mims_set, fan_out=False)
 
         status["steps_completed"].append("mims_processing")
 
@@ -7,7 +7,8 @@ from .png_conversion import convert_to_compressed_png
 from .image_filters import apply_sobel_filter, load_tiff_file
 
 # SAM2 segmentation
-from .sam2_segmentation import run_sam2_segmentation
+from .sam2_segmentation import label_mask_image, run_sam2_segmentation, set_torch_threads
+from .sam_models import get_mobile_sam, get_model_stats, preload_mobile_sam
 
 # Main processing entry points
 from .segmentation_processing import (
@@ -26,6 +27,11 @@ __all__ = [
     "load_tiff_file",
     # SAM2 segmentation
     "run_sam2_segmentation",
+    "label_mask_image",
+    "set_torch_threads",
+    "get_mobile_sam",
+    "get_model_stats",
+    "preload_mobile_sam",
     # Main processing entry points
     "process_segmentation_file",
     "process_segmentation_file_with_progress",
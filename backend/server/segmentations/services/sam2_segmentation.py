@@ -1,18 +1,166 @@
 """MobileSAM segmentation with tiled processing for large images."""
 
 import logging
+import os
+import tempfile
 import time
 import traceback
 
+import billiard
+import django
+
 import numpy as np
+import pyvips
 import torch
-from mobile_sam import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from django.conf import settings
+from mobile_sam import SamAutomaticMaskGenerator, SamPredictor
+from mobile_sam.utils.transforms import ResizeLongestSide
+
+from .sam_models import get_device, get_mobile_sam
+from .tile_merge import merge_tiles
 
 logger = logging.getLogger(__name__)
 
+# Tiles encoded together in one image encoder forward pass on CPU
+TILE_BATCH = getattr(settings, "MOBILE_SAM_TILE_BATCH", 4)
+# Point prompts decoded together in one mask decoder forward pass
+POINTS_PER_BATCH = getattr(settings, "MOBILE_SAM_POINTS_PER_BATCH", 256)
+# torch threads per segmentation process, 0 meaning the cores split between them
+NUM_THREADS = getattr(settings, "MOBILE_SAM_NUM_THREADS", 0)
+# Processes the tiles of a large image are spread over, each with its own model
+TILE_WORKERS = getattr(settings, "MOBILE_SAM_TILE_WORKERS", 4)
+# Where the memory-mapped tile masks of a run are kept until they are merged
+# (the canvas mask goes wherever the caller asks, see output_path)
+SCRATCH_DIR = getattr(settings, "SEGMENTATION_SCRATCH_DIR", None)
+
+# pyvips band formats of the label mask dtypes
+_VIPS_FORMATS = {"uint8": "uchar", "uint16": "ushort", "uint32": "uint"}
+
+
+class _EncodedPredictor(SamPredictor):
+    """SamPredictor whose image embedding can be set from a batched encoder pass."""
+
+    def set_features(self, features, original_size, input_size):
+        self.reset_image()
+        self.features = features
+        self.original_size = original_size
+        self.input_size = input_size
+        self.is_image_set = True
+
+    def set_image(self, image, image_format="RGB"):
+        # SamAutomaticMaskGenerator sets the image of every crop; keep the
+        # embedding of set_features instead of encoding the tile again
+        if not self.is_image_set:
+            super().set_image(image, image_format)
+
+
+def _make_mask_generator(model, points_per_side, min_mask_region_area):
+    mask_generator = SamAutomaticMaskGenerator(
+        model=model,
+        points_per_side=points_per_side,
+        points_per_batch=POINTS_PER_BATCH,
+        pred_iou_thresh=0.8,
+        stability_score_thresh=0.92,
+        crop_n_layers=0,
+        min_mask_region_area=min_mask_region_area,
+    )
+    mask_generator.predictor = _EncodedPredictor(model)
+    return mask_generator
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def set_torch_threads(num_threads: int = NUM_THREADS) -> int:
+    """Set the intra-op threads torch uses, see MOBILE_SAM_NUM_THREADS."""
+    num_threads = num_threads or _cpu_count()
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+
+def _in_process_threads() -> int:
+    """
+    torch threads for segmenting in the calling process: MOBILE_SAM_NUM_THREADS,
+    or the worker process's share of the cores set when it started.
+    """
+    if NUM_THREADS:
+        torch.set_num_threads(NUM_THREADS)
+    return torch.get_num_threads()
+
+
+def _to_rgb_uint8(image_array: np.ndarray) -> np.ndarray:
+    """HWC uint8 RGB version of a grayscale or RGB image."""
+    if len(image_array.shape) == 2:
+        # Grayscale to RGB
+        image_rgb = np.stack([image_array, image_array, image_array], axis=-1)
+    else:
+        image_rgb = image_array
+
+    if image_rgb.dtype != np.uint8:
+        # Normalize to 0-255 uint8
+        if image_rgb.max() <= 1:
+            image_rgb = (image_rgb * 255).astype(np.uint8)
+        else:
+            image_rgb = image_rgb.astype(np.uint8)
+    return image_rgb
+
+
+def _encode_tiles(model, tiles_rgb, device):
+    """
+    Image embeddings of several tiles from one image encoder forward pass.
+
+    Each tile is resized and normalized like SamPredictor.set_image does, and
+    padded to the encoder's square input, so tiles of different sizes (at the
+    image edges) stack into one batch.
+
+    Returns:
+        tuple: (features (N, C, H, W) tensor, list of input sizes)
+    """
+    transform = ResizeLongestSide(model.image_encoder.img_size)
+    inputs, input_sizes = [], []
+    for tile_rgb in tiles_rgb:
+        image = torch.as_tensor(transform.apply_image(tile_rgb), device=device)
+        image = image.permute(2, 0, 1).contiguous()[None, :, :, :]
+        input_sizes.append(tuple(image.shape[-2:]))
+        inputs.append(model.preprocess(image))
+    return model.image_encoder(torch.cat(inputs)), input_sizes
+
+
+def segment_tiles(tiles, mask_generator, device, tile_batch=TILE_BATCH):
+    """
+    Label masks of an iterable of tiles, tile_batch tiles at a time.
+
+    The tiles of a batch go through the image encoder together; the point grid
+    of each tile is then decoded from its embedding. Run it inside
+    torch.inference_mode().
+
+    Yields:
+        numpy.ndarray: uint16 label mask of each tile, in order
+    """
+    tiles = iter(tiles)
+    while True:
+        batch = [_to_rgb_uint8(tile) for _, tile in zip(range(tile_batch), tiles)]
+        if not batch:
+            return
+        features, input_sizes = _encode_tiles(mask_generator.predictor.model, batch, device)
+        for i, tile_rgb in enumerate(batch):
+            mask_generator.predictor.set_features(
+                features[i : i + 1], tile_rgb.shape[:2], input_sizes[i]
+            )
+            yield _process_mobile_sam_single_image(tile_rgb, mask_generator, device)
+        del features
+
 
 def run_sam2_segmentation(
-    image_array: np.ndarray, tile_size: int = 2048, overlap: int = 256
+    image_array: np.ndarray,
+    tile_size: int = 2048,
+    overlap: int = 256,
+    stats: dict = None,
+    output_path: str = None,
 ) -> np.ndarray:
     """
     Run MobileSAM automatic segmentation on an image with tiled processing for large images.
@@ -24,278 +172,298 @@ def run_sam2_segmentation(
         image_array: Input image as numpy array (grayscale uint8)
         tile_size: Size of tiles to process (default 2048)
         overlap: Overlap between tiles in pixels (default 256)
+        stats: Optional dict filled in with the tile count, time, tiles per
+            second, tile batch and torch threads of the run
+        output_path: Optional .npy file the mask of a tiled run is memory-mapped
+            to, instead of being held in memory (see label_mask_image)
 
     Returns:
-        Combined mask image as uint8 or uint16 where each detected object has a unique value
+        Combined mask image as uint8, uint16 or uint32 where each detected object has a unique value
     """
-    import os
-
     print(f"\n{'='*60}")
     print(f"[MobileSAM] Function entered, image shape: {image_array.shape}")
     print(f"{'='*60}\n")
 
-    # Force PyTorch to use MPS if available
-    if torch.backends.mps.is_available():
-        os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
-        logger.info("Enabled MPS fallback for PyTorch")
-
     try:
-        print("[MobileSAM] Starting segmentation...")
-
-        # Get original dimensions
-        print("[MobileSAM] Getting image dimensions...")
-        if len(image_array.shape) == 2:
-            height, width = image_array.shape
-            is_grayscale = True
-        else:
-            height, width = image_array.shape[:2]
-            is_grayscale = False
-        print(f"[MobileSAM] Image: {width}x{height}, grayscale={is_grayscale}")
-
-        # Get device (prefer CUDA, then MPS, then CPU)
-        # MobileSAM is lightweight and works well on MPS
-        print("[MobileSAM] Checking device availability...")
-        if torch.cuda.is_available():
-            device = torch.device("cuda")
-            print("[MobileSAM] Using CUDA GPU")
-        elif torch.backends.mps.is_available():
-            device = torch.device("mps")
-            # MPS doesn't support float64, so set default to float32
-            torch.set_default_dtype(torch.float32)
-            print("[MobileSAM] Using MPS (Apple Silicon GPU) with float32")
-        else:
-            device = torch.device("cpu")
-            print("[MobileSAM] Using CPU")
+        with torch.inference_mode():
+            return _run_sam2_segmentation(
+                image_array, tile_size, overlap, stats, output_path
+            )
+    except Exception as e:
+        logger.error(f"Error running MobileSAM segmentation: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise
 
-        # Build MobileSAM model
-        model_type = "vit_t"  # MobileSAM uses ViT-Tiny
-        checkpoint = (
-            "/Users/chris/Documents/lab/emAnalysis/backend/server/mobile_sam.pt"
-        )
 
-        print(f"[MobileSAM] Loading model from {checkpoint}...")
-        mobile_sam = sam_model_registry[model_type](checkpoint=checkpoint)
-        print(f"[MobileSAM] Model loaded, moving to device: {device}...")
-        mobile_sam.to(device=device)
-
-        # For MPS, we need to patch the model to handle float32
-        if device.type == "mps":
-            print("[MobileSAM] Patching model for MPS float32 compatibility...")
-            mobile_sam = mobile_sam.float()  # Ensure model is float32
-
-        print(f"[MobileSAM] Model on device, setting to eval mode...")
-        mobile_sam.eval()
-        print(f"[MobileSAM] Model ready!")
-
-        # Adjust tile size and parameters for MPS to avoid OOM
-        if device.type == "mps":
-            tile_size = 1024  # Smaller tiles for MPS
-            overlap = 128
-            points_per_side_single = 16  # Fewer points for MPS
-            points_per_side_tile = 12
-            print(f"[MobileSAM] Using MPS-optimized settings: tile_size={tile_size}, points={points_per_side_tile}")
-        else:
-            points_per_side_single = 32
-            points_per_side_tile = 24
-
-        # Check if tiling is needed
-        needs_tiling = width > tile_size or height > tile_size
-        print(f"[MobileSAM] Needs tiling: {needs_tiling} (image {width}x{height}, tile size {tile_size})")
-
-        if not needs_tiling:
-            # Small image - process directly
-            print("[MobileSAM] Image fits in single tile, processing directly")
-            logger.info("Image fits in single tile, processing directly")
-            # Create mask generator for single image
-            mask_generator = SamAutomaticMaskGenerator(
-                model=mobile_sam,
-                points_per_side=points_per_side_single,
-                pred_iou_thresh=0.8,
-                stability_score_thresh=0.92,
-                crop_n_layers=0,
-                min_mask_region_area=100,
-            )
-            return _process_mobile_sam_single_image(image_array, mask_generator, device)
-
-        # Large image - use tiled processing
-        print(f"[MobileSAM] Large image - using tiled processing ({tile_size}x{tile_size} with {overlap}px overlap)")
-
-        # Calculate tile grid
-        stride = tile_size - overlap
-        num_tiles_x = int(np.ceil((width - overlap) / stride))
-        num_tiles_y = int(np.ceil((height - overlap) / stride))
-        print(f"[MobileSAM] Will process {num_tiles_x * num_tiles_y} tiles ({num_tiles_x}x{num_tiles_y} grid)")
-
-        # Initialize output mask
-        print(f"[MobileSAM] Initializing output mask ({height}x{width})...")
-        combined_mask = np.zeros((height, width), dtype=np.uint32)
-        next_label = 1
-        print(f"[MobileSAM] Output mask initialized, starting tile processing...")
-
-        # Track timing for progress estimation
-        total_tiles = num_tiles_x * num_tiles_y
-        tiles_processed = 0
-        start_time = time.time()
-        tile_times = []
-        last_reported_pct = -1
-
-        # Process each tile
-        for ty in range(num_tiles_y):
-            for tx in range(num_tiles_x):
-                tile_start_time = time.time()
-                tiles_processed += 1
-
-                if tiles_processed == 1:
-                    print(f"[MobileSAM] Starting first tile ({ty}, {tx})...")
-
-                # Calculate tile boundaries
-                y_start = ty * stride
-                x_start = tx * stride
-                y_end = min(y_start + tile_size, height)
-                x_end = min(x_start + tile_size, width)
-
-                # Extract tile
-                if is_grayscale:
-                    tile = image_array[y_start:y_end, x_start:x_end]
-                else:
-                    tile = image_array[y_start:y_end, x_start:x_end, :]
-
-                if tiles_processed == 1:
-                    print(f"[MobileSAM] Extracted tile shape: {tile.shape}")
-                    print(f"[MobileSAM] Creating mask generator for first tile...")
-
-                # Create fresh mask generator for this tile to avoid state issues
-                # Use fewer points for tiles to reduce memory usage
-                tile_mask_generator = SamAutomaticMaskGenerator(
-                    model=mobile_sam,
-                    points_per_side=points_per_side_tile,
-                    pred_iou_thresh=0.8,
-                    stability_score_thresh=0.92,
-                    crop_n_layers=0,
-                    min_mask_region_area=50,  # Reduced from 100 for smaller tiles
-                )
+def _run_sam2_segmentation(image_array, tile_size, overlap, stats, output_path):
+    print("[MobileSAM] Starting segmentation...")
 
-                if tiles_processed == 1:
-                    print(f"[MobileSAM] Mask generator created, processing first tile...")
+    # Get original dimensions
+    print("[MobileSAM] Getting image dimensions...")
+    if len(image_array.shape) == 2:
+        height, width = image_array.shape
+        is_grayscale = True
+    else:
+        height, width = image_array.shape[:2]
+        is_grayscale = False
+    print(f"[MobileSAM] Image: {width}x{height}, grayscale={is_grayscale}")
 
-                # Process tile with MobileSAM
-                tile_mask = _process_mobile_sam_single_image(tile, tile_mask_generator, device)
+    device = get_device()
+    print(f"[MobileSAM] Using device {device}")
 
-                if tiles_processed == 1:
-                    print(f"[MobileSAM] First tile processed! Result shape: {tile_mask.shape}")
+    # Adjust tile size and parameters for MPS to avoid OOM
+    if device.type == "mps":
+        tile_size = 1024  # Smaller tiles for MPS
+        overlap = 128
+        points_per_side_single = 16  # Fewer points for MPS
+        points_per_side_tile = 12
+        print(f"[MobileSAM] Using MPS-optimized settings: tile_size={tile_size}, points={points_per_side_tile}")
+    else:
+        points_per_side_single = 32
+        points_per_side_tile = 24
+
+    # Encoder batches only pay off on CPU; MPS is short on memory already
+    tile_batch = TILE_BATCH if device.type == "cpu" else 1
+    start_time = time.time()
+
+    # Check if tiling is needed
+    needs_tiling = width > tile_size or height > tile_size
+    print(f"[MobileSAM] Needs tiling: {needs_tiling} (image {width}x{height}, tile size {tile_size})")
+
+    if not needs_tiling:
+        # Small image - process directly
+        print("[MobileSAM] Image fits in single tile, processing directly")
+        logger.info("Image fits in single tile, processing directly")
+        num_threads = _in_process_threads()
+        # Model of this worker process, only loaded by the first call
+        mobile_sam, device = get_mobile_sam()
+        # Create mask generator for single image
+        mask_generator = _make_mask_generator(mobile_sam, points_per_side_single, 100)
+        combined_mask = _process_mobile_sam_single_image(
+            image_array, mask_generator, device
+        )
+        _report_throughput(stats, 1, time.time() - start_time, 1, num_threads)
+        return combined_mask
 
+    # Large image - use tiled processing
+    print(f"[MobileSAM] Large image - using tiled processing ({tile_size}x{tile_size} with {overlap}px overlap)")
+
+    # Calculate tile grid
+    stride = tile_size - overlap
+    num_tiles_x = int(np.ceil((width - overlap) / stride))
+    num_tiles_y = int(np.ceil((height - overlap) / stride))
+    total_tiles = num_tiles_x * num_tiles_y
+    print(f"[MobileSAM] Will process {total_tiles} tiles ({num_tiles_x}x{num_tiles_y} grid)")
+
+    # Calculate tile boundaries
+    tile_boxes = []
+    for ty in range(num_tiles_y):
+        for tx in range(num_tiles_x):
+            y_start = ty * stride
+            x_start = tx * stride
+            y_end = min(y_start + tile_size, height)
+            x_end = min(x_start + tile_size, width)
+            tile_boxes.append((y_start, x_start, y_end, x_end))
+
+    # Spread the tiles over worker processes on CPU, enough of them to give
+    # every process at least one encoder batch
+    workers = min(TILE_WORKERS, -(-total_tiles // tile_batch))
+    if device.type != "cpu":
+        workers = 1
+    if workers > 1:
+        num_threads = NUM_THREADS or max(1, _cpu_count() // workers)
+    else:
+        num_threads = _in_process_threads()
+
+    with tempfile.TemporaryDirectory(prefix="sam_", dir=SCRATCH_DIR) as scratch_dir:
+        # Label mask of every tile, written by whichever process segments it
+        tile_stack_path = os.path.join(scratch_dir, "tiles.npy")
+        tile_stack = np.lib.format.open_memmap(
+            tile_stack_path,
+            mode="w+",
+            dtype=np.uint16,
+            shape=(total_tiles, tile_size, tile_size),
+        )
+        jobs = [
+            [(index, tile_boxes[index]) for index in range(i, min(i + tile_batch, total_tiles))]
+            for i in range(0, total_tiles, tile_batch)
+        ]
+        tile_args = (points_per_side_tile, 50, num_threads)  # 50: smaller tiles
+
+        if workers > 1:
+            print(f"[MobileSAM] Segmenting in {workers} processes with {num_threads} threads each")
+            # The processes read their tiles from a memory-mapped copy of the input
+            image_path = os.path.join(scratch_dir, "image.npy")
+            np.save(image_path, image_array)
+            label_counts = _segment_tiles_in_pool(
+                workers, jobs, image_path, tile_stack_path, tile_args, start_time
+            )
+        else:
+            label_counts = {}
+            for job in jobs:
+                label_counts.update(
+                    _segment_tiles_job(
+                        image_array, tile_stack, job, *tile_args
+                    )
+                )
+                _log_progress(len(label_counts), len(job), total_tiles, start_time)
                 # Clean up to free memory
-                del tile_mask_generator
                 if device.type == "mps":
                     torch.mps.empty_cache()
-                import gc
-                gc.collect()
 
-                # Record tile processing time
-                tile_elapsed = time.time() - tile_start_time
-                tile_times.append(tile_elapsed)
+        tile_stack.flush()
+        print(f"[MobileSAM] Merging {total_tiles} tiles...")
+        combined_mask, total_objects = merge_tiles(
+            tile_stack,
+            tile_boxes,
+            label_counts,
+            num_tiles_x,
+            num_tiles_y,
+            overlap,
+            height,
+            width,
+            output_path,
+        )
+        del tile_stack
+
+    # Report final statistics
+    total_time = time.time() - start_time
+    logger.info(
+        f"MobileSAM tiled segmentation complete: {total_objects} total objects, "
+        f"output shape {combined_mask.shape}, "
+        f"processed {total_tiles} tiles in {total_time:.1f}s "
+        f"(avg {total_time / total_tiles:.1f}s/tile over {workers} processes)"
+    )
+    _report_throughput(stats, total_tiles, total_time, tile_batch, num_threads)
+    if stats is not None:
+        stats["workers"] = workers
+        stats["objects"] = total_objects
+    return combined_mask
 
-                # Log progress at key milestones: after first tile, then every 20%
-                progress_pct = (tiles_processed / total_tiles) * 100
-                current_milestone = int(progress_pct / 20) * 20
 
-                should_log = (tiles_processed == 1) or (
-                    current_milestone > last_reported_pct
-                    and current_milestone % 20 == 0
-                )
+def _segment_tiles_job(image, tile_stack, job, points_per_side, min_mask_region_area, num_threads):
+    """
+    Segment one encoder batch of tiles into their slots of the tile stack.
 
-                if should_log:
-                    elapsed_time = time.time() - start_time
-                    elapsed_min = elapsed_time / 60
-
-                    if tiles_processed > 1:
-                        avg_time_per_tile = sum(tile_times) / len(tile_times)
-                        remaining_tiles = total_tiles - tiles_processed
-                        est_remaining_sec = avg_time_per_tile * remaining_tiles
-                        est_remaining_min = est_remaining_sec / 60
-                        logger.info(
-                            f"[MobileSAM] Tile {tiles_processed}/{total_tiles}, "
-                            f"elapsed: {elapsed_min:.1f}min, est. remaining: {est_remaining_min:.1f}min"
-                        )
-                    else:
-                        logger.info(
-                            f"[MobileSAM] Tile {tiles_processed}/{total_tiles}, "
-                            f"elapsed: {elapsed_min:.1f}min"
-                        )
-
-                    last_reported_pct = current_milestone
-
-                # Relabel to avoid conflicts with existing labels
-                unique_labels = np.unique(tile_mask)
-                unique_labels = unique_labels[unique_labels > 0]
-
-                if len(unique_labels) > 0:
-                    # Create relabeling map
-                    relabel_map = np.zeros(tile_mask.max() + 1, dtype=np.uint32)
-                    for old_label in unique_labels:
-                        relabel_map[old_label] = next_label
-                        next_label += 1
-
-                    # Relabel tile mask
-                    tile_mask_relabeled = relabel_map[tile_mask]
-
-                    # Calculate blending region (use center of overlap)
-                    # For overlapping regions, only keep objects whose center is in this tile
-                    blend_y_start = overlap // 2 if ty > 0 else 0
-                    blend_x_start = overlap // 2 if tx > 0 else 0
-                    blend_y_end = (
-                        tile_mask_relabeled.shape[0] - (overlap // 2)
-                        if ty < num_tiles_y - 1
-                        else tile_mask_relabeled.shape[0]
-                    )
-                    blend_x_end = (
-                        tile_mask_relabeled.shape[1] - (overlap // 2)
-                        if tx < num_tiles_x - 1
-                        else tile_mask_relabeled.shape[1]
-                    )
+    Args:
+        image: The whole input image (array or memmap)
+        tile_stack: (tiles, tile_size, tile_size) uint16 array of tile masks
+        job: list of (tile index, (y_start, x_start, y_end, x_end))
 
-                    # Extract the region to keep
-                    tile_region = tile_mask_relabeled[
-                        blend_y_start:blend_y_end, blend_x_start:blend_x_end
-                    ]
-
-                    # Place in output
-                    out_y_start = y_start + blend_y_start
-                    out_x_start = x_start + blend_x_start
-                    out_y_end = out_y_start + tile_region.shape[0]
-                    out_x_end = out_x_start + tile_region.shape[1]
-
-                    # Only write where output is still 0 (no overlap)
-                    output_region = combined_mask[
-                        out_y_start:out_y_end, out_x_start:out_x_end
-                    ]
-                    mask_to_write = tile_region > 0
-                    output_region[mask_to_write] = tile_region[mask_to_write]
-
-        # Count total objects
-        total_objects = len(np.unique(combined_mask)) - 1  # Exclude 0
-
-        # Convert to optimal dtype
-        if total_objects <= 255:
-            combined_mask = combined_mask.astype(np.uint8)
-        elif total_objects <= 65535:
-            combined_mask = combined_mask.astype(np.uint16)
-
-        # Report final statistics
-        total_time = time.time() - start_time
-        avg_time_per_tile = sum(tile_times) / len(tile_times) if tile_times else 0
-        logger.info(
-            f"MobileSAM tiled segmentation complete: {total_objects} total objects, "
-            f"output shape {combined_mask.shape}, "
-            f"processed {total_tiles} tiles in {total_time:.1f}s "
-            f"(avg {avg_time_per_tile:.1f}s/tile)"
-        )
-        return combined_mask
+    Returns:
+        dict: tile index -> largest label in its mask
+    """
+    set_torch_threads(num_threads)
+    # Model of this process, only loaded by the first job
+    mobile_sam, device = get_mobile_sam()
+    mask_generator = _make_mask_generator(mobile_sam, points_per_side, min_mask_region_area)
+    tiles = (image[y0:y1, x0:x1] for _, (y0, x0, y1, x1) in job)
+    label_counts = {}
+    with torch.inference_mode():
+        for (index, _), tile_mask in zip(
+            job, segment_tiles(tiles, mask_generator, device, len(job))
+        ):
+            tile_stack[index, : tile_mask.shape[0], : tile_mask.shape[1]] = tile_mask
+            label_counts[index] = int(tile_mask.max())
+    return label_counts
+
+
+def _run_pool_job(args):
+    """_segment_tiles_job in a pool process, on the memory-mapped input and output."""
+    image_path, tile_stack_path, job, tile_args = args
+    image = np.load(image_path, mmap_mode="r")
+    tile_stack = np.load(tile_stack_path, mmap_mode="r+")
+    label_counts = _segment_tiles_job(image, tile_stack, job, *tile_args)
+    tile_stack.flush()
+    return label_counts
+
+
+def _segment_tiles_in_pool(workers, jobs, image_path, tile_stack_path, tile_args, start_time):
+    """
+    Run the tile jobs on a pool of worker processes.
 
-    except Exception as e:
-        logger.error(f"Error running MobileSAM segmentation: {str(e)}")
-        logger.error(traceback.format_exc())
+    The pool is billiard's, Celery's fork of multiprocessing, which unlike
+    multiprocessing can start processes from the (daemonic) processes of a
+    prefork worker. The processes are spawned rather than forked, since the
+    calling worker already runs torch threads, and set up Django before their
+    first job. Each loads its own MobileSAM model once and keeps it for every
+    job it gets.
+
+    Returns:
+        dict: tile index -> largest label in its mask
+    """
+    total_tiles = sum(len(job) for job in jobs)
+    label_counts = {}
+    pool = billiard.get_context("spawn").Pool(
+        processes=workers, initializer=django.setup
+    )
+    try:
+        for job_counts in pool.imap_unordered(
+            _run_pool_job,
+            [(image_path, tile_stack_path, job, tile_args) for job in jobs],
+        ):
+            label_counts.update(job_counts)
+            _log_progress(len(label_counts), len(job_counts), total_tiles, start_time)
+        pool.close()
+    except BaseException:
+        pool.terminate()
         raise
+    finally:
+        pool.join()
+    return label_counts
+
+
+def _log_progress(tiles_processed, tiles_added, total_tiles, start_time):
+    """Log progress at key milestones: after the first tiles, then every 20%"""
+    previous = tiles_processed - tiles_added
+    if previous and previous * 5 // total_tiles == tiles_processed * 5 // total_tiles:
+        return
+    elapsed_time = time.time() - start_time
+    remaining_min = elapsed_time / tiles_processed * (total_tiles - tiles_processed) / 60
+    logger.info(
+        f"[MobileSAM] Tile {tiles_processed}/{total_tiles}, "
+        f"elapsed: {elapsed_time / 60:.1f}min, est. remaining: {remaining_min:.1f}min"
+    )
+
+
+def label_mask_image(mask):
+    """
+    pyvips image of a label mask from run_sam2_segmentation.
+
+    A memory-mapped mask is read from its file as the image is consumed
+    (e.g. by pngsave or dzsave) rather than loaded into memory.
+    """
+    if isinstance(mask, np.memmap):
+        img = pyvips.Image.rawload(
+            mask.filename,
+            mask.shape[1],
+            mask.shape[0],
+            1,
+            offset=mask.offset,
+            format=_VIPS_FORMATS[mask.dtype.name],
+        )
+    else:
+        img = pyvips.Image.new_from_array(mask)
+    # Otherwise savers reduce labels above 255 to 8 bits
+    return img.copy(interpretation="b-w" if mask.dtype == np.uint8 else "grey16")
+
+
+def _report_throughput(stats, tiles, seconds, tile_batch, num_threads):
+    tiles_per_second = tiles / seconds if seconds > 0 else 0
+    logger.info(
+        f"[MobileSAM] {tiles} tiles in {seconds:.1f}s: {tiles_per_second:.3f} tiles/s "
+        f"({tile_batch} tiles per batch, {num_threads} threads)"
+    )
+    if stats is not None:
+        stats.update(
+            {
+                "tiles": tiles,
+                "seconds": round(seconds, 2),
+                "tiles_per_second": round(tiles_per_second, 4),
+                "tile_batch": tile_batch,
+                "num_threads": num_threads,
+            }
+        )
 
 
 def _process_mobile_sam_single_image(
@@ -313,18 +481,7 @@ def _process_mobile_sam_single_image(
         Combined mask as uint16 where each object has a unique label
     """
     # Ensure image is in correct format (HWC uint8 RGB)
-    if len(image_array.shape) == 2:
-        # Grayscale to RGB
-        image_rgb = np.stack([image_array, image_array, image_array], axis=-1)
-    else:
-        image_rgb = image_array
-
-    if image_rgb.dtype != np.uint8:
-        # Normalize to 0-255 uint8
-        if image_rgb.max() <= 1:
-            image_rgb = (image_rgb * 255).astype(np.uint8)
-        else:
-            image_rgb = image_rgb.astype(np.uint8)
+    image_rgb = _to_rgb_uint8(image_array)
 
     # For MPS devices, monkey-patch torch.as_tensor to force float32
     device_type = mask_generator.predictor.device.type if hasattr(mask_generator, 'predictor') else None
@@ -0,0 +1,106 @@
+"""Worker-scoped MobileSAM models, loaded once per process and reused across tasks."""
+
+import logging
+import os
+import resource
+import sys
+import time
+
+import torch
+from django.conf import settings
+from mobile_sam import sam_model_registry
+
+logger = logging.getLogger(__name__)
+
+MODEL_TYPE = getattr(settings, "MOBILE_SAM_MODEL_TYPE", "vit_t")
+CHECKPOINT = getattr(
+    settings,
+    "MOBILE_SAM_CHECKPOINT",
+    os.path.join(settings.BASE_DIR, "mobile_sam.pt"),
+)
+
+# (model_type, checkpoint) -> (model, device), and the load stats of each
+_models = {}
+_model_stats = {}
+
+
+def _resident_memory():
+    """Resident memory of this process in bytes (the peak where /proc is missing)."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def get_device() -> torch.device:
+    """Prefer CUDA, then MPS, then CPU. MobileSAM is lightweight and works well on MPS."""
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if torch.backends.mps.is_available():
+        os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
+        # MPS doesn't support float64, so set default to float32
+        torch.set_default_dtype(torch.float32)
+        return torch.device("mps")
+    return torch.device("cpu")
+
+
+def get_mobile_sam(model_type: str = MODEL_TYPE, checkpoint: str = CHECKPOINT):
+    """
+    MobileSAM model of this process, loaded from checkpoint on first use.
+
+    Returns:
+        tuple: (model in eval mode on its device, torch.device)
+    """
+    key = (model_type, str(checkpoint))
+    if key in _models:
+        return _models[key]
+
+    device = get_device()
+    memory_before = _resident_memory()
+    start = time.time()
+    logger.info(f"[MobileSAM] Loading model from {checkpoint} onto {device}...")
+    mobile_sam = sam_model_registry[model_type](checkpoint=checkpoint)
+    mobile_sam.to(device=device)
+    if device.type == "mps":
+        mobile_sam = mobile_sam.float()  # Ensure model is float32
+    mobile_sam.eval()
+
+    _model_stats[key] = {
+        "model_type": model_type,
+        "checkpoint": str(checkpoint),
+        "device": device.type,
+        "pid": os.getpid(),
+        "load_seconds": round(time.time() - start, 3),
+        "parameter_bytes": sum(
+            p.numel() * p.element_size() for p in mobile_sam.parameters()
+        ),
+        "resident_bytes_added": _resident_memory() - memory_before,
+    }
+    logger.info(f"[MobileSAM] Model ready: {_model_stats[key]}")
+    _models[key] = (mobile_sam, device)
+    return _models[key]
+
+
+def get_model_stats():
+    """
+    Load stats of the models of this process, with its current resident memory.
+
+    Returns:
+        dict: {"pid", "resident_bytes", "models": [per model load stats]}
+    """
+    return {
+        "pid": os.getpid(),
+        "resident_bytes": _resident_memory(),
+        "models": list(_model_stats.values()),
+    }
+
+
+def preload_mobile_sam():
+    """Load the default model when a worker process starts, see server.celery."""
+    try:
+        get_mobile_sam()
+    except Exception as e:
+        # The worker still serves every other task; SAM tasks retry the load
+        logger.error(f"Could not preload MobileSAM from {CHECKPOINT}: {e}")
@@ -0,0 +1,149 @@
+"""Merging of the tile masks of a tiled segmentation into one canvas mask."""
+
+import numpy as np
+from django.conf import settings
+
+# Labels of neighbouring tiles overlapping at least this much are one object
+SEAM_IOU = getattr(settings, "MOBILE_SAM_SEAM_IOU", 0.5)
+
+
+def _seam_pairs(tile_stack, box_a, box_b, index_a, index_b, offsets):
+    """
+    Global labels of two overlapping tiles that are the same object.
+
+    Within the overlap of the two tiles, every pair of labels that share
+    pixels is scored by IoU over the overlap, and kept if it reaches SEAM_IOU.
+
+    Returns:
+        numpy.ndarray: (N, 2) pairs of global labels
+    """
+    y0, x0 = max(box_a[0], box_b[0]), max(box_a[1], box_b[1])
+    y1, x1 = min(box_a[2], box_b[2]), min(box_a[3], box_b[3])
+    if y1 <= y0 or x1 <= x0:
+        return np.empty((0, 2), dtype=np.int64)
+    labels_a = tile_stack[
+        index_a, y0 - box_a[0] : y1 - box_a[0], x0 - box_a[1] : x1 - box_a[1]
+    ].astype(np.int64).ravel()
+    labels_b = tile_stack[
+        index_b, y0 - box_b[0] : y1 - box_b[0], x0 - box_b[1] : x1 - box_b[1]
+    ].astype(np.int64).ravel()
+    area_a = np.bincount(labels_a)
+    area_b = np.bincount(labels_b)
+    both = (labels_a > 0) & (labels_b > 0)
+    pairs, intersection = np.unique(
+        labels_a[both] * len(area_b) + labels_b[both], return_counts=True
+    )
+    a, b = np.divmod(pairs, len(area_b))
+    iou = intersection / (area_a[a] + area_b[b] - intersection)
+    keep = iou >= SEAM_IOU
+    return np.column_stack([a[keep] + offsets[index_a], b[keep] + offsets[index_b]])
+
+
+def _union_labels(parent, pairs):
+    """Join the labels of every pair in the union-find forest parent."""
+    for a, b in pairs:
+        while parent[a] != a:
+            parent[a] = a = parent[parent[a]]
+        while parent[b] != b:
+            parent[b] = b = parent[parent[b]]
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+
+def merge_tiles(
+    tile_stack, tile_boxes, label_counts, num_tiles_x, num_tiles_y, overlap, height, width, output_path=None
+):
+    """
+    Assemble the tile masks of the tile stack into one canvas label mask.
+
+    Every tile label gets a global label, shifted past the labels of the
+    tiles before it. Labels of neighbouring tiles (including diagonal ones)
+    that match in their overlap are joined with union-find, so objects
+    crossing a seam keep one label. The center of each tile (the tile minus
+    half the overlap on inner sides) is then pasted through a lookup table
+    from tile labels to final labels, which are numbered in order of first
+    appearance so the object count is known without another pass.
+
+    The mask gets the smallest dtype that holds every joined object. With
+    output_path it is memory-mapped to that .npy file and written to disk
+    tile by tile, so only the tiles being merged are in memory.
+
+    Returns:
+        tuple: ((height, width) label mask, number of objects)
+    """
+    counts = np.array([label_counts[index] for index in range(len(tile_boxes))])
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    parent = np.arange(int(counts.sum()) + 1)
+
+    # Join labels across seams, only reading the overlaps of the tiles
+    for index, box in enumerate(tile_boxes):
+        ty, tx = divmod(index, num_tiles_x)
+        if not counts[index]:
+            continue
+        for ny, nx in ((ty, tx + 1), (ty + 1, tx - 1), (ty + 1, tx), (ty + 1, tx + 1)):
+            if not (0 <= ny < num_tiles_y and 0 <= nx < num_tiles_x):
+                continue
+            neighbour = ny * num_tiles_x + nx
+            if counts[neighbour]:
+                _union_labels(
+                    parent,
+                    _seam_pairs(tile_stack, box, tile_boxes[neighbour], index, neighbour, offsets),
+                )
+    # Point every label at its root
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    # Objects left after joining, an upper bound of the labels in the mask
+    num_roots = int(np.count_nonzero(parent == np.arange(len(parent)))) - 1
+    if num_roots <= 255:
+        dtype = np.uint8
+    elif num_roots <= 65535:
+        dtype = np.uint16
+    else:
+        dtype = np.uint32
+    if output_path:
+        combined_mask = np.lib.format.open_memmap(
+            output_path, mode="w+", dtype=dtype, shape=(height, width)
+        )
+    else:
+        combined_mask = np.zeros((height, width), dtype=dtype)
+    final_labels = np.zeros(len(parent), dtype=dtype)
+    total_objects = 0
+    for index, (y_start, x_start, y_end, x_end) in enumerate(tile_boxes):
+        ty, tx = divmod(index, num_tiles_x)
+        if not counts[index]:
+            continue
+
+        # Calculate blending region (use center of overlap)
+        blend_y_start = overlap // 2 if ty > 0 else 0
+        blend_x_start = overlap // 2 if tx > 0 else 0
+        blend_y_end = y_end - y_start - (overlap // 2) if ty < num_tiles_y - 1 else y_end - y_start
+        blend_x_end = x_end - x_start - (overlap // 2) if tx < num_tiles_x - 1 else x_end - x_start
+        tile_region = tile_stack[
+            index, blend_y_start:blend_y_end, blend_x_start:blend_x_end
+        ]
+
+        # Number the objects seen for the first time in this region
+        roots = parent[offsets[index] : offsets[index] + counts[index] + 1]
+        present = np.bincount(tile_region.ravel(), minlength=len(roots)) > 0
+        present[0] = False
+        new_roots = np.unique(roots[present])
+        new_roots = new_roots[final_labels[new_roots] == 0]
+        final_labels[new_roots] = np.arange(
+            total_objects + 1, total_objects + len(new_roots) + 1
+        )
+        total_objects += len(new_roots)
+
+        # Relabel with the lookup table and place in output
+        relabel_map = final_labels[roots]
+        relabel_map[0] = 0
+        combined_mask[
+            y_start + blend_y_start : y_start + blend_y_end,
+            x_start + blend_x_start : x_start + blend_x_end,
+        ] = relabel_map[tile_region]
+    if output_path:
+        combined_mask.flush()
+    return combined_mask, total_objects
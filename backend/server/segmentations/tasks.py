@@ -9,13 +9,17 @@ import os
 import numpy as np
 from PIL import Image
 import io
+import tempfile
 import time
 
+from image.services import save_dzi
 from .models import SegmentationFile
 from .services import (
     convert_to_compressed_png,
     process_segmentation_file_with_progress,
     apply_sobel_filter,
+    get_model_stats,
+    label_mask_image,
     run_sam2_segmentation,  # Now using MobileSAM - much faster!
 )
 
@@ -73,23 +77,9 @@ def process_segmentation_upload_async(self, segmentation_file_id):
         seg_file.progress_message = "Generating DZI tiles..."
         seg_file.save(update_fields=["progress", "progress_message"])
 
-        # Check if image is small (≤512x512) and adjust DZI parameters
         step_start = time.time()
         print(f"[STEP 1] Generating DZI tiles for original image...")
-        if img.width <= 512 and img.height <= 512:
-            img.dzsave(
-                dzi_save_path,
-                id=id_url,
-                tile_size=512,
-                depth="one",
-                layout=pyvips.enums.ForeignDzLayout.IIIF3,
-            )
-        else:
-            img.dzsave(
-                dzi_save_path,
-                id=id_url,
-                layout=pyvips.enums.ForeignDzLayout.IIIF3,
-            )
+        save_dzi(img, dzi_save_path, id_url, profile="segmentation")
         print(f"[STEP 1] ✓ Generated original DZI in {time.time() - step_start:.2f}s")
 
         # Update dzi_file field
@@ -196,20 +186,7 @@ def process_segmentation_upload_async(self, segmentation_file_id):
             print(f"[STEP 3] Generating DZI tiles for Sobel edges...")
             sobel_img = pyvips.Image.new_from_file(sobel_png_path, access="sequential")
 
-            if sobel_img.width <= 512 and sobel_img.height <= 512:
-                sobel_img.dzsave(
-                    sobel_dir,
-                    id=id_url,
-                    tile_size=512,
-                    depth="one",
-                    layout=pyvips.enums.ForeignDzLayout.IIIF3,
-                )
-            else:
-                sobel_img.dzsave(
-                    sobel_dir,
-                    id=id_url,
-                    layout=pyvips.enums.ForeignDzLayout.IIIF3,
-                )
+            save_dzi(sobel_img, sobel_dir, id_url, profile="segmentation")
             print(f"[STEP 3] ✓ Generated Sobel DZI in {time.time() - step_start:.2f}s")
 
             # Update sobel_dzi_file field
@@ -232,23 +209,40 @@ def process_segmentation_upload_async(self, segmentation_file_id):
             step_start = time.time()
             print(f"\n[STEP 4] Running MobileSAM segmentation (this may take a while)...")
             print(f"[STEP 4] About to call run_sam2_segmentation with array shape: {img_array.shape}, dtype: {img_array.dtype}")
-            sam2_masks = run_sam2_segmentation(img_array)
-            print(f"[STEP 4] ✓ MobileSAM segmentation complete in {time.time() - step_start:.2f}s")
-
-            # Save MobileSAM masks as PNG
-            step_start = time.time()
-            print(f"[STEP 4] Saving MobileSAM masks as PNG...")
-            sam2_dir = os.path.join(
-                settings.MEDIA_ROOT,
-                "tmp_images",
-                str(seg_file.canvas.id),
-                "segmentations",
-                str(seg_file.id),
-                "sam2"
-            )
-            os.makedirs(sam2_dir, exist_ok=True)
-            sam2_png_path = os.path.join(sam2_dir, "masks.png")
-            Image.fromarray(sam2_masks).save(sam2_png_path, format='PNG', compress_level=6)
+            sam_stats = {}
+            # The mask of a large image is memory-mapped to the scratch
+            # directory and streamed from there into the PNG
+            with tempfile.TemporaryDirectory(
+                prefix="sam_", dir=getattr(settings, "SEGMENTATION_SCRATCH_DIR", None)
+            ) as scratch_dir:
+                sam2_masks = run_sam2_segmentation(
+                    img_array,
+                    stats=sam_stats,
+                    output_path=os.path.join(scratch_dir, "masks.npy"),
+                )
+                print(f"[STEP 4] ✓ MobileSAM segmentation complete in {time.time() - step_start:.2f}s")
+                # Inference time, throughput and the (once per worker) model load,
+                # for sizing the workers
+                seg_file.processing_info["sam_seconds"] = round(time.time() - step_start, 2)
+                seg_file.processing_info["sam_throughput"] = sam_stats
+                seg_file.processing_info["sam_model"] = get_model_stats()
+                seg_file.save(update_fields=["processing_info"])
+
+                # Save MobileSAM masks as PNG
+                step_start = time.time()
+                print(f"[STEP 4] Saving MobileSAM masks as PNG...")
+                sam2_dir = os.path.join(
+                    settings.MEDIA_ROOT,
+                    "tmp_images",
+                    str(seg_file.canvas.id),
+                    "segmentations",
+                    str(seg_file.id),
+                    "sam2"
+                )
+                os.makedirs(sam2_dir, exist_ok=True)
+                sam2_png_path = os.path.join(sam2_dir, "masks.png")
+                label_mask_image(sam2_masks).pngsave(sam2_png_path, compression=6)
+                del sam2_masks
             print(f"[STEP 4] ✓ Saved MobileSAM PNG in {time.time() - step_start:.2f}s")
 
             # Generate DZI for MobileSAM
@@ -260,20 +254,7 @@ def process_segmentation_upload_async(self, segmentation_file_id):
             print(f"[STEP 4] Generating DZI tiles for MobileSAM masks...")
             sam2_img = pyvips.Image.new_from_file(sam2_png_path, access="sequential")
 
-            if sam2_img.width <= 512 and sam2_img.height <= 512:
-                sam2_img.dzsave(
-                    sam2_dir,
-                    id=id_url,
-                    tile_size=512,
-                    depth="one",
-                    layout=pyvips.enums.ForeignDzLayout.IIIF3,
-                )
-            else:
-                sam2_img.dzsave(
-                    sam2_dir,
-                    id=id_url,
-                    layout=pyvips.enums.ForeignDzLayout.IIIF3,
-                )
+            save_dzi(sam2_img, sam2_dir, id_url, profile="segmentation")
             print(f"[STEP 4] ✓ Generated MobileSAM DZI in {time.time() - step_start:.2f}s")
 
             # Update sam2_dzi_file field (keeping same field name for backward compatibility)
@@ -1,3 +1,125 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase
+
+from segmentations.services.tile_merge import _seam_pairs, _union_labels, merge_tiles
+
+
+def _objects(height, width, count, seed=0):
+    """Label mask of non-touching rectangles, numbered from 1."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width), dtype=np.int64)
+    label = 0
+    while label < count:
+        h, w = rng.integers(8, 60, 2)
+        y, x = rng.integers(0, height - h), rng.integers(0, width - w)
+        if mask[max(0, y - 1) : y + h + 1, max(0, x - 1) : x + w + 1].any():
+            continue
+        label += 1
+        mask[y : y + h, x : x + w] = label
+    return mask
+
+
+def _tile(mask, tile_size, overlap, seed=0):
+    """
+    Tile stack of a label mask, laid out like _run_sam2_segmentation does,
+    with the labels of every tile renumbered in a random order.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = mask.shape
+    stride = tile_size - overlap
+    num_tiles_x = int(np.ceil((width - overlap) / stride))
+    num_tiles_y = int(np.ceil((height - overlap) / stride))
+    tile_boxes = [
+        (
+            ty * stride,
+            tx * stride,
+            min(ty * stride + tile_size, height),
+            min(tx * stride + tile_size, width),
+        )
+        for ty in range(num_tiles_y)
+        for tx in range(num_tiles_x)
+    ]
+    tile_stack = np.zeros((len(tile_boxes), tile_size, tile_size), dtype=np.uint16)
+    label_counts = {}
+    for index, (y0, x0, y1, x1) in enumerate(tile_boxes):
+        crop = mask[y0:y1, x0:x1]
+        labels = np.unique(crop[crop > 0])
+        lookup = np.zeros(mask.max() + 1, dtype=np.int64)
+        lookup[labels] = rng.permutation(len(labels)) + 1
+        tile_stack[index, : y1 - y0, : x1 - x0] = lookup[crop]
+        label_counts[index] = len(labels)
+    return tile_stack, tile_boxes, label_counts, num_tiles_x, num_tiles_y
+
+
+class MergeTilesTests(SimpleTestCase):
+    def assert_same_objects(self, merged, mask):
+        # Every object keeps exactly one label and no two objects share one
+        pairs = np.unique(np.stack([merged.ravel(), mask.ravel()]), axis=1)
+        self.assertEqual(pairs.shape[1], len(np.unique(mask)))
+        np.testing.assert_array_equal(merged == 0, mask == 0)
+
+    def test_objects_crossing_seams_keep_one_label(self):
+        mask = _objects(300, 420, 60)
+        tiles = _tile(mask, 128, 32)
+        merged, total_objects = merge_tiles(*tiles, 32, 300, 420)
+        self.assertEqual(total_objects, 60)
+        self.assertEqual(merged.dtype, np.uint8)
+        self.assertEqual(set(np.unique(merged)), set(range(61)))
+        self.assert_same_objects(merged, mask)
+
+    def test_many_objects_widen_the_dtype(self):
+        mask = _objects(400, 500, 300, seed=1)
+        tiles = _tile(mask, 160, 40, seed=1)
+        merged, total_objects = merge_tiles(*tiles, 40, 400, 500)
+        self.assertEqual(total_objects, 300)
+        self.assertEqual(merged.dtype, np.uint16)
+        self.assert_same_objects(merged, mask)
+
+    def test_output_path(self):
+        scratch_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, scratch_dir)
+        mask = _objects(300, 420, 60)
+        tiles = _tile(mask, 128, 32)
+        in_memory, _ = merge_tiles(*tiles, 32, 300, 420)
+        output_path = os.path.join(scratch_dir, "mask.npy")
+        mapped, total_objects = merge_tiles(*tiles, 32, 300, 420, output_path)
+        self.assertEqual(total_objects, 60)
+        np.testing.assert_array_equal(np.load(output_path), in_memory)
+        np.testing.assert_array_equal(np.asarray(mapped), in_memory)
+
+
+class SeamPairsTests(SimpleTestCase):
+    def test_pairs_below_the_seam_iou_are_dropped(self):
+        # Two 40x40 tiles side by side, overlapping in 10 columns
+        tile_stack = np.zeros((2, 40, 40), dtype=np.uint16)
+        box_a, box_b = (0, 0, 40, 40), (0, 30, 40, 70)
+        # The same object in both tiles
+        tile_stack[0, 0:10, 30:40] = 1
+        tile_stack[1, 0:10, 0:10] = 2
+        # An object of tile a only partly found in tile b (IoU 0.3)
+        tile_stack[0, 20:30, 30:40] = 2
+        tile_stack[1, 20:23, 0:10] = 1
+        offsets = np.array([0, 2])
+        pairs = _seam_pairs(tile_stack, box_a, box_b, 0, 1, offsets)
+        np.testing.assert_array_equal(pairs, [[1, 4]])
+
+    def test_tiles_without_overlap(self):
+        tile_stack = np.ones((2, 10, 10), dtype=np.uint16)
+        pairs = _seam_pairs(
+            tile_stack, (0, 0, 10, 10), (0, 10, 10, 20), 0, 1, np.array([0, 1])
+        )
+        self.assertEqual(pairs.shape, (0, 2))
+
+    def test_union_labels_joins_to_the_smallest_label(self):
+        parent = np.arange(7)
+        _union_labels(parent, [(5, 6), (3, 6), (1, 2)])
+        roots = []
+        for label in range(7):
+            while parent[label] != label:
+                label = parent[label]
+            roots.append(label)
+        self.assertEqual(roots, [0, 1, 1, 3, 4, 3, 3])
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 from django.conf import settings
 
 # Set the default Django settings module for the 'celery' program.
@@ -19,3 +20,43 @@ app.autodiscover_tasks()
 @app.task(bind=True)
 def debug_task(self):
     print(f"Request: {self.request!r}")
+
+
+# Size of the prefork pool, recorded before the worker processes are forked
+WORKER_POOL_SIZE = None
+
+
+@worker_init.connect
+def record_pool_size(sender=None, **kwargs):
+    global WORKER_POOL_SIZE
+    WORKER_POOL_SIZE = getattr(sender, "concurrency", None)
+
+
+@worker_process_init.connect
+def configure_libvips(**kwargs):
+    # Share the cores between the pool processes instead of every process
+    # starting one libvips thread per core
+    from image.services import set_worker_concurrency
+
+    set_worker_concurrency(WORKER_POOL_SIZE or app.conf.worker_concurrency)
+
+
+@worker_process_init.connect
+def configure_torch(**kwargs):
+    # Same share of the cores for segmentations run inside the worker process
+    # (tiled runs spread over their own process pool instead)
+    from image.services import worker_concurrency
+    from segmentations.services import set_torch_threads
+
+    set_torch_threads(
+        worker_concurrency(WORKER_POOL_SIZE or app.conf.worker_concurrency)
+    )
+
+
+@worker_process_init.connect
+def load_models(**kwargs):
+    # Load MobileSAM once per worker process instead of once per segmentation
+    if getattr(settings, "MOBILE_SAM_PRELOAD", False):
+        from segmentations.services import preload_mobile_sam
+
+        preload_mobile_sam()
@@ -146,3 +146,78 @@ CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
+
+# MIMS processing
+# Number of registered species images kept in memory per worker process
+MIMS_SPECIES_CACHE_SIZE = 32
+# Register the plane stack once on a reference species (SE or the highest-count
+# species) and apply the same drift matrices to every other species
+MIMS_SHARED_STACK_TRANSFORMS = True
+# Alignment search used by create_alignment_estimates: "fft" scores every
+# translation at once over a coarse-to-fine pyramid, "sliding" is the original
+# 20 px sliding window
+MIMS_ALIGNMENT_ENGINE = "fft"
+# Shrink factors of the coarse-to-fine alignment search, coarsest first. At 8x
+# the runner-up matches start to drift from the full-resolution ones.
+MIMS_ALIGNMENT_PYRAMID_LEVELS = [4, 2, 1]
+# Half-width of the local search around a FROM_SET alignment predicted from
+# stage coordinates, as a fraction of the MIMS image size
+MIMS_FROM_SET_SEARCH_RADIUS = 0.15
+# Thin-plate spline unwarping evaluates the spline every MIMS_TPS_GRID_STEP
+# pixels and interpolates in between; cells whose interpolation error exceeds
+# MIMS_TPS_TOLERANCE pixels (of the MIMS-resolution canvas) are evaluated exactly
+MIMS_TPS_GRID_STEP = 8
+MIMS_TPS_TOLERANCE = 0.05
+# What is stored besides each overlay's DZI pyramid: "dzi" keeps nothing else,
+# "dzi+png" writes the full-resolution PNG the first time it is requested and
+# "dzi+tiff" writes a tiled, deflate-compressed TIFF master with the pyramid
+MIMS_OVERLAY_STORAGE = "dzi+png"
+
+# DZI tiles (image.services.dzi, used for EM images, MIMS composites and
+# segmentations). DZI_SUFFIX takes the tile format with its libvips save
+# options, e.g. ".jpg[Q=75]", ".webp[Q=80]" or ".png[compression=6]"; images
+# that fit in one tile are always written as a single level. 16 bit images keep
+# their high byte ("shift") or, with PNG tiles only, all 16 bits ("keep").
+DZI_TILE_SIZE = 512
+DZI_OVERLAP = 0
+DZI_SUFFIX = ".jpg[Q=75]"
+DZI_DEPTH = "onetile"
+DZI_16BIT = "shift"
+# libvips threads per task type (image.services.concurrency), 0 meaning every
+# core: one EM pyramid at a time gets the whole machine, overlays and
+# composites run many at once in the Celery pool with one thread each. Other
+# work uses the worker default of cores / Celery worker processes.
+VIPS_CONCURRENCY_PROFILES = {
+    "em": 0,
+    "overlay": 1,
+    "composite": 1,
+    "segmentation": 0,
+}
+
+# MobileSAM (segmentations.services.sam_models), loaded once per Celery worker
+# process on first use, then reused. MOBILE_SAM_PRELOAD loads it when the
+# process starts instead; turn it on only for workers that run segmentation
+# tasks, since every other worker process would hold an unused model. Tiles
+# segmented in spawned processes do not use it, see MOBILE_SAM_TILE_WORKERS.
+MOBILE_SAM_CHECKPOINT = os.path.join(BASE_DIR, "mobile_sam.pt")
+MOBILE_SAM_MODEL_TYPE = "vit_t"
+MOBILE_SAM_PRELOAD = False
+# CPU inference: tiles encoded together per image encoder pass, point prompts
+# per mask decoder pass, and torch threads per segmentation process (0 meaning
+# the worker process's share of the cores, or for the processes of a tiled
+# run, the cores split between them)
+MOBILE_SAM_TILE_BATCH = 4
+MOBILE_SAM_POINTS_PER_BATCH = 256
+MOBILE_SAM_NUM_THREADS = 0
+# Tiles of large images are segmented by this many spawned processes, which
+# write their masks to memory-mapped files in SEGMENTATION_SCRATCH_DIR (None
+# for the system temporary directory). The input image is copied there with
+# np.save for the processes to map, and each process loads its own MobileSAM,
+# so a tiled run holds MOBILE_SAM_TILE_WORKERS models besides the worker's own.
+# The merged canvas mask is memory-mapped there too until it is saved, so it
+# needs room for the input and both masks
+MOBILE_SAM_TILE_WORKERS = 4
+SEGMENTATION_SCRATCH_DIR = None
+# Labels of neighbouring tiles with at least this IoU in their overlap are
+# merged into one object
+MOBILE_SAM_SEAM_IOU = 0.5